@@ -1,14 +1,124 @@
-from fastapi import FastAPI
-from path import messages
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response
+from modules.admission import LoadShedMiddleware, RateLimiter, StreamSlots
+from modules.db import AsyncChatDB
+from modules.storage import CHAT_BACKEND
+from modules.ingest import MESSAGE_BATCH_WINDOW_MS, MessageBatcher
+from modules.invalidation import Invalidator
+from modules.media_pipeline import MediaPipeline
+from modules.membership import MembershipCache
+from modules.partitions import PartitionMaintainer
+from modules.metrics import Gauge, MetricsMiddleware, render
+from modules.permissions import PermissionCache
+from modules.redis_conn import r
+from modules.session import sessions
 from path.users import router as user_router
 from path.chats import router as chat_router
 from path.dialog import router as dialog_router
-from path.messages import router as messages_router
+from path.messages import router as messages_router, hub, log
+from path.media import router as media_router
+from path.sync import router as sync_router
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pool for every router; sized through the PQ_POOL_* environment variables.
+    if CHAT_BACKEND == 'memory':
+        from modules.memory_storage import MemoryChatStorage
+        app.state.db = MemoryChatStorage()
+    else:
+        app.state.db = AsyncChatDB()
+    await app.state.db.connect()
+    # Creates upcoming message partitions and archives old ones; Postgres only.
+    app.state.partitions = PartitionMaintainer(app.state.db) if isinstance(app.state.db, AsyncChatDB) else None
+    if app.state.partitions is not None:
+        await app.state.partitions.start()
+    app.state.membership = MembershipCache(app.state.db, r)
+    app.state.permissions = PermissionCache(app.state.db)
+    app.state.invalidator = Invalidator(r)
+    app.state.invalidator.on('chat', app.state.db.drop_chat)
+    app.state.invalidator.on('profile', app.state.db.drop_profile)
+    app.state.invalidator.on('recent', app.state.db.recent.apply)
+    app.state.invalidator.on('session', sessions.drop)
+    app.state.invalidator.on('member', app.state.membership.drop)
+    app.state.invalidator.on('rules', app.state.permissions.drop)
+    app.state.invalidator.on('chat', app.state.permissions.drop_chat)
+    app.state.invalidator.start()
+    app.state.db.invalidator = app.state.invalidator
+    app.state.db.permissions = app.state.permissions
+    app.state.membership.invalidator = app.state.invalidator
+    sessions.invalidator = app.state.invalidator
+    app.state.db.events = log
+    if isinstance(app.state.db, AsyncChatDB):
+        # Read-your-writes across workers; see modules/replicas.py.
+        app.state.db.replicas.redis = r
+    app.state.limiter = RateLimiter(r)
+    app.state.stream_slots = StreamSlots(r)
+    app.state.ingest = MessageBatcher(app.state.db) if MESSAGE_BATCH_WINDOW_MS > 0 else app.state.db
+    app.state.media = MediaPipeline(app.state.db)
+    await app.state.media.start()
+    yield
+    await app.state.media.close()
+    if isinstance(app.state.ingest, MessageBatcher):
+        await app.state.ingest.close()
+    await hub.close()
+    await app.state.invalidator.close()
+    if app.state.partitions is not None:
+        await app.state.partitions.close()
+    await app.state.db.close()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(LoadShedMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 
 app.include_router(user_router, prefix='/user')
 app.include_router(chat_router, prefix='/chat')
 app.include_router(dialog_router, prefix='/dialog')
 app.include_router(messages_router, prefix='/messages')
+app.include_router(media_router, prefix='/media')
+app.include_router(sync_router, prefix='/sync')
+
+
+@app.get('/status')
+async def status(request: Request):
+    ingest = request.app.state.ingest
+    return {'status_code': 200, 'pool': request.app.state.db.pool_stats(), 'hub': hub.stats(),
+            'chat_cache': request.app.state.db.chat_cache.stats(),
+            'profile_cache': request.app.state.db.profile_cache.stats(),
+            'recent_messages': request.app.state.db.recent.stats(),
+            'membership_cache': request.app.state.membership.cache.stats(),
+            'permission_cache': request.app.state.permissions.cache.stats(),
+            'ingest': ingest.stats() if isinstance(ingest, MessageBatcher) else None,
+            'rate_limiter': request.app.state.limiter.stats(),
+            'stream_slots': request.app.state.stream_slots.stats(),
+            'partitions': request.app.state.partitions.stats() if request.app.state.partitions else None,
+            'media_pipeline': request.app.state.media.stats()}
+
+def _pool_gauges():
+    stats = app.state.db.pool_stats()
+    return {(key,): stats[key] for key in ('size', 'in_use', 'waiting') if key in stats}
+
+
+def _replica_lag():
+    replicas = app.state.db.pool_stats().get('replicas', ())
+    return {(str(i),): replica['lag_s'] for i, replica in enumerate(replicas)
+            if replica['healthy'] and replica['lag_s'] is not None}
+
+
+Gauge('chat_pool_connections', 'Connection pool state.', ['state'], collect=_pool_gauges)
+Gauge('chat_replica_lag_seconds', 'How far each healthy read replica may trail the primary.', ['replica'],
+      collect=_replica_lag)
+Gauge('chat_active_streams', 'Open /messages/stream subscriptions.',
+      collect=lambda: {(): hub.stats()['subscribers']})
+Gauge('chat_media_jobs_queued', 'Queued media jobs, and how many of them are due, as of the last poll.', ['state'],
+      collect=lambda: {('queued',): app.state.media.backlog['queued'], ('due',): app.state.media.backlog['due']})
+Gauge('chat_media_job_oldest_due_seconds', 'How long the oldest due media job has been waiting.',
+      collect=lambda: {(): app.state.media.backlog['oldest_due_s']})
+Gauge('chat_stream_channels', 'Chats with at least one open stream in this worker.',
+      collect=lambda: {(): hub.stats()['channels']})
+
+
+@app.get('/metrics')
+async def metrics():
+    return Response(render(), media_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,74 @@
+"""
+Deep history paging: OFFSET versus keyset on a chat seeded with millions of
+messages. Needs PQ_DSN and the migrations applied (python -m modules.migrate).
+
+    python -m bench.history_pages [messages]
+"""
+import asyncio
+import statistics
+import sys
+import time
+import uuid
+
+from modules.db import AsyncChatDB
+
+PAGE = 40
+DEPTHS = (0, 1_000, 100_000, 1_000_000)
+RUNS = 20
+
+
+async def timed(fn, runs=RUNS):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e3
+
+
+async def main(total: int):
+    db = AsyncChatDB()
+    await db.connect()
+    name = f"bench-{uuid.uuid4().hex[:8]}"
+    user_id = await db.create_user(name, name, 'x')
+    chat_id = await db.create_chat(name, name, '', user_id)
+    try:
+        start = time.perf_counter()
+        async with db.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO messages(chat_id, sender_id, content)
+                SELECT $1, $2, 'message ' || g FROM generate_series(1, $3) g
+                """,
+                chat_id, user_id, total
+            )
+            await conn.execute("ANALYZE messages")
+            newest = await conn.fetchval("SELECT max(id) FROM messages WHERE chat_id = $1", chat_id)
+        print(f"seeded {total} messages in {time.perf_counter() - start:.1f}s")
+
+        for depth in DEPTHS:
+            if depth >= total:
+                continue
+
+            async def offset_page():
+                async with db.acquire() as conn:
+                    await conn.fetch(
+                        "SELECT * FROM messages WHERE chat_id = $1 ORDER BY sent_at DESC OFFSET $2 LIMIT $3",
+                        chat_id, depth, PAGE
+                    )
+
+            # Seeded ids are contiguous, so the cursor for this depth is known up front.
+            before_id = newest - depth + 1 if depth else None
+
+            async def keyset_page():
+                await db.get_last_messages(chat_id, PAGE, before_id=before_id)
+
+            print(f"depth={depth:>9} offset={await timed(offset_page):8.2f}ms "
+                  f"keyset={await timed(keyset_page):8.2f}ms")
+    finally:
+        await db.remove_group(chat_id)
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000))
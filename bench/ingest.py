@@ -0,0 +1,54 @@
+"""
+Throughput and p99 of message inserts, one INSERT per send versus the
+MessageBatcher, at 1, 100 and 1000 concurrent senders. Needs PQ_DSN.
+
+    python -m bench.ingest [sends-per-sender]
+"""
+import asyncio
+import sys
+import time
+import uuid
+
+from modules.db import AsyncChatDB
+from modules.ingest import MessageBatcher
+
+CONCURRENCY = (1, 100, 1000)
+
+
+async def run(sink, chat_id, user_id, senders, per_sender):
+    latencies = []
+
+    async def sender():
+        for _ in range(per_sender):
+            start = time.perf_counter()
+            await sink.send_message(chat_id, user_id, 'bench')
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(senders)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[int(len(latencies) * 0.99) - 1] * 1e3
+
+
+async def main(per_sender: int):
+    db = AsyncChatDB()
+    await db.connect()
+    name = f"bench-{uuid.uuid4().hex[:8]}"
+    user_id = await db.create_user(name, name, 'x')
+    chat_id = await db.create_chat(name, name, '', user_id)
+    batcher = MessageBatcher(db, window=0.002, max_batch=200)
+    try:
+        for senders in CONCURRENCY:
+            n = max(1, per_sender * 100 // senders)
+            for label, sink in (('direct', db), ('batched', batcher)):
+                rate, p99 = await run(sink, chat_id, user_id, senders, n)
+                print(f"senders={senders:>5} {label:<8} {rate:10.0f} msg/s p99={p99:8.2f}ms")
+    finally:
+        await batcher.close()
+        await db.remove_group(chat_id)
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
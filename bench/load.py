@@ -0,0 +1,235 @@
+"""
+Load suite driving the ASGI app in process: register, login, create/join,
+send, get and stream. Reports throughput and p50/p95/p99 per route. Runs
+against the in-memory storage and Redis stand-in unless CHAT_BACKEND is set,
+so it needs neither Postgres nor Redis; the same --seed gives the same workload.
+
+    python -m bench.load [--users 50] [--chats 5] [--messages 20] [--pages 5]
+                         [--streams 2] [--frames] [--concurrency 32] [--seed 1]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+os.environ.setdefault('CHAT_BACKEND', 'memory')
+
+import httpx  # noqa: E402
+
+from app import app  # noqa: E402
+from modules.wire import FRAMES_JSON, read_frames  # noqa: E402
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.elapsed: Dict[str, float] = defaultdict(float)
+
+    def add(self, route: str, seconds: float, ok: bool = True) -> None:
+        self.samples[route].append(seconds)
+        if not ok:
+            self.errors[route] += 1
+
+    def report(self) -> None:
+        print(f"{'route':<22}{'requests':>9}{'errors':>8}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for route, samples in self.samples.items():
+            samples = sorted(samples)
+            elapsed = self.elapsed.get(route)
+            rate = f"{len(samples) / elapsed:10.0f}" if elapsed else f"{'-':>10}"
+            print(f"{route:<22}{len(samples):>9}{self.errors[route]:>8}{rate}"
+                  + ''.join(f"{percentile(samples, p) * 1e3:9.2f}" for p in (50, 95, 99)))
+
+
+def percentile(samples: List[float], p: float) -> float:
+    return samples[max(math.ceil(p / 100 * len(samples)) - 1, 0)]
+
+
+async def phase(recorder: Recorder, routes, jobs, concurrency: int) -> list:
+    """
+    Runs the coroutines in jobs at most `concurrency` at a time and charges the
+    phase's wall time to each route in routes for the throughput column.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(job):
+        async with semaphore:
+            return await job
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run(job) for job in jobs))
+    for route in routes:
+        recorder.elapsed[route] += time.perf_counter() - start
+    return results
+
+
+async def call(client: httpx.AsyncClient, recorder: Recorder, route: str, method: str, url: str,
+               token: str = '', **kwargs) -> httpx.Response:
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+    start = time.perf_counter()
+    response = await client.request(method, url, headers=headers, **kwargs)
+    ok = response.status_code == 200 and '"status_code":500' not in response.text.replace(' ', '')
+    recorder.add(route, time.perf_counter() - start, ok)
+    return response
+
+
+class Stream:
+    """
+    /messages/stream driven over raw ASGI, since httpx's ASGI transport buffers
+    whole responses. Frames arrive on self.frames as (monotonic time, data).
+    With frames=True it asks for length-prefixed JSON frames instead of SSE.
+    """
+
+    def __init__(self, token: str, chat_id: int, frames: bool = False):
+        self.body = json.dumps({'chat_id': chat_id}).encode()
+        self.headers = [(b'authorization', f'Bearer {token}'.encode()),
+                        (b'content-type', b'application/json'),
+                        (b'content-length', str(len(self.body)).encode())]
+        if frames:
+            self.headers.append((b'accept', FRAMES_JSON.encode()))
+        self.length_prefixed = frames
+        self.buffer = bytearray()
+        self.started = asyncio.get_running_loop().create_future()
+        self.frames: asyncio.Queue = asyncio.Queue()
+        self._disconnect = asyncio.Event()
+        self._sent = False
+        self._task = None
+
+    async def _receive(self):
+        if not self._sent:
+            self._sent = True
+            return {'type': 'http.request', 'body': self.body, 'more_body': False}
+        await self._disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def _send(self, message):
+        if message['type'] == 'http.response.start' and not self.started.done():
+            self.started.set_result(message['status'])
+        elif message['type'] == 'http.response.body' and message.get('body'):
+            received = time.perf_counter()
+            if self.length_prefixed:
+                self.buffer += message['body']
+                for frame in read_frames(self.buffer):
+                    if frame:
+                        self.frames.put_nowait((received, json.loads(frame)['data']))
+                return
+            for frame in message['body'].split(b'\n\n'):
+                for line in frame.split(b'\n'):
+                    if line.startswith(b'data: '):
+                        self.frames.put_nowait((received, json.loads(line[6:])))
+
+    async def open(self) -> int:
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+                 'scheme': 'http', 'path': '/messages/stream', 'raw_path': b'/messages/stream',
+                 'query_string': b'', 'root_path': '', 'headers': self.headers,
+                 'client': ('127.0.0.1', 0), 'server': ('load', 80)}
+        self._task = asyncio.create_task(app(scope, self._receive, self._send))
+        return await self.started
+
+    async def close(self) -> None:
+        self._disconnect.set()
+        try:
+            await asyncio.wait_for(self._task, 5)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self._task.cancel()
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    run_id = f"{args.seed}-{time.time_ns() % 10 ** 8}"
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://load') as client:
+            usernames = [f"load-{run_id}-{i}" for i in range(args.users)]
+            await phase(recorder, ['/user/register'], [
+                call(client, recorder, '/user/register', 'POST', '/user/register',
+                     json={'name': name, 'username': name, 'password': 'secret'})
+                for name in usernames
+            ], args.concurrency)
+            logins = await phase(recorder, ['/user/login'], [
+                call(client, recorder, '/user/login', 'POST', '/user/login',
+                     json={'username': name, 'password': 'secret'})
+                for name in usernames
+            ], args.concurrency)
+            tokens = [response.json()['token'] for response in logins]
+
+            chat_names = [f"load-{run_id}-chat-{i}" for i in range(args.chats)]
+            created = await phase(recorder, ['/chat/create'], [
+                call(client, recorder, '/chat/create', 'POST', '/chat/create', tokens[i % len(tokens)],
+                     json={'groupname': name, 'grouptitle': name})
+                for i, name in enumerate(chat_names)
+            ], args.concurrency)
+            chat_ids = [response.json()['chat_id'] for response in created]
+            # Every user joins one chat chosen by the seeded generator.
+            membership = {i: chat_ids[rng.randrange(len(chat_ids))] for i in range(len(tokens))}
+            await phase(recorder, ['/dialog/join'], [
+                call(client, recorder, '/dialog/join', 'POST', '/dialog/join', tokens[i],
+                     params={'chat_id': chat_id})
+                for i, chat_id in membership.items()
+            ], args.concurrency)
+
+            streams = []
+            for chat_id in chat_ids:
+                members = [i for i, c in membership.items() if c == chat_id]
+                for i in members[:args.streams]:
+                    stream = Stream(tokens[i], chat_id, args.frames)
+                    start = time.perf_counter()
+                    status = await stream.open()
+                    recorder.add('/messages/stream open', time.perf_counter() - start, status == 200)
+                    streams.append(stream)
+
+            sent_at: Dict[str, float] = {}
+
+            async def send(i: int, n: int):
+                content = f"{usernames[i]} message {n} " + ' '.join(
+                    rng.choice(('hello', 'world', 'load', 'test', 'chat')) for _ in range(rng.randint(1, 12)))
+                sent_at[content] = time.perf_counter()
+                return await call(client, recorder, '/messages/send', 'POST', '/messages/send', tokens[i],
+                                  json={'content': content, 'chat_id': membership[i]})
+
+            sends = [(i, n) for n in range(args.messages) for i in range(len(tokens))]
+            await phase(recorder, ['/messages/send'], [send(i, n) for i, n in sends], args.concurrency)
+
+            async def get_pages(i: int):
+                cursor = ''
+                for _ in range(args.pages):
+                    response = await call(client, recorder, '/messages/get', 'POST', '/messages/get', tokens[i],
+                                          params={'chat_id': membership[i], 'limit': 40, 'cursor': cursor})
+                    cursor = response.json().get('next_cursor') or ''
+                    if not cursor:
+                        return
+
+            await phase(recorder, ['/messages/get'], [get_pages(i) for i in range(len(tokens))], args.concurrency)
+            await phase(recorder, ['/dialog/get'], [
+                call(client, recorder, '/dialog/get', 'POST', '/dialog/get', token) for token in tokens
+            ], args.concurrency)
+
+            # Give the fan-out a moment, then charge each delivered frame its send-to-delivery time.
+            await asyncio.sleep(0.2)
+            for stream in streams:
+                while not stream.frames.empty():
+                    received, event = stream.frames.get_nowait()
+                    message = event.get('message') or {}
+                    if message.get('content') in sent_at:
+                        recorder.add('/messages/stream event', received - sent_at[message['content']])
+                await stream.close()
+    recorder.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--chats', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=20, help='messages sent per user')
+    parser.add_argument('--pages', type=int, default=5, help='history pages read per user')
+    parser.add_argument('--streams', type=int, default=2, help='open streams per chat')
+    parser.add_argument('--frames', action='store_true', help='stream length-prefixed frames instead of SSE')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,116 @@
+"""
+Insert and history-read latency as messages grows across partitions, then
+the same pages read back from an archive segment. Each step seeds rows into
+the next partition, so later steps run against more partitions and more rows.
+Needs PQ_DSN and the migrations applied (python -m modules.migrate).
+
+    python -m bench.partitions [steps] [rows per step]
+"""
+import asyncio
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+from modules.archive import Archive, write_segment
+from modules.db import AsyncChatDB
+from modules.partitions import PartitionMaintainer, next_bound
+
+PAGE = 40
+RUNS = 200
+
+
+async def timed(fn, runs=RUNS):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return statistics.median(samples) * 1e3, samples[int(len(samples) * 0.99) - 1] * 1e3
+
+
+async def main(steps: int, per_step: int):
+    db = AsyncChatDB()
+    await db.connect()
+    name = f"bench-{uuid.uuid4().hex[:8]}"
+    user_id = await db.create_user(name, name, 'x')
+    chat_id = await db.create_chat(name, name, '', user_id)
+    # Another chat takes most rows, so the bench chat's pages come from a growing table.
+    noise_id = await db.create_chat(name + '-noise', name, '', user_id)
+    try:
+        maintainer = PartitionMaintainer(db, ahead=steps + 1)
+        async with db.acquire() as conn:
+            await maintainer.ensure_partitions(conn)
+            bound = next_bound(await conn.fetchval("SELECT LOCALTIMESTAMP"), maintainer.interval)
+        print(f"{'step':>4}{'rows':>12}{'partitions':>11}{'insert p50':>12}{'p99':>8}"
+              f"{'newest p50':>12}{'oldest p50':>12}")
+        for step in range(steps):
+            # Each step's rows land in the partition after the previous step's.
+            starts = bound
+            bound = next_bound(bound, maintainer.interval)
+            async with db.acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO messages(chat_id, sender_id, content, sent_at)
+                    SELECT CASE WHEN g % 10 = 0 THEN $1 ELSE $2 END, $3, 'message ' || g,
+                           $5::timestamp + g * ($6::timestamp - $5::timestamp) / ($4::int + 1)
+                    FROM generate_series(1, $4) g
+                    """,
+                    chat_id, noise_id, user_id, per_step, starts, bound - datetime.timedelta(seconds=1)
+                )
+                await conn.execute("ANALYZE messages")
+                total = await conn.fetchval("SELECT count(*) FROM messages")
+                partitions = await conn.fetchval("SELECT count(*) FROM message_partitions WHERE dropped_at IS NULL")
+                newest, oldest = await conn.fetchrow(
+                    "SELECT max(id), min(id) FROM messages WHERE chat_id = $1", chat_id
+                )
+
+            async def insert():
+                await db.send_message(chat_id, user_id, 'bench')
+
+            async def newest_page():
+                # A cursor past the newest id skips the recent-message ring.
+                await db.get_last_messages(chat_id, PAGE, before_id=newest + 1)
+
+            async def oldest_page():
+                await db.get_last_messages(chat_id, PAGE, before_id=oldest + PAGE)
+
+            insert_p50, insert_p99 = await timed(insert)
+            newest_p50, _ = await timed(newest_page)
+            oldest_p50, _ = await timed(oldest_page)
+            print(f"{step:>4}{total:>12}{partitions:>11}{insert_p50:>10.2f}ms{insert_p99:>6.2f}ms"
+                  f"{newest_p50:>10.2f}ms{oldest_p50:>10.2f}ms")
+
+        # Archive reads: the bench chat written to a segment, paged cold and warm.
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.seg')
+            async with db.acquire() as conn:
+                rows = await conn.fetch("SELECT * FROM messages WHERE chat_id = $1 ORDER BY id", chat_id)
+            start = time.perf_counter()
+            await asyncio.to_thread(write_segment, path, rows)
+            print(f"segment: {len(rows)} rows, {os.path.getsize(path) / 1e6:.1f}MB "
+                  f"in {time.perf_counter() - start:.2f}s")
+            archive = Archive()
+            await archive.sync({'bench': path})
+            middle = rows[len(rows) // 2]['id']
+
+            async def archive_page():
+                await archive.before(chat_id, middle, PAGE)
+
+            archive.blocks.clear()
+            cold, _ = await timed(archive_page, runs=1)
+            warm, warm_p99 = await timed(archive_page)
+            print(f"archive page: cold {cold:.2f}ms, warm p50 {warm:.3f}ms p99 {warm_p99:.3f}ms")
+    finally:
+        await db.remove_group(chat_id)
+        await db.remove_group(noise_id)
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 6,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 500_000))
@@ -0,0 +1,92 @@
+"""
+Full-text search latency on a seeded dataset: rare and common terms, scoped
+to one chat and across every joined chat, first page and a deep keyset page.
+Needs PQ_DSN and the migrations applied.
+
+    python -m bench.search [messages] [chats]
+"""
+import asyncio
+import statistics
+import sys
+import time
+import uuid
+
+from modules.db import AsyncChatDB, SEARCH_CONFIG
+
+PAGE = 20
+RUNS = 20
+# Word i shows up in roughly 1 / 2**i of the seeded messages.
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel',
+         'india', 'juliet', 'kilo', 'lima', 'mike', 'november', 'oscar', 'papa']
+QUERIES = ('alpha', 'delta', 'papa', 'bravo charlie', '"echo foxtrot"', 'alpha -bravo')
+
+
+async def timed(fn, runs=RUNS):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e3
+
+
+async def main(total: int, chat_count: int):
+    db = AsyncChatDB()
+    await db.connect()
+    name = f"bench-{uuid.uuid4().hex[:8]}"
+    user_id = await db.create_user(name, name, 'x')
+    chat_ids = []
+    try:
+        for i in range(chat_count):
+            chat_id = await db.create_chat(f"{name}-{i}", name, '', user_id)
+            await db.join_chat(user_id, chat_id)
+            chat_ids.append(chat_id)
+        start = time.perf_counter()
+        async with db.acquire() as conn:
+            await conn.execute(
+                f"""
+                WITH m AS (
+                    INSERT INTO messages(chat_id, sender_id, content)
+                    -- Referencing g keeps the word subquery correlated, so random() is drawn per row.
+                    SELECT ($1::bigint[])[1 + g % array_length($1::bigint[], 1)], $2,
+                           array_to_string(ARRAY(
+                               SELECT w FROM unnest($4::text[]) WITH ORDINALITY AS t(w, i)
+                               WHERE random() < 1.0 / (1 << (i - 1)::int) OR g < 0
+                           ), ' ') || ' message ' || g
+                    FROM generate_series(1, $3) g
+                    RETURNING id, chat_id, content
+                )
+                INSERT INTO message_search(message_id, chat_id, document)
+                SELECT id, chat_id, to_tsvector('{SEARCH_CONFIG}', content) FROM m
+                """,
+                chat_ids, user_id, total, WORDS
+            )
+            await conn.execute("ANALYZE messages")
+            await conn.execute("ANALYZE message_search")
+        print(f"seeded {total} messages in {chat_count} chats in {time.perf_counter() - start:.1f}s")
+
+        for query in QUERIES:
+            for scope, chat_id in (('chat', chat_ids[0]), ('all', None)):
+                first = await db.search_messages(query, chat_id, user_id, PAGE)
+
+                async def first_page():
+                    await db.search_messages(query, chat_id, user_id, PAGE)
+
+                line = f"{query!r:<18} scope={scope:<4} first={await timed(first_page):8.2f}ms"
+                if len(first) == PAGE:
+                    after = (first[-1]['rank'], first[-1]['id'])
+
+                    async def next_page():
+                        await db.search_messages(query, chat_id, user_id, PAGE, after)
+
+                    line += f" next={await timed(next_page):8.2f}ms"
+                print(line)
+    finally:
+        for chat_id in chat_ids:
+            await db.remove_group(chat_id)
+        await db.close()
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    asyncio.run(main(*(args + [10_000_000, 1000][len(args):])))
@@ -0,0 +1,79 @@
+"""
+Compares the /messages/send hot path with per-request password login versus
+session-token resolution. Needs PQ_DSN and a running Redis.
+
+    python -m bench.send_auth [iterations]
+"""
+import asyncio
+import hashlib
+import statistics
+import sys
+import time
+import uuid
+
+from modules.db import AsyncChatDB
+from modules.session import sessions
+
+
+class CountingPool:
+    """
+    Wraps an asyncpg pool and counts acquires (one per AsyncChatDB query).
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.acquires = 0
+
+    def acquire(self, *args, **kwargs):
+        self.acquires += 1
+        return self._pool.acquire(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+def report(name, samples, queries, n):
+    samples.sort()
+    print(f"{name:<14} p50={statistics.median(samples) * 1e3:.3f}ms "
+          f"p99={samples[int(len(samples) * 0.99) - 1] * 1e3:.3f}ms "
+          f"queries/send={queries / n:.2f}")
+
+
+async def main(n: int):
+    db = AsyncChatDB()
+    await db.connect()
+    pool = CountingPool(db.pool)
+    db.pool = pool
+
+    username, password = f"bench-{uuid.uuid4().hex[:8]}", "bench"
+    password_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
+    user_id = await db.create_user(username, username, password_hash)
+    chat_id = await db.create_chat(username, username, '', user_id)
+    await db.join_chat(user_id, chat_id)
+    token = await sessions.create(user_id)
+
+    async def login_path():
+        uid = await db.login(username, hashlib.sha256(password.encode('utf-8')).hexdigest())
+        await db.send_message(chat_id, uid, 'x')
+
+    async def session_path():
+        uid = await sessions.resolve(token)
+        await db.send_message(chat_id, uid, 'x')
+
+    try:
+        for name, path in (('password', login_path), ('session', session_path)):
+            samples = []
+            pool.acquires = 0
+            for _ in range(n):
+                start = time.perf_counter()
+                await path()
+                samples.append(time.perf_counter() - start)
+            report(name, samples, pool.acquires, n)
+    finally:
+        await sessions.revoke(token)
+        await db.remove_group(chat_id)
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
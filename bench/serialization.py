@@ -0,0 +1,118 @@
+"""
+Response serialization for /messages/get and /dialog/get payloads: FastAPI's
+jsonable_encoder + JSONResponse versus ORJSONResponse, at 40, 400 and 4000
+rows. Rows are real asyncpg Records built with generate_series, so only PQ_DSN
+is needed, no seeded tables. Without PQ_DSN the same rows are built in process
+as Records through asyncpg's internal _create_record, when this asyncpg still
+has it. Pages are timed the way routes get them, as the dicts AsyncChatDB
+converts each fetch to, and as raw Records (the fallback copy in
+modules.responses); the conversion itself is timed against dict(record).
+
+    python -m bench.serialization
+"""
+import asyncio
+import datetime
+import os
+import statistics
+import time
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from modules.db import AsyncChatDB, _as_dicts
+from modules.responses import ORJSONResponse
+
+SIZES = (40, 400, 4000)
+RUNS = 50
+
+MESSAGES = """
+    SELECT g::bigint AS id, 1::bigint AS chat_id, (g % 50)::bigint AS sender_id,
+           'message number ' || g || ' with a bit of text in it' AS content,
+           NULLIF(g % 7, 0)::bigint AS reply_to, g % 20 = 0 AS is_media,
+           now() - make_interval(secs => g) AS sent_at, NULL::timestamp AS edited_at,
+           g::bigint AS change_seq
+    FROM generate_series(1, $1) g
+"""
+
+DIALOGS = """
+    SELECT g::bigint AS id, 'chat' || g AS chatname, 'Chat ' || g AS chat_title, '' AS chat_about,
+           1::bigint AS owner, now() - make_interval(secs => g) AS last_activity_at,
+           (g % 13)::bigint AS unread_count, g * 100::bigint AS last_read_id,
+           g * 100 + 13::bigint AS last_message_id, (g % 50)::bigint AS last_message_sender_id,
+           'last message in chat ' || g AS last_message_content, false AS last_message_is_media,
+           now() - make_interval(secs => g) AS last_message_sent_at
+    FROM generate_series(1, $1) g
+"""
+
+
+def timed(fn, runs=RUNS):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e3
+
+
+def compare(label, content):
+    generic = timed(lambda: JSONResponse(jsonable_encoder(content)).body)
+    fast = timed(lambda: ORJSONResponse(content).body)
+    print(f"{label:<22} jsonable_encoder={generic:8.3f}ms orjson={fast:8.3f}ms x{generic / fast:5.1f}")
+
+
+def report(size, messages, dialogs):
+    compare(f"messages/get {size}", {'status_code': 200, 'messages': _as_dicts(messages), 'next_cursor': None})
+    compare(f"messages/get raw {size}", {'status_code': 200, 'messages': messages, 'next_cursor': None})
+    compare(f"dialog/get {size}", {'status_code': 200, 'chats': _as_dicts(dialogs)})
+    converted = timed(lambda: _as_dicts(messages))
+    copied = timed(lambda: [dict(row) for row in messages])
+    print(f"{'convert ' + str(size):<22} _as_dicts={converted:8.3f}ms dict(record)={copied:8.3f}ms")
+
+
+def offline_rows(size):
+    """
+    The rows MESSAGES and DIALOGS select, built without a server; None when
+    this asyncpg has no _create_record.
+    """
+    try:
+        from asyncpg.protocol.protocol import _create_record
+    except ImportError:
+        return None
+
+    def records(rows):
+        mapping = {key: i for i, key in enumerate(rows[0])}
+        return [_create_record(mapping, tuple(row.values())) for row in rows]
+
+    now = datetime.datetime.now()
+    messages = [{'id': g, 'chat_id': 1, 'sender_id': g % 50, 'content': f'message number {g} with a bit of text in it',
+                 'reply_to': g % 7 or None, 'is_media': g % 20 == 0, 'sent_at': now - datetime.timedelta(seconds=g),
+                 'edited_at': None, 'change_seq': g} for g in range(1, size + 1)]
+    dialogs = [{'id': g, 'chatname': f'chat{g}', 'chat_title': f'Chat {g}', 'chat_about': '', 'owner': 1,
+                'last_activity_at': now - datetime.timedelta(seconds=g), 'unread_count': g % 13,
+                'last_read_id': g * 100, 'last_message_id': g * 100 + 13, 'last_message_sender_id': g % 50,
+                'last_message_content': f'last message in chat {g}', 'last_message_is_media': False,
+                'last_message_sent_at': now - datetime.timedelta(seconds=g)} for g in range(1, size + 1)]
+    return records(messages), records(dialogs)
+
+
+async def main():
+    if not os.getenv('PQ_DSN'):
+        for size in SIZES:
+            rows = offline_rows(size)
+            if rows is None:
+                print("This asyncpg cannot build Records without a server; set PQ_DSN.")
+                return
+            report(size, *rows)
+        return
+    db = AsyncChatDB(min_size=1, max_size=1)
+    await db.connect()
+    try:
+        async with db.acquire() as conn:
+            for size in SIZES:
+                report(size, await conn.fetch(MESSAGES, size), await conn.fetch(DIALOGS, size))
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+"""
+Catching up a user in 200 chats: one /sync query versus polling each chat's
+newest page. Needs PQ_DSN and the migrations applied.
+
+    python -m bench.sync [chats] [new-messages-per-chat]
+"""
+import asyncio
+import statistics
+import sys
+import time
+import uuid
+
+from modules.db import AsyncChatDB
+
+RUNS = 20
+
+
+async def main(chat_count: int, per_chat: int):
+    db = AsyncChatDB()
+    await db.connect()
+    name = f"bench-{uuid.uuid4().hex[:8]}"
+    user_id = await db.create_user(name, name, 'x')
+    chat_ids = []
+    try:
+        for i in range(chat_count):
+            chat_id = await db.create_chat(f"{name}-{i}", name, '', user_id)
+            await db.join_chat(user_id, chat_id)
+            chat_ids.append(chat_id)
+        last_seen = {}
+        for chat_id in chat_ids:
+            last_seen[chat_id] = await db.send_message(chat_id, user_id, 'seen')
+        for _ in range(per_chat):
+            await db.send_messages([(chat_id, user_id, 'new', None, False) for chat_id in chat_ids])
+
+        async def poll():
+            for chat_id in chat_ids:
+                await db.get_last_messages(chat_id, 40, after_id=last_seen[chat_id])
+
+        async def sync():
+            await db.get_changes(user_id, last_seen=last_seen, count=chat_count * per_chat, settle=0)
+
+        for label, fn in (('per-chat poll', poll), ('sync', sync)):
+            samples = []
+            for _ in range(RUNS):
+                start = time.perf_counter()
+                await fn()
+                samples.append(time.perf_counter() - start)
+            queries = chat_count if fn is poll else 2
+            print(f"{label:<14} median={statistics.median(samples) * 1e3:8.2f}ms queries={queries}")
+    finally:
+        for chat_id in chat_ids:
+            await db.remove_group(chat_id)
+        await db.close()
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    asyncio.run(main(*(args + [200, 5][len(args):])))
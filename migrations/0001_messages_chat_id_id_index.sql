@@ -0,0 +1,3 @@
+-- Keyset pagination of chat history walks (chat_id, id) in both directions.
+-- CONCURRENTLY cannot run inside a transaction, so keep one statement per file.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_chat_id_id_idx ON messages (chat_id, id);
@@ -0,0 +1,2 @@
+-- Membership listing and warming of the Redis member sets scan dialogs by chat.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS dialogs_chat_id_user_id_idx ON dialogs (chat_id, user_id);
@@ -0,0 +1,20 @@
+-- Per-chat activity summary and per-member read markers for the dialog list.
+-- Unread count = chat_activity.message_count - dialogs.read_count, where read_count
+-- counts the chat's messages with id <= dialogs.last_read_id.
+CREATE TABLE IF NOT EXISTS chat_activity (
+    chat_id BIGINT PRIMARY KEY REFERENCES chats(id) ON DELETE CASCADE,
+    last_message_id BIGINT,
+    last_activity_at TIMESTAMP,
+    message_count BIGINT NOT NULL DEFAULT 0
+);
+
+ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS last_read_id BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS read_count BIGINT NOT NULL DEFAULT 0;
+
+INSERT INTO chat_activity(chat_id, last_message_id, last_activity_at, message_count)
+SELECT chat_id, max(id), max(sent_at), count(*) FROM messages GROUP BY chat_id
+ON CONFLICT (chat_id) DO NOTHING;
+
+-- Existing members start with everything read.
+UPDATE dialogs SET last_read_id = a.last_message_id, read_count = a.message_count
+FROM chat_activity a WHERE a.chat_id = dialogs.chat_id;
@@ -0,0 +1,17 @@
+-- Global change sequence for delta sync: bumped on insert and edit, and
+-- recorded in message_deletions when a message is deleted.
+CREATE SEQUENCE IF NOT EXISTS message_change_seq;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS change_seq BIGINT;
+UPDATE messages SET change_seq = nextval('message_change_seq') WHERE change_seq IS NULL;
+ALTER TABLE messages ALTER COLUMN change_seq SET DEFAULT nextval('message_change_seq');
+ALTER TABLE messages ALTER COLUMN change_seq SET NOT NULL;
+CREATE INDEX IF NOT EXISTS messages_chat_id_change_seq_idx ON messages (chat_id, change_seq);
+
+CREATE TABLE IF NOT EXISTS message_deletions (
+    message_id BIGINT PRIMARY KEY,
+    chat_id BIGINT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    change_seq BIGINT NOT NULL DEFAULT nextval('message_change_seq'),
+    deleted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS message_deletions_chat_id_change_seq_idx ON message_deletions (chat_id, change_seq);
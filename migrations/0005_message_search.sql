@@ -0,0 +1,18 @@
+-- Full-text search documents for text messages, kept in step by the insert,
+-- edit and delete statements in modules/db.py. A side table rather than a
+-- column so SELECT * on messages does not carry the tsvector around.
+-- btree_gin lets one GIN index serve both chat-scoped and cross-chat searches.
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+CREATE TABLE IF NOT EXISTS message_search (
+    message_id BIGINT PRIMARY KEY,
+    chat_id BIGINT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    document TSVECTOR NOT NULL
+);
+
+INSERT INTO message_search(message_id, chat_id, document)
+SELECT id, chat_id, to_tsvector('simple', content) FROM messages WHERE NOT is_media
+ON CONFLICT (message_id) DO NOTHING;
+
+CREATE INDEX IF NOT EXISTS message_search_chat_id_document_idx ON message_search USING gin (chat_id, document);
+ANALYZE message_search;
@@ -0,0 +1,67 @@
+-- Range-partitions messages by sent_at so old months can be archived to segment
+-- files and dropped (modules/partitions.py) instead of bloating one table and
+-- its indexes forever. The existing table is attached as the first partition,
+-- covering everything sent before now, so no rows are copied.
+-- A partitioned table's unique keys must include the partition key, so each
+-- partition keeps its own primary key on id (ids stay unique through their
+-- sequence) and foreign keys referencing messages(id) are dropped.
+-- Assumes messages.id is a serial column.
+CREATE TABLE IF NOT EXISTS message_partitions (
+    name TEXT PRIMARY KEY,
+    starts TIMESTAMP,
+    ends TIMESTAMP NOT NULL,
+    segment TEXT,
+    archived_rows BIGINT,
+    archived_change_seq BIGINT,
+    archived_at TIMESTAMP,
+    dropped_at TIMESTAMP
+);
+
+DO $$
+DECLARE
+    fk RECORD;
+    id_seq TEXT;
+    cutoff TIMESTAMP;
+    next_month TIMESTAMP;
+    first_name TEXT;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass) THEN
+        RETURN;
+    END IF;
+
+    FOR fk IN SELECT conrelid::regclass AS tbl, conname FROM pg_constraint
+              WHERE contype = 'f' AND confrelid = 'messages'::regclass LOOP
+        EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', fk.tbl, fk.conname);
+    END LOOP;
+
+    UPDATE messages SET sent_at = 'epoch' WHERE sent_at IS NULL;
+    ALTER TABLE messages ALTER COLUMN sent_at SET NOT NULL;
+    ALTER TABLE messages RENAME TO messages_legacy;
+
+    CREATE TABLE messages (LIKE messages_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+        PARTITION BY RANGE (sent_at);
+    FOR fk IN SELECT conname, pg_get_constraintdef(oid) AS def FROM pg_constraint
+              WHERE contype = 'f' AND conrelid = 'messages_legacy'::regclass LOOP
+        EXECUTE format('ALTER TABLE messages ADD CONSTRAINT %I %s', fk.conname, fk.def);
+    END LOOP;
+    -- Same definitions as the legacy indexes, which ATTACH adopts instead of rebuilding.
+    CREATE INDEX messages_part_chat_id_id_idx ON messages (chat_id, id);
+    CREATE INDEX messages_part_chat_id_change_seq_idx ON messages (chat_id, change_seq);
+
+    -- The sequence must outlive the legacy partition, which is archived and dropped some day.
+    id_seq := pg_get_serial_sequence('messages_legacy', 'id');
+    IF id_seq IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY messages.id', id_seq);
+    END IF;
+
+    cutoff := GREATEST(LOCALTIMESTAMP, (SELECT max(sent_at) FROM messages_legacy) + interval '1 microsecond');
+    next_month := date_trunc('month', cutoff) + interval '1 month';
+    first_name := 'messages_p' || to_char(cutoff, 'YYYYMMDD');
+    EXECUTE format('ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (%L)', cutoff);
+    EXECUTE format('CREATE TABLE %I PARTITION OF messages (PRIMARY KEY (id)) FOR VALUES FROM (%L) TO (%L)',
+                   first_name, cutoff, next_month);
+    INSERT INTO message_partitions(name, starts, ends)
+    VALUES ('messages_legacy', NULL, cutoff), (first_name, cutoff, next_month);
+END $$;
+
+ANALYZE messages;
@@ -0,0 +1,21 @@
+-- Durable queue for the media pipeline (modules/media_pipeline.py) and the
+-- metadata it produces. One job per stored file; identical uploads share the
+-- file and so the job. Claimed jobs are leased by pushing run_after forward,
+-- so a job whose worker died is picked up again once the lease runs out.
+CREATE TABLE IF NOT EXISTS media_jobs (
+    filename TEXT PRIMARY KEY,
+    size BIGINT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',  -- queued, done or failed
+    attempts INT NOT NULL DEFAULT 0,
+    run_after TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,
+    error TEXT,
+    meta JSONB,
+    created_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,
+    finished_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS media_jobs_queued_idx ON media_jobs (run_after) WHERE state = 'queued';
+
+-- The processed metadata of an is_media message's file, NULL until its job is done.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS media JSONB;
+-- Only media messages still waiting for their job, looked up by their content (the file's URL).
+CREATE INDEX IF NOT EXISTS messages_media_pending_idx ON messages (content) WHERE is_media AND media IS NULL;
@@ -1,18 +1,42 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Optional
+import datetime
 
 class CreateChat(BaseModel):
-    username: str
-    password: str
-    groupname: str
     groupname: str
     grouptitle: str
 
 class DeleteChat(BaseModel):
-    username: str
-    password: str
     groupname: str
 
 class JoinChat(BaseModel):
-    username: str
-    password: str
-    groupname: str
\ No newline at end of file
+    groupname: str
+
+class SetRules(BaseModel):
+    chat_id: int
+    user_ids: List[int] = Field(min_length=1, max_length=10000)
+    can_ban_user: bool = False
+    can_remove_message: bool = False
+    can_send_message: bool = True
+    can_send_media: bool = True
+
+class Dialog(BaseModel):
+    # Every chats column plus the dialog summary below.
+    model_config = ConfigDict(extra='allow')
+
+    id: int
+    chatname: str
+    chat_title: str
+    owner: int
+    last_activity_at: Optional[datetime.datetime] = None
+    unread_count: int
+    last_read_id: Optional[int] = None
+    last_message_id: Optional[int] = None
+    last_message_sender_id: Optional[int] = None
+    last_message_content: Optional[str] = None
+    last_message_is_media: Optional[bool] = None
+    last_message_sent_at: Optional[datetime.datetime] = None
+
+class DialogList(BaseModel):
+    status_code: int = 200
+    chats: List[Dialog]
@@ -1,9 +1,9 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import Dict, List, Optional
+from models.users import UserProfile
+import datetime
 
 class MessageInput(BaseModel):
-    username: str
-    password: str
     content: str
     chat_id: Optional[int] = 0
     chat_name: Optional[str] = ''
@@ -11,7 +11,75 @@ class MessageInput(BaseModel):
     is_media: Optional[bool] = False
 
 class StreamRequest(BaseModel):
-    username: str
-    password: str
     chat_id: int = 0
-    chat_name: str = ''
\ No newline at end of file
+    chat_name: str = ''
+    last_event_id: str = ''
+
+class EditMessage(BaseModel):
+    message_id: int
+    content: str
+
+class DeleteMessage(BaseModel):
+    message_id: int
+    chat_id: int
+
+class SyncRequest(BaseModel):
+    since: int = 0
+    chats: Dict[int, int] = {}
+    limit: int = 500
+
+
+class MediaMeta(BaseModel):
+    mime: str
+    size: int
+    sha256: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    # JPEG URLs under /media/, for images Pillow can decode.
+    thumb: Optional[str] = None
+    thumb_size: Optional[List[int]] = None
+    preview: Optional[str] = None
+    preview_size: Optional[List[int]] = None
+
+
+class Message(BaseModel):
+    id: int
+    chat_id: int
+    sender_id: int
+    content: str
+    reply_to: Optional[int] = None
+    is_media: bool = False
+    sent_at: datetime.datetime
+    edited_at: Optional[datetime.datetime] = None
+    change_seq: int
+    # is_media messages only, once their file has been processed.
+    media: Optional[MediaMeta] = None
+
+class MessagesPage(BaseModel):
+    status_code: int = 200
+    messages: List[Message]
+    next_cursor: Optional[str] = None
+    # Only with include=senders: each distinct sender on the page, once.
+    senders: Optional[List[UserProfile]] = None
+
+class SearchHit(Message):
+    rank: float
+
+class SearchPage(BaseModel):
+    status_code: int = 200
+    messages: List[SearchHit]
+    next_cursor: Optional[str] = None
+
+class Deletion(BaseModel):
+    message_id: int
+    chat_id: int
+    change_seq: int
+
+class SyncPage(BaseModel):
+    status_code: int = 200
+    messages: List[Message]
+    deleted: List[Deletion]
+    next_seq: Optional[int] = None
+    # Only for a `chats` map request: the new last seen message id of each chat that moved.
+    next_chats: Optional[Dict[int, int]] = None
+    has_more: bool
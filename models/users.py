@@ -1,4 +1,5 @@
 from pydantic import BaseModel
+from typing import Optional
 import hashlib
 
 
@@ -14,3 +15,11 @@ class UserLogin(BaseModel):
     @property
     def password_hash(self):
         return hashlib.sha256(self.password.encode('utf-8')).hexdigest()
+
+class UserProfile(BaseModel):
+    id: int
+    username: str
+    name: str
+    profile: Optional[str] = None
+    bio: Optional[str] = None
+    status: Optional[str] = None
@@ -0,0 +1,259 @@
+"""
+Admission control: per-user, per-route token buckets, a per-user cap on open
+streams, and load shedding when the connection pool backs up.
+
+Buckets live in Redis so limits hold across workers, but each worker leases
+tokens a few at a time and spends them locally, so most requests never touch
+Redis. A worker can run up to RATE_LIMIT_LEASE tokens ahead of the shared
+bucket.
+
+RATE_LIMITS is "route=rate:burst,..." with rate in requests per second, e.g.
+"/messages/send=5:20". Routes not listed are not limited.
+"""
+import math
+import os
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+import redis.asyncio as redis
+from fastapi import Depends, HTTPException, Request
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from modules.lru import MISSING, TTLCache
+from modules.metrics import Counter
+from modules.session import require_user
+
+
+RATE_LIMITS = os.getenv(
+    'RATE_LIMITS',
+    '/messages/send=5:20,/messages/upload-media=1:5,/messages/edit=2:10,/messages/delete=2:10,'
+    '/messages/get=20:60,/messages/search=2:10,/messages/stream=1:10,/sync=2:10,/dialog/get=5:20',
+)
+RATE_LIMIT_LEASE = int(os.getenv('RATE_LIMIT_LEASE', 5))
+RATE_LIMIT_CACHE_SIZE = int(os.getenv('RATE_LIMIT_CACHE_SIZE', 100000))
+STREAMS_PER_USER = int(os.getenv('STREAMS_PER_USER', 5))
+# An open stream refreshes its slot this often; slots not refreshed for 3x this are reclaimed.
+STREAM_SLOT_REFRESH = float(os.getenv('STREAM_SLOT_REFRESH', 15))
+# Shed requests with 503 once a connection has been awaited this long; 0 disables shedding.
+SHED_POOL_WAIT_MS = float(os.getenv('SHED_POOL_WAIT_MS', 500))
+# Paths that are never shed, so the service stays observable under load.
+SHED_EXEMPT = ('/metrics', '/status')
+
+RATE_LIMITED = Counter('chat_rate_limited_total', 'Requests refused with 429.', ['route'])
+REQUESTS_SHED = Counter('chat_requests_shed_total', 'Requests refused with 503 on pool backlog.')
+
+# Refills KEYS[1] to now from Redis' clock, then grants up to ARGV[3] whole
+# tokens. Returns {granted, milliseconds until the next token}.
+_TAKE = """
+local rate, burst, want = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = clock[1] * 1000 + math.floor(clock[2] / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate / 1000)
+local granted = math.min(want, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+local wait = 0
+if tokens < 1 then wait = math.ceil((1 - tokens) * 1000 / rate) end
+return {granted, wait}
+"""
+
+# Drops stale slots from the KEYS[1] sorted set, then claims ARGV[3] if fewer
+# than ARGV[4] remain. ARGV[1] is now and ARGV[2] the slot lifetime, in ms.
+_OPEN_STREAM = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[3])
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[float, int]]:
+    limits = {}
+    for item in filter(None, (item.strip() for item in spec.split(','))):
+        route, _, rule = item.partition('=')
+        rate, _, burst = rule.partition(':')
+        limits[route.strip()] = (float(rate), int(burst or max(float(rate), 1)))
+    return limits
+
+
+class RateLimiter:
+    def __init__(self, r: redis.Redis, limits: Optional[Dict[str, Tuple[float, int]]] = None,
+                 lease: int = RATE_LIMIT_LEASE, cache_size: int = RATE_LIMIT_CACHE_SIZE):
+        self.r = r
+        self.limits = parse_limits(RATE_LIMITS) if limits is None else limits
+        self.lease = lease
+        # (route, user_id) -> [leased tokens, monotonic time before which Redis has none]
+        self.local = TTLCache(cache_size, 60)
+        self._take = r.register_script(_TAKE)
+        self.allowed = 0
+        self.limited = 0
+        self.redis_calls = 0
+        self.redis_errors = 0
+
+    @staticmethod
+    def _key(route: str, user_id: int) -> str:
+        return f'ratelimit:{route}:{user_id}'
+
+    async def check(self, route: str, user_id: int) -> None:
+        """
+        Spends one token; raises 429 with Retry-After when the bucket is empty.
+        """
+        limit = self.limits.get(route)
+        if limit is None:
+            return
+        entry = self.local.get((route, user_id))
+        if entry is MISSING:
+            entry = [0, 0.0]
+            self.local.set((route, user_id), entry)
+        if entry[0] <= 0:
+            now = time.monotonic()
+            if now < entry[1]:
+                self._deny(route, entry[1] - now)
+            rate, burst = limit
+            try:
+                self.redis_calls += 1
+                granted, wait_ms = await self._take(keys=[self._key(route, user_id)],
+                                                    args=[rate, burst, min(self.lease, burst)])
+            except Exception as e:
+                # Fail open: a Redis outage must not take every limited route down with it.
+                self.redis_errors += 1
+                print("Rate limiter lost Redis:", e)
+                return
+            entry[0] += int(granted)
+            if entry[0] <= 0:
+                entry[1] = now + int(wait_ms) / 1000
+                self._deny(route, int(wait_ms) / 1000)
+        entry[0] -= 1
+        self.allowed += 1
+
+    def _deny(self, route: str, wait: float) -> None:
+        self.limited += 1
+        RATE_LIMITED.inc(route)
+        raise HTTPException(429, 'Too many requests.', headers={'Retry-After': str(max(1, math.ceil(wait)))})
+
+    def stats(self) -> dict:
+        return {'allowed': self.allowed, 'limited': self.limited, 'redis_calls': self.redis_calls,
+                'redis_errors': self.redis_errors, 'routes': len(self.limits)}
+
+
+def rate_limited(route: str):
+    """
+    Dependency that resolves the session like require_user and then spends
+    one of that user's tokens for `route`.
+    """
+    async def dependency(request: Request, user_id: int = Depends(require_user)) -> int:
+        await request.app.state.limiter.check(route, user_id)
+        return user_id
+    return dependency
+
+
+class StreamSlot:
+    def __init__(self, slots: "StreamSlots", user_id: int, slot_id: str):
+        self.slots = slots
+        self.user_id = user_id
+        self.slot_id = slot_id
+        self.refreshed = time.monotonic()
+
+    async def refresh_if_due(self) -> None:
+        if time.monotonic() - self.refreshed < self.slots.refresh:
+            return
+        self.refreshed = time.monotonic()
+        key = self.slots._key(self.user_id)
+        try:
+            # Renew the key's expiry too, or it lapses under a stream that is still open.
+            async with self.slots.r.pipeline(transaction=False) as pipe:
+                pipe.zadd(key, {self.slot_id: int(time.time() * 1000)})
+                pipe.pexpire(key, self.slots.lifetime_ms)
+                await pipe.execute()
+        except Exception as e:
+            print("Stream slot refresh failed:", e)
+
+    async def release(self) -> None:
+        try:
+            await self.slots.r.zrem(self.slots._key(self.user_id), self.slot_id)
+        except Exception as e:
+            print("Stream slot release failed:", e)
+        self.slots.open -= 1
+
+
+class StreamSlots:
+    """
+    Per-user cap on concurrently open streams across workers: one sorted-set
+    member per stream, scored by its last refresh. Slots of crashed workers
+    age out after three missed refreshes. Uses wall-clock time from the
+    workers, so clock skew only shifts when stale slots are reclaimed.
+    """
+
+    def __init__(self, r: redis.Redis, per_user: int = STREAMS_PER_USER, refresh: float = STREAM_SLOT_REFRESH):
+        self.r = r
+        self.per_user = per_user
+        self.refresh = refresh
+        # Slots not refreshed for this long belong to streams that are gone.
+        self.lifetime_ms = int(refresh * 3000)
+        self._open = r.register_script(_OPEN_STREAM)
+        self.open = 0
+        self.rejected = 0
+
+    @staticmethod
+    def _key(user_id: int) -> str:
+        return f'streams:{user_id}'
+
+    async def acquire(self, user_id: int) -> Optional[StreamSlot]:
+        """
+        A slot to release when the stream ends, or None when the user is at the cap.
+        """
+        slot_id = uuid.uuid4().hex
+        try:
+            claimed = await self._open(keys=[self._key(user_id)],
+                                       args=[int(time.time() * 1000), self.lifetime_ms, slot_id,
+                                             self.per_user])
+        except Exception as e:
+            print("Stream slots lost Redis:", e)
+            claimed = 1
+        if not claimed:
+            self.rejected += 1
+            RATE_LIMITED.inc('/messages/stream')
+            return None
+        self.open += 1
+        return StreamSlot(self, user_id, slot_id)
+
+    def stats(self) -> dict:
+        return {'open': self.open, 'rejected': self.rejected, 'per_user': self.per_user}
+
+
+def get_stream_slots(request: Request) -> StreamSlots:
+    return request.app.state.stream_slots
+
+
+class LoadShedMiddleware:
+    """
+    Answers 503 with Retry-After, before any route work, while callers have
+    been waiting on the storage connection pool for more than `threshold`
+    seconds.
+    """
+
+    def __init__(self, app: ASGIApp, threshold: float = SHED_POOL_WAIT_MS / 1000):
+        self.app = app
+        self.threshold = threshold
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http' and self.threshold and not scope['path'].startswith(SHED_EXEMPT):
+            db = getattr(scope['app'].state, 'db', None)
+            wait = db.pool_wait() if db is not None else 0.0
+            if wait > self.threshold:
+                REQUESTS_SHED.inc()
+                await send({'type': 'http.response.start', 'status': 503,
+                            'headers': [(b'content-type', b'application/json'),
+                                        (b'retry-after', str(max(1, math.ceil(wait))).encode())]})
+                await send({'type': 'http.response.body',
+                            'body': b'{"detail":"Server is overloaded, retry later."}'})
+                return
+        await self.app(scope, receive, send)
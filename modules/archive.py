@@ -0,0 +1,208 @@
+"""
+Compressed, append-only segment files holding the messages of archived
+partitions (see modules/partitions.py), and the reader history pages fall
+through to once a cursor passes the live partitions.
+
+A segment is written once, front to back, and never modified:
+
+    MAGIC | block ... | index | index offset, index length (u64 LE) | MAGIC
+
+Each block is a zlib-compressed JSON array of up to ARCHIVE_BLOCK_ROWS rows of
+one chat in id order. The index, compressed the same way, lists every block as
+[chat_id, first_id, last_id, offset, length], so a page decompresses only the
+blocks it touches.
+"""
+import asyncio
+import bisect
+import itertools
+import os
+import struct
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import orjson
+
+from modules.lru import MISSING, TTLCache
+from modules.recent import decode_row
+from modules.responses import dumps
+
+
+ARCHIVE_DIR = os.getenv('MESSAGE_ARCHIVE_DIR', 'archive/messages')
+ARCHIVE_BLOCK_ROWS = int(os.getenv('MESSAGE_ARCHIVE_BLOCK_ROWS', 256))
+ARCHIVE_COMPRESSION = int(os.getenv('MESSAGE_ARCHIVE_COMPRESSION', 6))
+ARCHIVE_BLOCK_CACHE = int(os.getenv('MESSAGE_ARCHIVE_BLOCK_CACHE', 1024))
+
+MAGIC = b'CHATSEG1'
+_TRAILER = struct.Struct('<QQ')
+
+
+class SegmentWriter:
+    """
+    Writes rows, grouped by chat and in id order within a chat, to
+    `path` + '.tmp' and moves the finished file into place on close().
+    """
+
+    def __init__(self, path: str, block_rows: int = ARCHIVE_BLOCK_ROWS, level: int = ARCHIVE_COMPRESSION):
+        self.path = path
+        self.block_rows = block_rows
+        self.level = level
+        self.index: List[list] = []
+        self.rows = 0
+        self._block: List[dict] = []
+        self._file = open(path + '.tmp', 'wb')
+        self._file.write(MAGIC)
+
+    def add(self, row) -> None:
+        if self._block and (row['chat_id'] != self._block[0]['chat_id'] or len(self._block) >= self.block_rows):
+            self._flush()
+        self._block.append(dict(row))
+        self.rows += 1
+
+    def _flush(self) -> None:
+        data = zlib.compress(dumps(self._block), self.level)
+        self.index.append([self._block[0]['chat_id'], self._block[0]['id'], self._block[-1]['id'],
+                           self._file.tell(), len(data)])
+        self._file.write(data)
+        self._block = []
+
+    def close(self) -> None:
+        if self._block:
+            self._flush()
+        index = zlib.compress(orjson.dumps(self.index), self.level)
+        offset = self._file.tell()
+        self._file.write(index)
+        self._file.write(_TRAILER.pack(offset, len(index)) + MAGIC)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+    def abort(self) -> None:
+        self._file.close()
+        os.unlink(self.path + '.tmp')
+
+
+def write_segment(path: str, rows: Iterable) -> int:
+    """
+    Writes a whole segment from rows sorted by (chat_id, id); returns the row count.
+    """
+    writer = SegmentWriter(path)
+    try:
+        for row in rows:
+            writer.add(row)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.rows
+
+
+def read_index(path: str) -> List[list]:
+    with open(path, 'rb') as f:
+        f.seek(-(_TRAILER.size + len(MAGIC)), os.SEEK_END)
+        trailer = f.read()
+        if trailer[-len(MAGIC):] != MAGIC:
+            raise ValueError(f'{path} is not a finished message segment')
+        offset, length = _TRAILER.unpack(trailer[:_TRAILER.size])
+        f.seek(offset)
+        return orjson.loads(zlib.decompress(f.read(length)))
+
+
+def read_block(path: str, offset: int, length: int) -> List[dict]:
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return [decode_row(row) for row in orjson.loads(zlib.decompress(f.read(length)))]
+
+
+class Archive:
+    """
+    In-memory index over every loaded segment: chat_id -> its blocks sorted
+    by first id, so paging seeks straight to the blocks around a cursor.
+    Decompressed blocks are kept in a small LRU.
+    """
+
+    def __init__(self, block_cache: int = ARCHIVE_BLOCK_CACHE):
+        self.segments: Dict[str, str] = {}
+        # chat_id -> [(first_id, last_id, path, offset, length)] sorted by first_id
+        self.chats: Dict[int, List[Tuple[int, int, str, int, int]]] = {}
+        self.blocks = TTLCache(block_cache, 3600)
+        self.reads = 0
+
+    async def sync(self, segments: Dict[str, str]) -> None:
+        """
+        Makes the loaded set exactly `segments` (partition name -> path).
+        """
+        if segments == self.segments:
+            return
+        indexes = {}
+        for name, path in segments.items():
+            try:
+                indexes[path] = await asyncio.to_thread(read_index, path)
+            except OSError as e:
+                print("Archive segment unavailable:", path, e)
+        chats: Dict[int, list] = {}
+        for path, index in indexes.items():
+            for chat_id, first_id, last_id, offset, length in index:
+                chats.setdefault(chat_id, []).append((first_id, last_id, path, offset, length))
+        for blocks in chats.values():
+            blocks.sort()
+        self.chats = chats
+        self.segments = {name: path for name, path in segments.items() if path in indexes}
+        self.blocks.clear()
+
+    def newest_id(self, chat_id: int) -> Optional[int]:
+        blocks = self.chats.get(chat_id)
+        return max(block[1] for block in blocks) if blocks else None
+
+    async def _rows(self, block) -> List[dict]:
+        key = (block[2], block[3])
+        rows = self.blocks.get(key)
+        if rows is MISSING:
+            self.reads += 1
+            rows = await asyncio.to_thread(read_block, block[2], block[3], block[4])
+            self.blocks.set(key, rows)
+        return rows
+
+    async def before(self, chat_id: int, before_id: Optional[int], count: int) -> List[dict]:
+        """
+        Up to `count` archived messages older than before_id (None for the
+        newest), newest first.
+        """
+        blocks = self.chats.get(chat_id)
+        if not blocks or count <= 0:
+            return []
+        limit = float('inf') if before_id is None else before_id
+        end = bisect.bisect_left(blocks, (limit,))
+        # Blocks of different segments may overlap at partition boundaries, so an
+        # earlier block can still hold newer rows: reach[i] is the highest last_id
+        # among blocks[:i + 1], everything not read yet.
+        reach = list(itertools.accumulate((block[1] for block in blocks[:end]), max))
+        page = []
+        for i in reversed(range(end)):
+            if len(page) >= count and reach[i] < page[count - 1]['id']:
+                break
+            page.extend(row for row in await self._rows(blocks[i]) if row['id'] < limit)
+            page.sort(key=lambda row: row['id'], reverse=True)
+        return page[:count]
+
+    async def after(self, chat_id: int, after_id: int, count: int) -> List[dict]:
+        """
+        Up to `count` archived messages newer than after_id, oldest first.
+        """
+        blocks = self.chats.get(chat_id)
+        if not blocks or count <= 0:
+            return []
+        page = []
+        for block in blocks:
+            if block[1] <= after_id:
+                continue
+            if len(page) >= count and block[0] > page[count - 1]['id']:
+                break
+            page.extend(row for row in await self._rows(block) if row['id'] > after_id)
+            page.sort(key=lambda row: row['id'])
+        return page[:count]
+
+    def stats(self) -> dict:
+        return {'segments': len(self.segments), 'chats': len(self.chats),
+                'blocks': sum(len(blocks) for blocks in self.chats.values()),
+                'block_reads': self.reads, 'block_cache': self.blocks.stats()}
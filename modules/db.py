@@ -1,24 +1,227 @@
 import asyncpg
-from typing import Optional, List
+import asyncio
+import orjson
+import time
+from contextlib import asynccontextmanager
+from fastapi import Request
+from itertools import repeat
+from typing import Dict, List, Optional
+from modules.archive import Archive
+from modules.events import DELETED, EDITED
+from modules.lru import MISSING
+from modules.media import media_filename, media_url
+from modules.metrics import POOL_TIMEOUTS, POOL_WAIT_SECONDS, timed_methods
+from modules.replicas import REPLICA_DSNS, REPLICA_POOL_MAX_SIZE, ReplicaSet
+from modules.storage import ChatStorage
 import os
 
-class AsyncChatDB:
-    def __init__(self):
-        self.dsn = os.getenv('PQ_DSN')
+
+# Everything in users except the password hash.
+PUBLIC_USER_COLUMNS = "users.id, users.username, users.name, users.profile, users.bio, users.status"
+
+
+# Appended to a "WITH m AS (INSERT INTO messages ... RETURNING *)" statement:
+# bumps each chat's activity summary and marks the chat read for the senders.
+_TRACK_ACTIVITY = """, activity AS (
+                    INSERT INTO chat_activity(chat_id, last_message_id, last_activity_at, message_count)
+                    SELECT chat_id, max(id), max(sent_at), count(*) FROM m GROUP BY chat_id
+                    ON CONFLICT (chat_id) DO UPDATE
+                    SET last_message_id = GREATEST(chat_activity.last_message_id, EXCLUDED.last_message_id),
+                        last_activity_at = GREATEST(chat_activity.last_activity_at, EXCLUDED.last_activity_at),
+                        message_count = chat_activity.message_count + EXCLUDED.message_count
+                    RETURNING chat_id, last_message_id, message_count
+                ), marked AS (
+                    UPDATE dialogs
+                    SET last_read_id = activity.last_message_id, read_count = activity.message_count
+                    FROM activity, (SELECT DISTINCT chat_id, sender_id FROM m) AS senders
+                    WHERE dialogs.chat_id = activity.chat_id
+                      AND senders.chat_id = activity.chat_id AND dialogs.user_id = senders.sender_id
+                )"""
+
+# Text search configuration for message_search; migrations/0005 backfills with the same one.
+SEARCH_CONFIG = 'simple'
+
+# Appended to a "WITH m AS (INSERT INTO messages / UPDATE messages ... RETURNING *)"
+# statement: (re)indexes the text messages for search.
+_INDEX_SEARCH = f""", indexed AS (
+                    INSERT INTO message_search(message_id, chat_id, document)
+                    SELECT id, chat_id, to_tsvector('{SEARCH_CONFIG}', content) FROM m WHERE NOT is_media
+                    ON CONFLICT (message_id) DO UPDATE SET document = EXCLUDED.document
+                )"""
+
+
+# Attaches the file's processed metadata to media messages whose job is done. FOR SHARE
+# makes finish_media_job wait for this insert, so it either sees the job done here
+# or its UPDATE of pending media messages sees the new row.
+_MEDIA_META = "(SELECT CASE WHEN state = 'done' THEN meta END FROM media_jobs WHERE filename = {} FOR SHARE)"
+
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    # jsonb (messages.media, media_jobs.meta) as Python objects rather than strings.
+    await conn.set_type_codec('jsonb', schema='pg_catalog', encoder=lambda value: orjson.dumps(value).decode(),
+                              decoder=orjson.loads)
+
+
+def _as_dicts(rows: List[asyncpg.Record]) -> List[dict]:
+    """
+    The rows of one fetch as plain dicts, zipping each row with the column
+    names taken once: cheaper than dict(record), and responses serialize the
+    result without copying it again.
+    """
+    if not rows:
+        return []
+    return list(map(dict, map(zip, repeat(tuple(rows[0].keys())), rows)))
+
+
+def _setting(value, env: str, default, cast):
+    return cast(os.getenv(env, default)) if value is None else value
+
+
+@timed_methods
+class AsyncChatDB(ChatStorage):
+    def __init__(self, dsn: Optional[str] = None, min_size: Optional[int] = None,
+                 max_size: Optional[int] = None, statement_cache_size: Optional[int] = None,
+                 connection_lifetime: Optional[float] = None, acquire_timeout: Optional[float] = None,
+                 replica_dsns: Optional[List[str]] = None):
+        super().__init__()
+        self.dsn = dsn or os.getenv('PQ_DSN')
         self.pool: asyncpg.pool.Pool = None
+        self.min_size = _setting(min_size, 'PQ_POOL_MIN_SIZE', 5, int)
+        self.max_size = _setting(max_size, 'PQ_POOL_MAX_SIZE', 20, int)
+        self.statement_cache_size = _setting(statement_cache_size, 'PQ_STATEMENT_CACHE_SIZE', 100, int)
+        self.connection_lifetime = _setting(connection_lifetime, 'PQ_CONNECTION_LIFETIME', 300, float)
+        self.acquire_timeout = _setting(acquire_timeout, 'PQ_ACQUIRE_TIMEOUT', 10, float)
+        # Pool wait accounting, see pool_stats()
+        self.waiting = 0
+        # Start times of callers waiting for a connection, oldest first.
+        self._waiters: Dict[object, float] = {}
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # Read-only methods use acquire_read(); see modules/replicas.py.
+        self.replicas = ReplicaSet(REPLICA_DSNS if replica_dsns is None else replica_dsns, {
+            'min_size': min(self.min_size, REPLICA_POOL_MAX_SIZE),
+            'max_size': REPLICA_POOL_MAX_SIZE,
+            'statement_cache_size': self.statement_cache_size,
+            'max_inactive_connection_lifetime': self.connection_lifetime,
+            'init': _init_connection,
+        })
+        # When a chat or profile change last reached this worker; cache fills must not predate it.
+        self._chat_dropped_at = float('-inf')
+        self._profiles_dropped_at = float('-inf')
+        # Set by PartitionMaintainer to the archived partitions; history pages continue into it.
+        self.archive: Optional[Archive] = None
 
     async def connect(self):
-        self.pool = await asyncpg.create_pool(dsn=self.dsn)
+        self.pool = await asyncpg.create_pool(
+            dsn=self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            statement_cache_size=self.statement_cache_size,
+            max_inactive_connection_lifetime=self.connection_lifetime,
+            init=_init_connection,
+        )
+        if self.replicas:
+            await self.replicas.start(self.pool)
 
     async def close(self):
+        await self.replicas.close()
         if self.pool:
             await self.pool.close()
 
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        pool.acquire() that records how long callers wait for a connection.
+        """
+        self.waiting += 1
+        start = time.perf_counter()
+        waiter = object()
+        self._waiters[waiter] = start
+        try:
+            conn = await self.pool.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            self.waiting -= 1
+            del self._waiters[waiter]
+        waited = time.perf_counter() - start
+        POOL_WAIT_SECONDS.observe(waited)
+        self.acquires += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+
+    @asynccontextmanager
+    async def acquire_read(self, after: float = float('-inf')):
+        """
+        A connection for a read-only query: from a replica that holds every
+        commit acknowledged before `after` (time.time()) and the current
+        user's last write, else from the primary.
+        """
+        replica = await self.replicas.pick(after) if self.replicas else None
+        conn = None
+        if replica is not None:
+            try:
+                conn = await replica.pool.acquire(timeout=self.acquire_timeout)
+            except Exception as e:
+                print("Replica acquire failed:", e)
+                replica.healthy = False
+                replica.failures += 1
+        if conn is None:
+            async with self.acquire() as conn:
+                yield conn
+            return
+        replica.reads += 1
+        try:
+            yield conn
+        finally:
+            await replica.pool.release(conn)
+
+    def pool_wait(self) -> float:
+        for start in self._waiters.values():
+            return time.perf_counter() - start
+        return 0.0
+
+    def drop_chat(self, chat_id: Optional[int]) -> None:
+        self._chat_dropped_at = time.time()
+        super().drop_chat(chat_id)
+
+    def drop_profile(self, user_id: Optional[int]) -> None:
+        self._profiles_dropped_at = time.time()
+        super().drop_profile(user_id)
+
+    def pool_stats(self) -> dict:
+        size = self.pool.get_size() if self.pool else 0
+        idle = self.pool.get_idle_size() if self.pool else 0
+        return {
+            'size': size,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'in_use': size - idle,
+            'saturation': (size - idle) / self.max_size if self.max_size else 0.0,
+            'waiting': self.waiting,
+            'acquires': self.acquires,
+            'acquire_timeouts': self.acquire_timeouts,
+            'wait_avg_ms': self.wait_total / self.acquires * 1e3 if self.acquires else 0.0,
+            'wait_max_ms': self.wait_max * 1e3,
+            'replicas': self.replicas.stats(),
+            'replica_fallbacks': self.replicas.fallbacks,
+            'replica_redis_errors': self.replicas.redis_errors,
+            'replica_marker_lookups': self.replicas.marker_lookups,
+        }
+
     # -------- Users --------
     async def create_user(self, username: str, name: str, password_hash: str,
                           profile: Optional[str] = None, bio: Optional[str] = None,
                           status: Optional[str] = None) -> int:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             result = await conn.fetchrow(
                 """
                 INSERT INTO users(username, name, password, profile, bio, status)
@@ -30,18 +233,18 @@ class AsyncChatDB:
             return result['id']
 
     async def get_user_by_username(self, username: str) -> Optional[asyncpg.Record]:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             return await conn.fetchrow("SELECT * FROM users WHERE username = $1", username)
 
     async def get_user_by_id(self, user_id: int):
-        async with self.pool.acquire() as conn:
+        async with self.acquire_read() as conn:
             return await conn.fetchrow("SELECT * FROM users WHERE id = $1", user_id)
 
     async def login(self, username: str, password_hash: str) -> Optional[int]:
         """
         Returns user id if username + password hash matches, else None.
         """
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             result = await conn.fetchrow(
                 "SELECT id FROM users WHERE username = $1 AND password = $2",
                 username, password_hash
@@ -60,15 +263,21 @@ class AsyncChatDB:
             return
         sets = ", ".join(f"{k} = ${i+2}" for i, k in enumerate(keys))
         values = [kwargs[k] for k in keys]
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute(
                 f"UPDATE users SET {sets} WHERE id = $1",
                 user_id, *values
             )
+        await self.replicas.wrote(user_id)
+        await self.invalidate_profile(user_id)
+
+    async def load_profiles(self, user_ids: List[int]) -> List[asyncpg.Record]:
+        async with self.acquire_read(self._profiles_dropped_at) as conn:
+            return await conn.fetch(f"SELECT {PUBLIC_USER_COLUMNS} FROM users WHERE id = ANY($1::bigint[])", user_ids)
 
     # -------- Chats --------
     async def create_chat(self, chatname: str, chat_title: str, chat_about: str, owner_id: int) -> int:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             result = await conn.fetchrow(
                 """
                 INSERT INTO chats(chatname, chat_title, chat_about, owner)
@@ -77,15 +286,26 @@ class AsyncChatDB:
                 """,
                 chatname, chat_title, chat_about, owner_id
             )
-            return result['id']
+        await self.replicas.wrote(owner_id)
+        return result['id']
 
     async def get_chat_by_name(self, chatname: str) -> Optional[asyncpg.Record]:
-        async with self.pool.acquire() as conn:
-            return await conn.fetchrow("SELECT * FROM chats WHERE chatname = $1", chatname)
+        chat = self.chat_cache.get(('name', chatname))
+        if chat is not MISSING:
+            return chat
+        async with self.acquire_read(self._chat_dropped_at) as conn:
+            chat = await conn.fetchrow("SELECT * FROM chats WHERE chatname = $1", chatname)
+        self._cache_chat(chat)
+        return chat
 
     async def get_chat_by_id(self, chatid: int) -> Optional[asyncpg.Record]:
-        async with self.pool.acquire() as conn:
-            return await conn.fetchrow("SELECT * FROM chats WHERE id = $1", chatid)
+        chat = self.chat_cache.get(('id', chatid))
+        if chat is not MISSING:
+            return chat
+        async with self.acquire_read(self._chat_dropped_at) as conn:
+            chat = await conn.fetchrow("SELECT * FROM chats WHERE id = $1", chatid)
+        self._cache_chat(chat)
+        return chat
 
     async def update_chat_info(self, chat_id: int, **kwargs) -> None:
         """
@@ -97,24 +317,29 @@ class AsyncChatDB:
             return
         sets = ", ".join(f"{k} = ${i+2}" for i, k in enumerate(keys))
         values = [kwargs[k] for k in keys]
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute(
                 f"UPDATE chats SET {sets} WHERE id = $1",
                 chat_id, *values
             )
+        await self.replicas.wrote()
+        await self.invalidate_chat(chat_id)
 
     async def remove_group(self, chat_id: int) -> None:
         """
         Deletes chat and cascades due to foreign keys.
         """
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute("DELETE FROM chats WHERE id = $1", chat_id)
+        await self.replicas.wrote()
+        await self.invalidate_chat(chat_id)
+        await self._share_recent(['drop', chat_id])
 
     # -------- Chat Rules --------
     async def set_chat_rules(self, user_id: int, chat_id: int,
                              can_ban_user: bool = False, can_remove_message: bool = False,
                              can_send_message: bool = True, can_send_media: bool = True) -> None:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute(
                 """
                 INSERT INTO chat_rules(user_id, chat_id, can_ban_user, can_remove_message, can_send_message, can_send_media)
@@ -127,48 +352,113 @@ class AsyncChatDB:
                 """,
                 user_id, chat_id, can_ban_user, can_remove_message, can_send_message, can_send_media
             )
+        await self.replicas.wrote()
+        await self.invalidate_rules(chat_id, [user_id])
 
     async def get_chat_rules(self, user_id: int, chat_id: int) -> Optional[asyncpg.Record]:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             return await conn.fetchrow(
                 "SELECT * FROM chat_rules WHERE user_id = $1 AND chat_id = $2",
                 user_id, chat_id
             )
 
+    async def set_chat_rules_bulk(self, chat_id: int, user_ids: List[int],
+                                  can_ban_user: bool = False, can_remove_message: bool = False,
+                                  can_send_message: bool = True, can_send_media: bool = True) -> None:
+        """
+        Same rules for many members of one chat in a single statement.
+        """
+        async with self.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO chat_rules(user_id, chat_id, can_ban_user, can_remove_message, can_send_message, can_send_media)
+                SELECT user_id, $2, $3, $4, $5, $6 FROM unnest($1::bigint[]) AS u(user_id)
+                ON CONFLICT (user_id, chat_id) DO UPDATE
+                SET can_ban_user = EXCLUDED.can_ban_user,
+                    can_remove_message = EXCLUDED.can_remove_message,
+                    can_send_message = EXCLUDED.can_send_message,
+                    can_send_media = EXCLUDED.can_send_media
+                """,
+                user_ids, chat_id, can_ban_user, can_remove_message, can_send_message, can_send_media
+            )
+        await self.replicas.wrote()
+        await self.invalidate_rules(chat_id, list(user_ids))
+
     # -------- Dialogs (memberships) --------
     async def join_chat(self, user_id: int, chat_id: int) -> None:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute(
                 """
-                INSERT INTO dialogs(user_id, chat_id)
-                VALUES ($1, $2)
+                INSERT INTO dialogs(user_id, chat_id, last_read_id, read_count)
+                SELECT $1, $2, COALESCE(a.last_message_id, 0), COALESCE(a.message_count, 0)
+                FROM (SELECT 1) AS one
+                LEFT JOIN chat_activity a ON a.chat_id = $2
                 ON CONFLICT DO NOTHING
                 """,
                 user_id, chat_id
             )
+        await self.replicas.wrote(user_id)
 
     async def leave_chat(self, user_id: int, chat_id: int) -> None:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             await conn.execute(
                 """
                 DELETE FROM dialogs WHERE user_id = $1 AND chat_id = $2
                 """,
                 user_id, chat_id
             )
+        await self.replicas.wrote(user_id)
 
-    async def get_user_chats(self, user_id: int) -> List[asyncpg.Record]:
-        async with self.pool.acquire() as conn:
-            return await conn.fetch(
+    async def get_user_chats(self, user_id: int) -> List[dict]:
+        """
+        The user's chats with last message preview and unread count, most recently active first.
+        """
+        async with self.acquire_read() as conn:
+            return _as_dicts(await conn.fetch(
                 """
-                SELECT chats.* FROM chats
-                JOIN dialogs ON chats.id = dialogs.chat_id
+                SELECT chats.*,
+                       a.last_activity_at,
+                       GREATEST(COALESCE(a.message_count, 0) - dialogs.read_count, 0) AS unread_count,
+                       dialogs.last_read_id,
+                       m.id AS last_message_id,
+                       m.sender_id AS last_message_sender_id,
+                       m.content AS last_message_content,
+                       m.is_media AS last_message_is_media,
+                       m.sent_at AS last_message_sent_at
+                FROM dialogs
+                JOIN chats ON chats.id = dialogs.chat_id
+                LEFT JOIN chat_activity a ON a.chat_id = dialogs.chat_id
+                LEFT JOIN messages m ON m.id = a.last_message_id
                 WHERE dialogs.user_id = $1
+                ORDER BY a.last_activity_at DESC NULLS LAST, chats.id DESC
                 """,
                 user_id
+            ))
+
+    async def mark_read(self, user_id: int, chat_id: int, message_id: Optional[int] = None) -> bool:
+        """
+        Moves the user's read marker forward to message_id, or to the newest message when None.
+        """
+        async with self.acquire() as conn:
+            result = await conn.execute(
+                """
+                UPDATE dialogs
+                SET last_read_id = COALESCE($3, a.last_message_id),
+                    read_count = a.message_count - (
+                        SELECT count(*) FROM messages
+                        WHERE chat_id = $2 AND id > COALESCE($3, a.last_message_id)
+                    )
+                FROM chat_activity a
+                WHERE dialogs.user_id = $1 AND dialogs.chat_id = $2 AND a.chat_id = $2
+                  AND dialogs.last_read_id < COALESCE($3, a.last_message_id)
+                """,
+                user_id, chat_id, message_id
             )
-    
+        await self.replicas.wrote(user_id)
+        return not result.endswith(" 0")
+
     async def is_joined(self, chat_id: int, user_id: int) -> bool:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             result = await conn.fetchval(
                 """
                 SELECT EXISTS (
@@ -182,61 +472,473 @@ class AsyncChatDB:
 
 
     async def get_chat_users(self, chat_id: int) -> List[asyncpg.Record]:
-        async with self.pool.acquire() as conn:
+        async with self.acquire_read() as conn:
             return await conn.fetch(
-                """
-                SELECT users.* FROM users
+                f"""
+                SELECT {PUBLIC_USER_COLUMNS} FROM users
                 JOIN dialogs ON users.id = dialogs.user_id
                 WHERE dialogs.chat_id = $1
                 """,
                 chat_id
             )
-    
+
+    async def get_chat_members(self, chat_id: int, after_id: int = 0, count: int = 100) -> List[asyncpg.Record]:
+        """
+        Keyset page of a chat's members ordered by user id, without private columns.
+        """
+        async with self.acquire_read() as conn:
+            return await conn.fetch(
+                f"""
+                SELECT {PUBLIC_USER_COLUMNS} FROM dialogs
+                JOIN users ON users.id = dialogs.user_id
+                WHERE dialogs.chat_id = $1 AND dialogs.user_id > $2
+                ORDER BY dialogs.user_id
+                LIMIT $3
+                """,
+                chat_id, after_id, count
+            )
+
+    async def get_chat_member_ids(self, chat_id: int) -> List[int]:
+        async with self.acquire() as conn:
+            rows = await conn.fetch("SELECT user_id FROM dialogs WHERE chat_id = $1", chat_id)
+            return [row['user_id'] for row in rows]
+
     async def send_message(self, chat_id: int, sender_id: int, content: str,
                            reply_to: Optional[int] = None, is_media: bool = False) -> int:
-        async with self.pool.acquire() as conn:
+        async with self.acquire() as conn:
             result = await conn.fetchrow(
-                """
-                INSERT INTO messages(chat_id, sender_id, content, reply_to, is_media)
-                VALUES ($1, $2, $3, $4, $5)
-                RETURNING id
+                f"""
+                WITH m AS (
+                    INSERT INTO messages(chat_id, sender_id, content, reply_to, is_media, media)
+                    VALUES ($1, $2, $3, $4, $5, {_MEDIA_META.format('$6')})
+                    RETURNING *
+                ){_TRACK_ACTIVITY}{_INDEX_SEARCH}
+                SELECT * FROM m
                 """,
-                chat_id, sender_id, content, reply_to, is_media
+                chat_id, sender_id, content, reply_to, is_media, media_filename(content) if is_media else None
             )
-            return result["id"]
+        await self.replicas.wrote(sender_id)
+        await self._emit_created([result])
+        return result["id"]
 
-    async def get_last_messages(self, chat_id: int, offset: int = 0, count: int = 20) -> List[asyncpg.Record]:
-        async with self.pool.acquire() as conn:
-            return await conn.fetch(
+    async def send_messages(self, rows: List[tuple]) -> List[int]:
+        """
+        Multi-row insert of (chat_id, sender_id, content, reply_to, is_media) tuples.
+        Returns the new ids in the same order as rows.
+        """
+        chat_ids, sender_ids, contents, reply_tos, is_medias = (list(col) for col in zip(*rows))
+        media_files = [media_filename(content) if is_media else None for content, is_media in zip(contents, is_medias)]
+        async with self.acquire() as conn:
+            result = await conn.fetch(
+                f"""
+                WITH m AS (
+                    INSERT INTO messages(chat_id, sender_id, content, reply_to, is_media, media)
+                    SELECT chat_id, sender_id, content, reply_to, is_media, {_MEDIA_META.format('u.media_file')}
+                    FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::bigint[], $5::boolean[], $6::text[])
+                        WITH ORDINALITY AS u(chat_id, sender_id, content, reply_to, is_media, media_file, n)
+                    ORDER BY n
+                    RETURNING *
+                ){_TRACK_ACTIVITY}{_INDEX_SEARCH}
+                SELECT * FROM m
+                """,
+                chat_ids, sender_ids, contents, reply_tos, is_medias, media_files
+            )
+        # ids are drawn from the sequence in row order.
+        result = sorted(result, key=lambda row: row['id'])
+        await self.replicas.wrote(*set(sender_ids))
+        await self._emit_created(result)
+        return [row['id'] for row in result]
+
+    async def get_last_messages(self, chat_id: int, count: int = 20,
+                                before_id: Optional[int] = None,
+                                after_id: Optional[int] = None) -> List[dict]:
+        """
+        Keyset page over (chat_id, id), newest first.
+        before_id pages back into history, after_id pages forward to newer messages.
+        The newest page is served from self.recent when it holds enough messages.
+        Pages continue into self.archive past the live partitions.
+        """
+        if before_id is None and after_id is None:
+            return await self._get_newest_messages(chat_id, count)
+        async with self.acquire_read() as conn:
+            if after_id is not None:
+                rows = await conn.fetch(
+                    """
+                    SELECT * FROM messages
+                    WHERE chat_id = $1 AND id > $2
+                    ORDER BY id ASC
+                    LIMIT $3
+                    """,
+                    chat_id, after_id, count
+                )
+            else:
+                rows = await conn.fetch(
+                    """
+                    SELECT * FROM messages
+                    WHERE chat_id = $1 AND id < $2
+                    ORDER BY id DESC
+                    LIMIT $3
+                    """,
+                    chat_id, before_id, count
+                )
+        rows = _as_dicts(rows)
+        if self.archive is None:
+            return rows[::-1] if after_id is not None else rows
+        if after_id is not None:
+            if (self.archive.newest_id(chat_id) or 0) <= after_id:
+                return rows[::-1]
+            # A partition is briefly both live and archived, so merge by id.
+            merged = {row['id']: row for row in await self.archive.after(chat_id, after_id, count)}
+            merged.update((row['id'], row) for row in rows)
+            return [merged[i] for i in sorted(merged)[:count]][::-1]
+        return await self._continue_into_archive(chat_id, rows, count, before_id)
+
+    async def _continue_into_archive(self, chat_id: int, rows: list, count: int,
+                                     before_id: Optional[int] = None) -> list:
+        """
+        Tops a short newest-first page of live rows up with archived ones.
+        """
+        if len(rows) >= count or self.archive is None:
+            return rows
+        older = await self.archive.before(chat_id, rows[-1]['id'] if rows else before_id, count - len(rows))
+        return list(rows) + older
+
+    async def _get_newest_messages(self, chat_id: int, count: int) -> List[dict]:
+        started = time.perf_counter()
+        page = self.recent.page(chat_id, count)
+        stale = self.recent.stale(chat_id) if page is None else None
+        if stale is not None:
+            # Messages another worker sent or edited: fetch just those, from the primary.
+            ring, wanted = stale
+            async with self.acquire() as conn:
+                rows = await conn.fetch(
+                    "SELECT * FROM messages WHERE chat_id = $1 AND id = ANY($2::bigint[])",
+                    chat_id, list(wanted)
+                )
+            self.recent.finish_refill(chat_id, ring, wanted, _as_dicts(rows))
+            page = self.recent.page(chat_id, count)
+        if page is not None:
+            self.recent.record(True, started)
+            return page
+        warm = count <= self.recent.per_chat
+        ring = self.recent.begin_warm(chat_id) if warm else None
+        # A ring warmed from a lagging replica would keep missing messages, so warm from the primary.
+        async with (self.acquire() if warm else self.acquire_read()) as conn:
+            rows = await conn.fetch(
                 """
                 SELECT * FROM messages
                 WHERE chat_id = $1
-                ORDER BY sent_at DESC
-                OFFSET $2 LIMIT $3
+                ORDER BY id DESC
+                LIMIT $2
                 """,
-                chat_id, offset, count
+                chat_id, self.recent.per_chat if warm else count
             )
+        rows = await self._continue_into_archive(chat_id, _as_dicts(rows),
+                                                 self.recent.per_chat if warm else count)
+        if warm:
+            self.recent.finish_warm(chat_id, ring, rows)
+        self.recent.record(False, started)
+        return rows[:count]
 
-    async def delete_message(self, message_id: int, user_id: int) -> bool:
-        async with self.pool.acquire() as conn:
-            # Ensure only sender can delete
-            result = await conn.execute(
+    async def get_changes(self, user_id: int, since: int = 0, last_seen: Optional[dict] = None,
+                          count: int = 500, settle: float = 1.0):
+        """
+        Messages created or edited and messages deleted after change_seq `since`
+        across the user's chats, in change_seq order, at most `count` of each.
+
+        last_seen maps chat_id -> last seen message id instead; only those chats are
+        synced, from a change_seq no later than when that message was sent, so the
+        result may repeat changes the client already has but never misses one.
+        Changes younger than `settle` seconds are held back so a still-committing
+        lower change_seq cannot be skipped.
+        Returns (messages, deletions).
+        Runs on the primary: on a replica the settle window would have to
+        cover its lag as well.
+        """
+        chat_ids = list(last_seen) if last_seen else None
+        last_ids = [last_seen[c] for c in chat_ids] if last_seen else None
+        async with self.acquire() as conn:
+            if last_seen:
+                chats = """
+                    SELECT d.chat_id, COALESCE((
+                        SELECT change_seq FROM messages
+                        WHERE chat_id = s.chat_id AND id <= s.last_id AND edited_at IS NULL
+                        ORDER BY id DESC LIMIT 1
+                    ), 0) AS since
+                    FROM unnest($3::bigint[], $4::bigint[]) AS s(chat_id, last_id)
+                    JOIN dialogs d ON d.chat_id = s.chat_id AND d.user_id = $1
                 """
-                DELETE FROM messages
-                WHERE id = $1 AND sender_id = $2
+                args = (user_id, count, chat_ids, last_ids, settle)
+            else:
+                chats = "SELECT chat_id, $3::bigint AS since FROM dialogs WHERE user_id = $1"
+                args = (user_id, count, since, settle)
+            cutoff = f"CURRENT_TIMESTAMP - make_interval(secs => ${len(args)})"
+            messages = await conn.fetch(
+                f"""
+                WITH c AS ({chats})
+                SELECT m.* FROM c
+                JOIN LATERAL (
+                    SELECT * FROM messages
+                    WHERE chat_id = c.chat_id AND change_seq > c.since
+                      AND COALESCE(edited_at, sent_at) < {cutoff}
+                    ORDER BY change_seq
+                    LIMIT $2
+                ) m ON true
+                ORDER BY m.change_seq
+                LIMIT $2
                 """,
-                message_id, user_id
+                *args
             )
-            return result.endswith("1")  # e.g., 'DELETE 1'
+            deletions = await conn.fetch(
+                f"""
+                WITH c AS ({chats})
+                SELECT x.message_id, x.chat_id, x.change_seq FROM c
+                JOIN LATERAL (
+                    SELECT * FROM message_deletions
+                    WHERE chat_id = c.chat_id AND change_seq > c.since AND deleted_at < {cutoff}
+                    ORDER BY change_seq
+                    LIMIT $2
+                ) x ON true
+                ORDER BY x.change_seq
+                LIMIT $2
+                """,
+                *args
+            )
+            return messages, deletions
 
-    async def edit_message(self, message_id: int, user_id: int, new_content: str) -> bool:
-        async with self.pool.acquire() as conn:
-            result = await conn.execute(
+    async def get_chat_changes(self, chat_id: int, since: int, count: int = 500):
+        """
+        Messages created or edited and messages deleted in one chat after
+        change_seq `since`, at most `count` of each. Returns (messages, deletions).
+        """
+        async with self.acquire() as conn:
+            messages = await conn.fetch(
                 """
-                UPDATE messages
-                SET content = $1, edited_at = CURRENT_TIMESTAMP
-                WHERE id = $2 AND sender_id = $3
+                SELECT * FROM messages
+                WHERE chat_id = $1 AND change_seq > $2
+                ORDER BY change_seq
+                LIMIT $3
+                """,
+                chat_id, since, count
+            )
+            deletions = await conn.fetch(
+                """
+                SELECT * FROM message_deletions
+                WHERE chat_id = $1 AND change_seq > $2
+                ORDER BY change_seq
+                LIMIT $3
+                """,
+                chat_id, since, count
+            )
+            return messages, deletions
+
+    async def search_messages(self, query: str, chat_id: Optional[int] = None, user_id: Optional[int] = None,
+                              count: int = 20, after: Optional[tuple] = None) -> List[dict]:
+        """
+        Text messages matching a web-search style query, best match first, in
+        one chat or (chat_id None) in every chat user_id has joined. Each row
+        carries its rank; pass the last row's (rank, id) as `after` for the next page.
+        """
+        if chat_id is not None:
+            scope, args = "s.chat_id = $2", [query, chat_id]
+        else:
+            scope, args = "s.chat_id IN (SELECT chat_id FROM dialogs WHERE user_id = $2)", [query, user_id]
+        keyset = ""
+        if after is not None:
+            keyset = "AND (rank, message_id) < ($4::real, $5::bigint)"
+            args += [count, *after]
+        else:
+            args.append(count)
+        async with self.acquire_read() as conn:
+            return _as_dicts(await conn.fetch(
+                f"""
+                WITH hits AS (
+                    SELECT * FROM (
+                        SELECT s.message_id, ts_rank(s.document, q) AS rank
+                        FROM message_search s, websearch_to_tsquery('{SEARCH_CONFIG}', $1) q
+                        WHERE s.document @@ q AND {scope}
+                    ) ranked
+                    WHERE true {keyset}
+                    ORDER BY rank DESC, message_id DESC
+                    LIMIT $3
+                )
+                SELECT m.*, hits.rank FROM hits
+                JOIN messages m ON m.id = hits.message_id
+                ORDER BY hits.rank DESC, hits.message_id DESC
+                """,
+                *args
+            ))
+
+    async def _delete_message(self, condition: str, *args) -> Optional[asyncpg.Record]:
+        """
+        Deletes the message matching condition ($1 is its id) and keeps
+        chat_activity and read counts in step; returns its tombstone.
+        """
+        async with self.acquire() as conn:
+            return await conn.fetchrow(
+                f"""
+                WITH d AS (
+                    DELETE FROM messages WHERE {condition}
+                    RETURNING id, chat_id
+                ), tombstone AS (
+                    INSERT INTO message_deletions(message_id, chat_id)
+                    SELECT id, chat_id FROM d
+                    RETURNING *
+                ), unindexed AS (
+                    DELETE FROM message_search USING d WHERE message_search.message_id = d.id
+                ), unread AS (
+                    UPDATE dialogs SET read_count = read_count - 1
+                    FROM d
+                    WHERE dialogs.chat_id = d.chat_id AND dialogs.last_read_id >= d.id
+                ), activity AS (
+                    UPDATE chat_activity
+                    SET message_count = message_count - 1,
+                        last_message_id = CASE WHEN last_message_id = d.id
+                            THEN (SELECT max(id) FROM messages WHERE chat_id = d.chat_id AND id < d.id)
+                            ELSE last_message_id END
+                    FROM d
+                    WHERE chat_activity.chat_id = d.chat_id
+                )
+                SELECT * FROM tombstone
+                """,
+                *args
+            )
+
+    async def delete_message(self, message_id: int, user_id: int) -> bool:
+        # Ensure only sender can delete
+        tombstone = await self._delete_message("id = $1 AND sender_id = $2", message_id, user_id)
+        await self.replicas.wrote(user_id)
+        if tombstone is None:
+            return False
+        await self._emit(DELETED, [tombstone])
+        return True
+
+    async def remove_message(self, message_id: int, chat_id: int) -> bool:
+        """
+        Moderator delete; the caller checks the remove-message permission for chat_id.
+        """
+        tombstone = await self._delete_message("id = $1 AND chat_id = $2", message_id, chat_id)
+        await self.replicas.wrote()
+        if tombstone is None:
+            return False
+        await self._emit(DELETED, [tombstone])
+        return True
+
+    async def edit_message(self, message_id: int, user_id: int, new_content: str) -> bool:
+        async with self.acquire() as conn:
+            result = await conn.fetchrow(
+                f"""
+                WITH m AS (
+                    UPDATE messages
+                    SET content = $1, edited_at = CURRENT_TIMESTAMP, change_seq = nextval('message_change_seq')
+                    WHERE id = $2 AND sender_id = $3
+                    RETURNING *
+                ){_INDEX_SEARCH}
+                SELECT * FROM m
                 """,
                 new_content, message_id, user_id
             )
-            return result.endswith("1")
\ No newline at end of file
+        await self.replicas.wrote(user_id)
+        if result is None:
+            return False
+        await self._emit(EDITED, [result])
+        return True
+
+    # -------- Media jobs --------
+    async def enqueue_media(self, filename: str, size: int) -> None:
+        async with self.acquire() as conn:
+            # Uploading a file again gives a job that ran out of attempts a fresh start.
+            await conn.execute(
+                """
+                INSERT INTO media_jobs(filename, size) VALUES ($1, $2)
+                ON CONFLICT (filename) DO UPDATE
+                SET state = 'queued', attempts = 0, run_after = LOCALTIMESTAMP, error = NULL
+                WHERE media_jobs.state = 'failed'
+                """,
+                filename, size
+            )
+
+    async def claim_media_jobs(self, count: int, lease: float) -> List[asyncpg.Record]:
+        async with self.acquire() as conn:
+            return await conn.fetch(
+                """
+                WITH due AS (
+                    SELECT filename FROM media_jobs
+                    WHERE state = 'queued' AND run_after <= LOCALTIMESTAMP
+                    ORDER BY run_after
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE media_jobs j
+                SET attempts = j.attempts + 1, run_after = LOCALTIMESTAMP + make_interval(secs => $2)
+                FROM due
+                WHERE j.filename = due.filename
+                RETURNING j.filename, j.size, j.attempts
+                """,
+                count, lease
+            )
+
+    async def finish_media_job(self, filename: str, meta: dict) -> int:
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    UPDATE media_jobs SET state = 'done', meta = $2, error = NULL, finished_at = LOCALTIMESTAMP
+                    WHERE filename = $1
+                    """,
+                    filename, meta
+                )
+                rows = await conn.fetch(
+                    """
+                    UPDATE messages SET media = $2, change_seq = nextval('message_change_seq')
+                    WHERE is_media AND media IS NULL AND content = $1
+                    RETURNING *
+                    """,
+                    media_url(filename), meta
+                )
+        if rows:
+            await self.replicas.wrote(*{row['sender_id'] for row in rows})
+            await self._emit(EDITED, rows)
+        return len(rows)
+
+    async def fail_media_job(self, filename: str, error: str, retry_in: Optional[float]) -> None:
+        async with self.acquire() as conn:
+            if retry_in is None:
+                await conn.execute(
+                    """
+                    UPDATE media_jobs SET state = 'failed', error = $2, finished_at = LOCALTIMESTAMP
+                    WHERE filename = $1
+                    """,
+                    filename, error
+                )
+            else:
+                await conn.execute(
+                    """
+                    UPDATE media_jobs SET error = $2, run_after = LOCALTIMESTAMP + make_interval(secs => $3)
+                    WHERE filename = $1
+                    """,
+                    filename, error, retry_in
+                )
+
+    async def get_media_job(self, filename: str) -> Optional[asyncpg.Record]:
+        async with self.acquire_read() as conn:
+            return await conn.fetchrow("SELECT * FROM media_jobs WHERE filename = $1", filename)
+
+    async def media_backlog(self) -> dict:
+        async with self.acquire() as conn:
+            row = await conn.fetchrow(
+                """
+                SELECT count(*) AS queued,
+                       count(*) FILTER (WHERE run_after <= LOCALTIMESTAMP) AS due,
+                       EXTRACT(EPOCH FROM LOCALTIMESTAMP - min(run_after) FILTER (WHERE run_after <= LOCALTIMESTAMP))
+                           AS oldest_due_s
+                FROM media_jobs WHERE state = 'queued'
+                """
+            )
+        return {'queued': row['queued'], 'due': row['due'], 'oldest_due_s': float(row['oldest_due_s'] or 0)}
+
+def get_db(request: Request) -> ChatStorage:
+    """
+    FastAPI dependency returning the storage owned by the app lifespan.
+    """
+    return request.app.state.db
@@ -0,0 +1,133 @@
+import datetime
+import os
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from modules.metrics import REDIS_PUBLISH_SECONDS
+from modules.responses import dumps
+
+
+CHAT_LOG_MAXLEN = int(os.getenv('CHAT_LOG_MAXLEN', 1000))
+
+# Appending and publishing in one script keeps the log order and the live
+# delivery order identical, and costs a single round trip.
+_APPEND = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'm', ARGV[2], 'd', ARGV[3])
+redis.call('PUBLISH', ARGV[4], id .. ' ' .. ARGV[2] .. ' ' .. ARGV[3])
+return id
+"""
+
+CREATED = 'created'
+EDITED = 'edited'
+DELETED = 'deleted'
+
+MESSAGE_FIELDS = ('id', 'chat_id', 'sender_id', 'content', 'reply_to', 'is_media', 'sent_at', 'edited_at', 'media')
+
+Event = Tuple[str, int, bytes]
+
+
+def _timestamp(value: Optional[datetime.datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def message_envelope(kind: str, row) -> bytes:
+    """
+    JSON body of every realtime event, encoded once when it is published and
+    sent as is to every subscriber. `row` is a messages row for created and
+    edited events and a message_deletions row for deleted ones; `seq` is the
+    row's change_seq, the same sequence /sync pages by.
+    """
+    if kind == DELETED:
+        message_id, ts, message = row['message_id'], row['deleted_at'], None
+    else:
+        message_id, ts = row['id'], row['edited_at'] if kind == EDITED else row['sent_at']
+        message = {key: row[key] for key in MESSAGE_FIELDS}
+        message['sent_at'] = _timestamp(message['sent_at'])
+        message['edited_at'] = _timestamp(message['edited_at'])
+    return dumps({
+        'type': kind,
+        'message_id': message_id,
+        'chat_id': row['chat_id'],
+        'seq': row['change_seq'],
+        'ts': _timestamp(ts),
+        'message': message,
+    })
+
+
+def parse_stream_id(stream_id: str) -> Tuple[int, int]:
+    ms, _, seq = stream_id.partition('-')
+    return int(ms), int(seq or 0)
+
+
+def make_event_id(stream_id: str, seq: int) -> str:
+    """
+    Event ids carry the log position plus the change_seq, so a client whose
+    position has been trimmed from the log can still resume from Postgres.
+    """
+    return f'{stream_id}:{seq}'
+
+
+def parse_event_id(event_id: str) -> Tuple[str, int]:
+    stream_id, _, seq = event_id.partition(':')
+    parse_stream_id(stream_id)
+    return stream_id, int(seq)
+
+
+def parse_published(raw: bytes) -> Event:
+    stream_id, seq, data = raw.split(b' ', 2)
+    return stream_id.decode(), int(seq), data
+
+
+def sse_frame(event_id: str, data: bytes, event: str = 'message') -> bytes:
+    return b'id: %s\nevent: %s\ndata: %s\n\n' % (event_id.encode(), event.encode(), data)
+
+
+class EventLog:
+    """
+    Capped Redis Stream per chat mirroring everything published on the chat's
+    pub/sub channel, used to replay what a reconnecting client missed.
+    """
+
+    def __init__(self, r: redis.Redis, maxlen: int = CHAT_LOG_MAXLEN):
+        self.r = r
+        self.maxlen = maxlen
+        self._append = r.register_script(_APPEND)
+
+    @staticmethod
+    def key(chat_id: int) -> str:
+        return f'chat:{chat_id}:log'
+
+    async def append(self, chat_id: int, seq: int, data: bytes) -> str:
+        """
+        Logs and publishes one event; returns its stream id.
+        """
+        start = time.perf_counter()
+        stream_id = await self._append(keys=[self.key(chat_id)],
+                                       args=[self.maxlen, seq, data, str(chat_id)])
+        REDIS_PUBLISH_SECONDS.observe(time.perf_counter() - start, 'event')
+        return stream_id.decode() if isinstance(stream_id, bytes) else stream_id
+
+    async def append_many(self, events: Iterable[Tuple[int, int, bytes]]) -> None:
+        """
+        append() for several (chat_id, seq, data) events in one pipelined round trip.
+        """
+        start = time.perf_counter()
+        async with self.r.pipeline(transaction=False) as pipe:
+            for chat_id, seq, data in events:
+                await self._append(keys=[self.key(chat_id)], args=[self.maxlen, seq, data, str(chat_id)],
+                                   client=pipe)
+            await pipe.execute()
+        REDIS_PUBLISH_SECONDS.observe(time.perf_counter() - start, 'event')
+
+    async def replay(self, chat_id: int, stream_id: str) -> Optional[List[Event]]:
+        """
+        Events logged after stream_id, or None when stream_id is no longer in
+        the log and the caller has to fall back to the database.
+        """
+        key = self.key(chat_id)
+        if not await self.r.xrange(key, stream_id, stream_id):
+            return None
+        entries = await self.r.xrange(key, '(' + stream_id, '+')
+        return [(entry_id.decode(), int(fields[b'm']), fields[b'd']) for entry_id, fields in entries]
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import time
+from typing import Any, Callable, Dict, Optional, Set
+
+import redis.asyncio as redis
+
+
+STREAM_QUEUE_SIZE = int(os.getenv('STREAM_QUEUE_SIZE', 256))
+# 'drop' discards the oldest queued message, 'disconnect' ends the slow stream.
+STREAM_SLOW_CONSUMER = os.getenv('STREAM_SLOW_CONSUMER', 'drop')
+
+_CLOSED = object()
+
+
+class Published:
+    """
+    One published message, handed as the same object to every listener of
+    its channel. Whatever a listener derives from it goes through encode(),
+    so listeners wanting the same thing share one copy.
+    """
+
+    __slots__ = ('data', 'encoded')
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.encoded: Dict[Any, Any] = {}
+
+    def encode(self, key, encoder: Callable[[bytes], Any]):
+        try:
+            return self.encoded[key]
+        except KeyError:
+            value = self.encoded[key] = encoder(self.data)
+            return value
+
+
+class Subscription:
+    def __init__(self, hub: "FanoutHub", channel: str, maxsize: int):
+        self.hub = hub
+        self.channel = channel
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.closed = False
+
+    def _offer(self, received: float, data: Published) -> None:
+        try:
+            self.queue.put_nowait((received, data))
+            return
+        except asyncio.QueueFull:
+            pass
+        if self.hub.policy == 'disconnect':
+            self.hub.disconnected += 1
+            self._close()
+        else:
+            self.hub.dropped += 1
+            self.queue.get_nowait()
+            self.queue.put_nowait((received, data))
+
+    def _close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(_CLOSED)
+
+    async def get(self, timeout: Optional[float] = None) -> Published:
+        """
+        Next message; raises asyncio.TimeoutError after `timeout` seconds and
+        StopAsyncIteration once the subscription has been closed.
+        """
+        item = await asyncio.wait_for(self.queue.get(), timeout)
+        if item is _CLOSED:
+            self.queue.put_nowait(_CLOSED)
+            raise StopAsyncIteration
+        received, data = item
+        self.hub._record_lag(time.monotonic() - received)
+        return data
+
+    async def __aiter__(self):
+        while True:
+            try:
+                yield await self.get()
+            except StopAsyncIteration:
+                return
+
+
+class FanoutHub:
+    """
+    Holds one Redis subscription per active channel for the whole process and
+    copies each published message into bounded per-listener queues.
+    """
+
+    def __init__(self, r: redis.Redis, queue_size: int = STREAM_QUEUE_SIZE,
+                 policy: str = STREAM_SLOW_CONSUMER):
+        if policy not in ('drop', 'disconnect'):
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.r = r
+        self.queue_size = queue_size
+        self.policy = policy
+        self.listeners: Dict[str, Set[Subscription]] = {}
+        self.pubsub = None
+        self._lock = asyncio.Lock()
+        self._reader: Optional[asyncio.Task] = None
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.consumed = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    async def subscribe(self, channel: str) -> Subscription:
+        sub = Subscription(self, channel, self.queue_size)
+        async with self._lock:
+            if self.pubsub is None:
+                self.pubsub = self.r.pubsub()
+            if channel not in self.listeners:
+                await self.pubsub.subscribe(channel)
+                self.listeners[channel] = set()
+            self.listeners[channel].add(sub)
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read())
+        return sub
+
+    async def unsubscribe(self, sub: Subscription) -> None:
+        sub._close()
+        async with self._lock:
+            subs = self.listeners.get(sub.channel)
+            if subs is None:
+                return
+            subs.discard(sub)
+            if not subs:
+                del self.listeners[sub.channel]
+                await self.pubsub.unsubscribe(sub.channel)
+
+    async def _read(self) -> None:
+        while self.listeners:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Fan-out hub lost its Redis subscription:", e)
+                await asyncio.sleep(1)
+                await self._resubscribe()
+                continue
+            if message is None or message['type'] != 'message':
+                continue
+            self._dispatch(message['channel'], message['data'])
+
+    def _dispatch(self, channel, data: bytes) -> None:
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        received = time.monotonic()
+        self.received += 1
+        data = Published(data)
+        for sub in list(self.listeners.get(channel, ())):
+            sub._offer(received, data)
+            if sub.closed:
+                self.listeners[channel].discard(sub)
+            else:
+                self.delivered += 1
+
+    async def _resubscribe(self) -> None:
+        async with self._lock:
+            try:
+                await self.pubsub.aclose()
+            except Exception:
+                pass
+            self.pubsub = self.r.pubsub()
+            if self.listeners:
+                await self.pubsub.subscribe(*self.listeners)
+
+    def _record_lag(self, lag: float) -> None:
+        self.consumed += 1
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+
+    async def close(self) -> None:
+        for subs in self.listeners.values():
+            for sub in subs:
+                sub._close()
+        self.listeners.clear()
+        if self._reader:
+            self._reader.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+            self.pubsub = None
+
+    def stats(self) -> dict:
+        return {
+            'channels': len(self.listeners),
+            'subscribers': sum(len(subs) for subs in self.listeners.values()),
+            'received': self.received,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'disconnected': self.disconnected,
+            'lag_avg_ms': self.lag_total / self.consumed * 1e3 if self.consumed else 0.0,
+            'lag_max_ms': self.lag_max * 1e3,
+        }
@@ -0,0 +1,117 @@
+import asyncio
+import os
+from typing import List, Optional, Set, Tuple
+
+import asyncpg
+from fastapi import Request
+
+from modules.storage import ChatStorage, PublishError
+
+
+# 0 disables batching and sends go straight to ChatStorage.send_message.
+MESSAGE_BATCH_WINDOW_MS = float(os.getenv('MESSAGE_BATCH_WINDOW_MS', 0))
+MESSAGE_BATCH_SIZE = int(os.getenv('MESSAGE_BATCH_SIZE', 100))
+
+
+class MessageBatcher:
+    """
+    Collects concurrent send_message calls for up to `window` seconds (or
+    `max_batch` messages) and writes them with one multi-row INSERT.
+    Each caller still awaits its own id or its own exception.
+    """
+
+    def __init__(self, db: ChatStorage, window: float = MESSAGE_BATCH_WINDOW_MS / 1000,
+                 max_batch: int = MESSAGE_BATCH_SIZE):
+        self.db = db
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.messages = 0
+        self.fallbacks = 0
+        self.publish_failures = 0
+        self._pending: List[Tuple[tuple, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._writes: Set[asyncio.Task] = set()
+
+    async def send_message(self, chat_id: int, sender_id: int, content: str,
+                           reply_to: Optional[int] = None, is_media: bool = False) -> int:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((chat_id, sender_id, content, reply_to, is_media), future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, batch: List[Tuple[tuple, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.messages += len(batch)
+        try:
+            ids = await self.db.send_messages([row for row, _ in batch])
+        except PublishError as e:
+            # Stored; only the live delivery failed. Never insert these rows again.
+            self.publish_failures += 1
+            print("Batched messages stored but not published:", e.__cause__)
+            ids = e.ids
+        except asyncpg.PostgresError:
+            # The statement was rejected, so nothing was stored: one bad row fails
+            # the whole INSERT. Retry singly so only its sender sees the error.
+            self.fallbacks += 1
+            for row, future in batch:
+                try:
+                    result = await self.db.send_message(*row)
+                except PublishError as e:
+                    self.publish_failures += 1
+                    print("Message stored but not published:", e.__cause__)
+                    result = e.ids[0]
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                if not future.done():
+                    future.set_result(result)
+            return
+        except Exception as e:
+            # Pool timeouts, lost connections: whether anything was stored is unknown,
+            # so fail the batch rather than risk storing it twice.
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), message_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(message_id)
+
+    async def close(self) -> None:
+        self._flush()
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'messages': self.messages,
+            'avg_batch': self.messages / self.batches if self.batches else 0.0,
+            'fallbacks': self.fallbacks,
+            'publish_failures': self.publish_failures,
+            'pending': len(self._pending),
+        }
+
+
+def get_ingest(request: Request):
+    """
+    FastAPI dependency returning whatever accepts new messages:
+    the MessageBatcher when batching is enabled, else the ChatStorage itself.
+    """
+    return request.app.state.ingest
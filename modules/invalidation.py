@@ -0,0 +1,78 @@
+import asyncio
+import json
+import time
+from typing import Callable, Dict, List, Optional
+
+import redis.asyncio as redis
+
+from modules.metrics import REDIS_PUBLISH_SECONDS
+
+
+INVALIDATION_CHANNEL = 'cache:invalidate'
+
+
+class Invalidator:
+    """
+    Broadcasts cache invalidations over Redis pub/sub so every worker drops
+    its local copy. Handlers are registered per kind and get the key, or None
+    after a reconnect (when broadcasts may have been missed) to drop everything.
+    """
+
+    def __init__(self, r: redis.Redis, channel: str = INVALIDATION_CHANNEL):
+        self.r = r
+        self.channel = channel
+        self.handlers: Dict[str, List[Callable]] = {}
+        self.received = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def on(self, kind: str, handler: Callable) -> None:
+        self.handlers.setdefault(kind, []).append(handler)
+
+    def _apply(self, kind: str, key) -> None:
+        for handler in self.handlers.get(kind, ()):
+            handler(key)
+
+    async def publish(self, kind: str, key) -> None:
+        # Drop locally first; the broadcast reaches this worker too, which is harmless.
+        self._apply(kind, key)
+        start = time.perf_counter()
+        await self.r.publish(self.channel, json.dumps([kind, key]))
+        REDIS_PUBLISH_SECONDS.observe(time.perf_counter() - start, 'invalidate')
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def _listen(self) -> None:
+        lost = False
+        while True:
+            pubsub = self.r.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                if lost:
+                    for kind in self.handlers:
+                        self._apply(kind, None)
+                    lost = False
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    kind, key = json.loads(message['data'])
+                    self.received += 1
+                    self._apply(kind, key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Invalidation listener lost Redis:", e)
+                lost = True
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
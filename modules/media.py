@@ -0,0 +1,100 @@
+import asyncio
+import hashlib
+import os
+import re
+import uuid
+from typing import AsyncIterator, Optional, Tuple
+
+
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', 'static/media')
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', 50 * 1024 * 1024))
+# Request chunks are small; disk writes and hashing happen off the loop in blocks of this size.
+MEDIA_WRITE_BLOCK = 1024 * 1024
+
+# Uploads are <sha256>.bin; the pipeline adds <sha256>-thumb.jpg and <sha256>-preview.jpg.
+FILENAME = re.compile(r'^[A-Za-z0-9-]+\.(bin|jpg)$')
+MEDIA_URL_PREFIX = '/media/'
+
+
+class EmptyMedia(ValueError):
+    pass
+
+
+class MediaTooLarge(ValueError):
+    pass
+
+
+def media_path(filename: str) -> Optional[str]:
+    """
+    Path of a stored file, or None if filename is not one we could have issued.
+    """
+    if not FILENAME.match(filename):
+        return None
+    return os.path.join(MEDIA_ROOT, filename)
+
+
+def media_url(filename: str) -> str:
+    return MEDIA_URL_PREFIX + filename
+
+
+def media_filename(content: str) -> Optional[str]:
+    """
+    The upload an is_media message's content (the URL /upload-media returned)
+    points at, or None.
+    """
+    if not content.startswith(MEDIA_URL_PREFIX):
+        return None
+    filename = content[len(MEDIA_URL_PREFIX):]
+    return filename if FILENAME.match(filename) and filename.endswith('.bin') else None
+
+
+def _write(f, digest, block: bytearray) -> None:
+    digest.update(block)
+    f.write(block)
+
+
+def _discard(f, path: str) -> None:
+    f.close()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _commit(tmp: str, final: str) -> None:
+    # Content-addressed names: an existing file already holds these exact bytes.
+    if os.path.exists(final):
+        os.remove(tmp)
+    else:
+        os.replace(tmp, final)
+
+
+async def store_stream(chunks: AsyncIterator[bytes], max_bytes: int = MEDIA_MAX_BYTES) -> Tuple[str, int]:
+    """
+    Streams chunks to disk without blocking the event loop and stores the file
+    under its sha256, so identical uploads share one file. Returns (filename, size).
+    """
+    os.makedirs(MEDIA_ROOT, exist_ok=True)
+    tmp = os.path.join(MEDIA_ROOT, f'.{uuid.uuid4()}.part')
+    digest = hashlib.sha256()
+    size = 0
+    block = bytearray()
+    f = await asyncio.to_thread(open, tmp, 'wb')
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise MediaTooLarge(size)
+            block += chunk
+            if len(block) >= MEDIA_WRITE_BLOCK:
+                await asyncio.to_thread(_write, f, digest, block)
+                block.clear()
+        if not size:
+            raise EmptyMedia()
+        if block:
+            await asyncio.to_thread(_write, f, digest, block)
+        await asyncio.to_thread(f.close)
+    except BaseException:
+        await asyncio.to_thread(_discard, f, tmp)
+        raise
+    filename = f'{digest.hexdigest()}.bin'
+    await asyncio.to_thread(_commit, tmp, os.path.join(MEDIA_ROOT, filename))
+    return filename, size
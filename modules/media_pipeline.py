@@ -0,0 +1,169 @@
+"""
+Background processing of uploaded media. /messages/upload-media queues a job
+per stored file in ChatStorage (media_jobs in Postgres, so jobs survive
+restarts and are shared by every worker); MediaPipeline claims due jobs and
+runs modules.media_probe.probe() on a process pool of MEDIA_WORKERS, so
+hashing, sniffing and image resizing never hold up the event loop.
+
+A claimed job is leased for MEDIA_JOB_LEASE seconds; if its worker dies the
+job becomes due again when the lease runs out. Failed attempts are retried
+with exponential backoff up to MEDIA_JOB_ATTEMPTS times. The result lands in
+media_jobs.meta and on every is_media message sent with the file, which is
+published as an edit so streams and /sync pick it up.
+"""
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Set
+
+from fastapi import Request
+
+from modules.media import media_path
+from modules.media_probe import probe
+from modules.metrics import LATENCY_BUCKETS, Counter, Histogram
+from modules.storage import ChatStorage
+
+
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', min(4, os.cpu_count() or 1)))
+MEDIA_JOB_ATTEMPTS = int(os.getenv('MEDIA_JOB_ATTEMPTS', 5))
+MEDIA_JOB_LEASE = float(os.getenv('MEDIA_JOB_LEASE', 300))
+MEDIA_JOB_TIMEOUT = float(os.getenv('MEDIA_JOB_TIMEOUT', 120))
+MEDIA_JOB_POLL = float(os.getenv('MEDIA_JOB_POLL', 2))
+MEDIA_RETRY_BASE = float(os.getenv('MEDIA_RETRY_BASE', 5))
+MEDIA_RETRY_MAX = float(os.getenv('MEDIA_RETRY_MAX', 3600))
+
+MEDIA_JOBS = Counter('chat_media_jobs_total', 'Media job attempts by outcome.', ('outcome',))
+MEDIA_JOB_SECONDS = Histogram('chat_media_job_seconds', 'Time to process one media file in the worker pool.',
+                              buckets=LATENCY_BUCKETS + (30, 60, 120))
+
+# Retrying cannot fix these.
+_PERMANENT = (FileNotFoundError, ValueError)
+
+
+class MediaPipeline:
+    def __init__(self, db: ChatStorage, workers: int = MEDIA_WORKERS, attempts: int = MEDIA_JOB_ATTEMPTS,
+                 lease: float = MEDIA_JOB_LEASE, timeout: float = MEDIA_JOB_TIMEOUT, poll: float = MEDIA_JOB_POLL):
+        self.db = db
+        self.workers = workers
+        self.attempts = attempts
+        # A job must finish, or be given up on, before its lease lets someone else claim it.
+        self.lease = max(lease, 2 * timeout)
+        self.timeout = timeout
+        self.poll = poll
+        self.pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self.running: Set[asyncio.Task] = set()
+        self.backlog = {'queued': 0, 'due': 0, 'oldest_due_s': 0.0}
+        self.done = 0
+        self.retried = 0
+        self.failed = 0
+        self.attached = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _start_pool(self) -> None:
+        # spawn: forking a process that runs an event loop and helper threads is not safe.
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    async def start(self) -> None:
+        self._start_pool()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        for task in list(self.running):
+            task.cancel()
+        await asyncio.gather(*self.running, return_exceptions=True)
+        if self.pool is not None:
+            # Unfinished jobs stay leased in storage and run again after the lease.
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def notify(self) -> None:
+        """
+        A job was just queued; look for work now rather than at the next poll.
+        """
+        self._wake.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print("Media pipeline failed:", e)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def run_once(self) -> None:
+        """
+        Claims as many due jobs as there are idle workers and starts them.
+        """
+        self.backlog = await self.db.media_backlog()
+        free = self.workers - len(self.running)
+        if free <= 0:
+            return
+        for job in await self.db.claim_media_jobs(free, self.lease):
+            task = asyncio.create_task(self._process(job['filename'], job['attempts']))
+            self.running.add(task)
+            task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task) -> None:
+        self.running.discard(task)
+        # A worker came free; there may be more due jobs.
+        self._wake.set()
+
+    async def _process(self, filename: str, attempt: int) -> None:
+        path = media_path(filename)
+        pool = self.pool
+        start = time.perf_counter()
+        try:
+            # A timed-out probe keeps its worker process until it ends; the job is retried meanwhile.
+            meta = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(pool, probe, path),
+                                          self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool) and pool is self.pool:
+                # A worker died (killed, out of memory); every later job would fail on this pool too.
+                pool.shutdown(wait=False, cancel_futures=True)
+                self._start_pool()
+            await self._failed(filename, attempt, e)
+            return
+        MEDIA_JOB_SECONDS.observe(time.perf_counter() - start)
+        MEDIA_JOBS.inc('done')
+        self.done += 1
+        try:
+            self.attached += await self.db.finish_media_job(filename, meta)
+        except Exception as e:
+            # The lease runs out and the job runs again.
+            print("Could not store media job result:", filename, e)
+
+    async def _failed(self, filename: str, attempt: int, error: Exception) -> None:
+        message = f'{type(error).__name__}: {error}'
+        if isinstance(error, _PERMANENT) or attempt >= self.attempts:
+            retry_in = None
+            self.failed += 1
+            MEDIA_JOBS.inc('failed')
+            print("Media job failed for good:", filename, message)
+        else:
+            retry_in = min(MEDIA_RETRY_BASE * 2 ** (attempt - 1), MEDIA_RETRY_MAX)
+            self.retried += 1
+            MEDIA_JOBS.inc('retried')
+        try:
+            await self.db.fail_media_job(filename, message, retry_in)
+        except Exception as e:
+            print("Could not record media job failure:", filename, e)
+
+    def stats(self) -> dict:
+        return {'workers': self.workers, 'running': len(self.running), 'done': self.done,
+                'retried': self.retried, 'failed': self.failed, 'attached': self.attached, **self.backlog}
+
+
+def get_media_pipeline(request: Request) -> MediaPipeline:
+    return request.app.state.media
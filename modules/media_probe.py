@@ -0,0 +1,184 @@
+"""
+The CPU-bound half of the media pipeline: runs in the pipeline's worker
+processes, so it imports nothing beyond modules.media and touches no event loop.
+
+probe() hashes a stored file, sniffs its type from its leading bytes, reads
+image dimensions from the headers, and for images Pillow can decode writes a
+thumbnail and a preview next to it.
+"""
+import hashlib
+import os
+import struct
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from modules.media import media_url
+
+
+MEDIA_THUMB_SIZE = int(os.getenv('MEDIA_THUMB_SIZE', 320))
+MEDIA_PREVIEW_SIZE = int(os.getenv('MEDIA_PREVIEW_SIZE', 1280))
+MEDIA_DERIVED_QUALITY = int(os.getenv('MEDIA_DERIVED_QUALITY', 80))
+# Decoding a bigger image risks the worker's memory for a thumbnail nobody needs.
+MEDIA_MAX_PIXELS = int(os.getenv('MEDIA_MAX_PIXELS', 50_000_000))
+
+# What Pillow raises for a file it cannot decode, e.g. a valid header over a corrupt body.
+_UNDECODABLE = (OSError, SyntaxError, ValueError, Image.DecompressionBombError)
+
+_READ_BLOCK = 1024 * 1024
+_SNIFF_BYTES = 64
+
+# (offset, signature, mime), first match wins.
+_SIGNATURES = (
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'fLaC', 'audio/flac'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'\x1aE\xdf\xa3', 'video/webm'),
+)
+
+# ISO base media brands (bytes 8-12 after 'ftyp').
+_BRANDS = {
+    b'heic': 'image/heic', b'heix': 'image/heic', b'mif1': 'image/heif', b'avif': 'image/avif',
+    b'qt  ': 'video/quicktime', b'M4A ': 'audio/mp4',
+}
+
+
+def sniff(head: bytes) -> str:
+    """
+    MIME type from a file's leading bytes; never trusts a client-sent type.
+    """
+    for offset, signature, mime in _SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return mime
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return 'audio/wav'
+    if head[4:8] == b'ftyp':
+        return _BRANDS.get(head[8:12], 'video/mp4')
+    if head[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2'):
+        return 'audio/mpeg'
+    try:
+        # A full read may end inside a character; judge it without the last few bytes.
+        head.decode('utf-8') if len(head) < _SNIFF_BYTES else head[:-4].decode('utf-8')
+    except UnicodeDecodeError:
+        return 'application/octet-stream'
+    return 'text/plain' if b'\x00' not in head else 'application/octet-stream'
+
+
+def _jpeg_size(f) -> Optional[Tuple[int, int]]:
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        if marker[1] in (0xd8, 0x01) or 0xd0 <= marker[1] <= 0xd7:
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        (length,) = struct.unpack('>H', length)
+        # Start-of-frame markers, except DHT (c4), JPG (c8) and DAC (cc).
+        if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def dimensions(f, mime: str) -> Optional[Tuple[int, int]]:
+    """
+    (width, height) read from the image headers, without decoding pixels.
+    """
+    f.seek(0)
+    head = f.read(32)
+    if mime == 'image/png' and len(head) >= 24:
+        return struct.unpack('>II', head[16:24])
+    if mime == 'image/gif' and len(head) >= 10:
+        return struct.unpack('<HH', head[6:10])
+    if mime == 'image/bmp' and len(head) >= 26:
+        width, height = struct.unpack('<ii', head[18:26])
+        return width, abs(height)
+    if mime == 'image/webp' and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b'VP8X':
+            return (int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1)
+        if chunk == b'VP8L':
+            bits = int.from_bytes(head[21:25], 'little')
+            return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == b'VP8 ':
+            width, height = struct.unpack('<HH', head[26:30])
+            return width & 0x3fff, height & 0x3fff
+    if mime == 'image/jpeg':
+        return _jpeg_size(f)
+    return None
+
+
+def _derive(path: str, stem: str, directory: str) -> dict:
+    """
+    Thumbnail and preview JPEGs next to the original; returns their URLs and
+    sizes, or nothing when Pillow cannot decode the image.
+    """
+    try:
+        with Image.open(path) as original:
+            image = ImageOps.exif_transpose(original)
+            image.load()
+    except _UNDECODABLE:
+        # Retrying will not fix the file; keep the metadata probe() already has.
+        return {}
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    derived = {}
+    for name, size in (('preview', MEDIA_PREVIEW_SIZE), ('thumb', MEDIA_THUMB_SIZE)):
+        # Each step shrinks the previous result, the preview, not the full image again.
+        image.thumbnail((size, size))
+        filename = f'{stem}-{name}.jpg'
+        tmp = os.path.join(directory, f'.{filename}.part')
+        image.save(tmp, 'JPEG', quality=MEDIA_DERIVED_QUALITY, optimize=True)
+        os.replace(tmp, os.path.join(directory, filename))
+        derived[name] = media_url(filename)
+        derived[f'{name}_size'] = list(image.size)
+    return derived
+
+
+def probe(path: str) -> dict:
+    """
+    Metadata for the stored file at `path`; writes derived images beside it.
+    Raises on unreadable files and on content that does not match its name.
+    """
+    directory, filename = os.path.split(path)
+    stem = filename.rsplit('.', 1)[0]
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        head = f.read(_SNIFF_BYTES)
+        f.seek(0)
+        while True:
+            block = f.read(_READ_BLOCK)
+            if not block:
+                break
+            digest.update(block)
+            size += len(block)
+        mime = sniff(head)
+        size_wh = dimensions(f, mime) if mime.startswith('image/') else None
+    if digest.hexdigest() != stem:
+        raise ValueError(f'{filename} does not hash to its name')
+    meta = {'mime': mime, 'size': size, 'sha256': stem}
+    if size_wh:
+        meta['width'], meta['height'] = size_wh
+    if (mime in ('image/png', 'image/jpeg', 'image/gif', 'image/bmp', 'image/webp', 'image/tiff')
+            and (not size_wh or size_wh[0] * size_wh[1] <= MEDIA_MAX_PIXELS)):
+        meta.update(_derive(path, stem, directory))
+    return meta
@@ -0,0 +1,138 @@
+import asyncio
+import os
+import uuid
+from typing import Optional, Set
+
+import redis.asyncio as redis
+from fastapi import Request
+
+from modules.storage import ChatStorage
+from modules.lru import MISSING, TTLCache
+
+
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', 100000))
+MEMBERSHIP_CACHE_TTL = float(os.getenv('MEMBERSHIP_CACHE_TTL', 60))
+WARM_CHUNK = 10000
+
+# User ids start at 1, so 0 in a member set marks it as completely loaded.
+READY = 0
+
+# Installs a freshly loaded set only if no join/leave happened while it was being built.
+_SWAP = """
+if (redis.call('GET', KEYS[1]) or '0') == ARGV[1] then
+    redis.call('RENAME', KEYS[2], KEYS[3])
+    return 1
+end
+redis.call('DEL', KEYS[2])
+return 0
+"""
+
+
+class MembershipCache:
+    """
+    Chat membership mirrored into one Redis set per chat, with an in-process
+    cache of (chat_id, user_id) answers in front of it. Joins and leaves must
+    go through join()/leave() to keep both in step with the dialogs table.
+    """
+
+    def __init__(self, db: ChatStorage, r: redis.Redis,
+                 cache_size: int = MEMBERSHIP_CACHE_SIZE, cache_ttl: float = MEMBERSHIP_CACHE_TTL):
+        self.db = db
+        self.r = r
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self._swap = r.register_script(_SWAP)
+        self._warming: Set[int] = set()
+        # Set by the app to broadcast membership changes to other workers.
+        self.invalidator = None
+
+    @staticmethod
+    def _key(chat_id: int) -> str:
+        return f'chat:{chat_id}:members'
+
+    @staticmethod
+    def _version_key(chat_id: int) -> str:
+        return f'chat:{chat_id}:members:v'
+
+    async def is_member(self, chat_id: int, user_id: int) -> bool:
+        cached = self.cache.get((chat_id, user_id))
+        if cached is not MISSING:
+            return cached
+        ready, member = await self.r.smismember(self._key(chat_id), [READY, user_id])
+        if ready:
+            result = bool(member)
+        else:
+            result = await self.db.is_joined(chat_id, user_id)
+            self._schedule_warm(chat_id)
+        self.cache.set((chat_id, user_id), result)
+        return result
+
+    async def join(self, user_id: int, chat_id: int) -> None:
+        await self.db.join_chat(user_id, chat_id)
+        await self._change(chat_id, user_id, joined=True)
+
+    async def leave(self, user_id: int, chat_id: int) -> None:
+        await self.db.leave_chat(user_id, chat_id)
+        await self._change(chat_id, user_id, joined=False)
+
+    async def remove_chat(self, chat_id: int) -> None:
+        await self.r.delete(self._key(chat_id), self._version_key(chat_id))
+        await self._broadcast([chat_id, None])
+
+    async def _change(self, chat_id: int, user_id: int, joined: bool) -> None:
+        async with self.r.pipeline(transaction=True) as pipe:
+            pipe.incr(self._version_key(chat_id))
+            if joined:
+                pipe.sadd(self._key(chat_id), user_id)
+            else:
+                pipe.srem(self._key(chat_id), user_id)
+            await pipe.execute()
+        await self._broadcast([chat_id, user_id])
+
+    async def _broadcast(self, key) -> None:
+        if self.invalidator is not None:
+            await self.invalidator.publish('member', key)
+        else:
+            self.drop(key)
+
+    def drop(self, key: Optional[list]) -> None:
+        """
+        Drops cached answers for [chat_id, user_id], [chat_id, None] for a whole chat,
+        or None for everything.
+        """
+        if key is None:
+            self.cache.clear()
+            return
+        chat_id, user_id = key
+        if user_id is not None:
+            self.cache.pop((chat_id, user_id))
+            return
+        for cached in [k for k in self.cache.keys() if k[0] == chat_id]:
+            self.cache.pop(cached)
+
+    def _schedule_warm(self, chat_id: int) -> None:
+        if chat_id in self._warming:
+            return
+        self._warming.add(chat_id)
+        task = asyncio.create_task(self.warm(chat_id))
+        task.add_done_callback(lambda _: self._warming.discard(chat_id))
+
+    async def warm(self, chat_id: int) -> bool:
+        """
+        Loads a chat's member set from Postgres; returns False if it raced a change.
+        """
+        try:
+            version = (await self.r.get(self._version_key(chat_id)) or b'0').decode()
+            member_ids = await self.db.get_chat_member_ids(chat_id)
+            tmp = f'{self._key(chat_id)}:warm:{uuid.uuid4().hex}'
+            for i in range(0, len(member_ids), WARM_CHUNK):
+                await self.r.sadd(tmp, *member_ids[i:i + WARM_CHUNK])
+            await self.r.sadd(tmp, READY)
+            return bool(await self._swap(keys=[self._version_key(chat_id), tmp, self._key(chat_id)],
+                                         args=[version]))
+        except Exception as e:
+            print("Membership warm failed:", e)
+            return False
+
+
+def get_membership(request: Request) -> MembershipCache:
+    return request.app.state.membership
@@ -0,0 +1,325 @@
+"""
+In-process stand-in for the slice of redis.asyncio.Redis this app uses:
+strings with expiry, sets, streams, pub/sub, pipelines and the app's own Lua
+scripts (re-implemented in Python below). Selected with CHAT_BACKEND=memory.
+Only meant for a single worker: nothing is shared between processes.
+"""
+import asyncio
+import math
+import time
+from typing import Dict, List, Optional, Set
+
+
+def _encode(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    return str(value).encode()
+
+
+def _parse_stream_bound(bound, default_seq: int):
+    bound = _encode(bound).decode()
+    exclusive = bound.startswith('(')
+    if exclusive:
+        bound = bound[1:]
+    ms, _, seq = bound.partition('-')
+    return (int(ms), int(seq) if seq else default_seq), exclusive
+
+
+class MemoryPubSub:
+    def __init__(self, r: "MemoryRedis"):
+        self.r = r
+        self.channels: Set[bytes] = set()
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def subscribe(self, *channels) -> None:
+        for channel in map(_encode, channels):
+            self.channels.add(channel)
+            self.r._subscribers.setdefault(channel, set()).add(self)
+            self.queue.put_nowait({'type': 'subscribe', 'pattern': None, 'channel': channel,
+                                   'data': len(self.channels)})
+
+    async def unsubscribe(self, *channels) -> None:
+        for channel in map(_encode, channels or list(self.channels)):
+            self.channels.discard(channel)
+            subscribers = self.r._subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(self)
+                if not subscribers:
+                    del self.r._subscribers[channel]
+            self.queue.put_nowait({'type': 'unsubscribe', 'pattern': None, 'channel': channel,
+                                   'data': len(self.channels)})
+
+    async def get_message(self, ignore_subscribe_messages: bool = False,
+                          timeout: Optional[float] = 0.0) -> Optional[dict]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                message = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if ignore_subscribe_messages and message['type'] != 'message':
+                continue
+            return message
+
+    async def listen(self):
+        while self.channels:
+            yield await self.queue.get()
+
+    async def aclose(self) -> None:
+        await self.unsubscribe()
+
+
+class MemoryPipeline:
+    """
+    Queues commands (and script calls passed client=pipe) until execute().
+    """
+
+    def __init__(self, r: "MemoryRedis"):
+        self.r = r
+        self._commands = []
+
+    def _queue(self, fn, *args, **kwargs) -> "MemoryPipeline":
+        self._commands.append((fn, args, kwargs))
+        return self
+
+    def __getattr__(self, name):
+        fn = getattr(self.r, name)
+        return lambda *args, **kwargs: self._queue(fn, *args, **kwargs)
+
+    async def execute(self) -> list:
+        commands, self._commands = self._commands, []
+        return [await fn(*args, **kwargs) for fn, args, kwargs in commands]
+
+    async def __aenter__(self) -> "MemoryPipeline":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._commands = []
+
+
+class MemoryScript:
+    def __init__(self, r: "MemoryRedis", source: str):
+        scripts = _scripts()
+        if source not in scripts:
+            raise ValueError('MemoryRedis has no implementation for this script')
+        self.r = r
+        self.run = scripts[source]
+
+    async def __call__(self, keys=None, args=None, client=None):
+        if isinstance(client, MemoryPipeline):
+            return client._queue(self.run, self.r, list(keys or []), list(args or []))
+        return await self.run(self.r, list(keys or []), list(args or []))
+
+
+class MemoryRedis:
+    def __init__(self):
+        self._data: Dict[bytes, object] = {}
+        self._expires: Dict[bytes, float] = {}
+        self._subscribers: Dict[bytes, Set[MemoryPubSub]] = {}
+        self._last_stream_id = (0, 0)
+
+    def _get(self, key):
+        key = _encode(key)
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._data.pop(key, None)
+            del self._expires[key]
+        return self._data.get(key)
+
+    # -------- Strings --------
+    async def get(self, key) -> Optional[bytes]:
+        return self._get(key)
+
+    async def set(self, key, value, ex: Optional[int] = None, px: Optional[int] = None) -> bool:
+        key = _encode(key)
+        self._data[key] = _encode(value)
+        if ex is not None or px is not None:
+            self._expires[key] = time.monotonic() + (ex if ex is not None else px / 1000)
+        else:
+            self._expires.pop(key, None)
+        return True
+
+    async def incr(self, key, amount: int = 1) -> int:
+        value = int(self._get(key) or 0) + amount
+        self._data[_encode(key)] = _encode(value)
+        return value
+
+    async def delete(self, *keys) -> int:
+        deleted = 0
+        for key in map(_encode, keys):
+            if self._get(key) is not None:
+                deleted += 1
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return deleted
+
+    async def exists(self, *keys) -> int:
+        return sum(self._get(key) is not None for key in keys)
+
+    async def rename(self, src, dst) -> bool:
+        value = self._get(src)
+        if value is None:
+            raise KeyError('no such key')
+        await self.delete(src, dst)
+        self._data[_encode(dst)] = value
+        return True
+
+    # -------- Sets --------
+    async def sadd(self, key, *members) -> int:
+        members = set(map(_encode, members))
+        current = self._get(key)
+        if current is None:
+            current = self._data[_encode(key)] = set()
+        added = len(members - current)
+        current |= members
+        return added
+
+    async def srem(self, key, *members) -> int:
+        current = self._get(key)
+        if current is None:
+            return 0
+        members = set(map(_encode, members))
+        removed = len(members & current)
+        current -= members
+        if not current:
+            await self.delete(key)
+        return removed
+
+    async def smismember(self, key, members) -> List[int]:
+        current = self._get(key) or set()
+        return [int(_encode(member) in current) for member in members]
+
+    async def sismember(self, key, member) -> bool:
+        return _encode(member) in (self._get(key) or set())
+
+    async def pexpire(self, key, ms: int) -> bool:
+        if self._get(key) is None:
+            return False
+        self._expires[_encode(key)] = time.monotonic() + int(ms) / 1000
+        return True
+
+    # -------- Sorted sets --------
+    async def zadd(self, key, mapping: dict) -> int:
+        current = self._get(key)
+        if current is None:
+            current = self._data[_encode(key)] = {}
+        added = 0
+        for member, score in mapping.items():
+            added += _encode(member) not in current
+            current[_encode(member)] = float(score)
+        return added
+
+    async def zrem(self, key, *members) -> int:
+        current = self._get(key) or {}
+        removed = sum(current.pop(_encode(member), None) is not None for member in members)
+        if not current:
+            await self.delete(key)
+        return removed
+
+    async def zremrangebyscore(self, key, low, high) -> int:
+        current = self._get(key) or {}
+        low = float('-inf') if low == '-inf' else float(low)
+        high = float('inf') if high == '+inf' else float(high)
+        stale = [member for member, score in current.items() if low <= score <= high]
+        for member in stale:
+            del current[member]
+        return len(stale)
+
+    async def zcard(self, key) -> int:
+        return len(self._get(key) or {})
+
+    # -------- Streams --------
+    async def xadd(self, key, fields: dict, maxlen: Optional[int] = None, approximate: bool = True) -> bytes:
+        ms = int(time.time() * 1000)
+        last_ms, last_seq = self._last_stream_id
+        stream_id = (ms, 0) if ms > last_ms else (last_ms, last_seq + 1)
+        self._last_stream_id = stream_id
+        entries = self._get(key)
+        if entries is None:
+            entries = self._data[_encode(key)] = []
+        entries.append((stream_id, {_encode(k): _encode(v) for k, v in fields.items()}))
+        if maxlen is not None and len(entries) > int(maxlen):
+            del entries[:len(entries) - int(maxlen)]
+        return b'%d-%d' % stream_id
+
+    async def xrange(self, key, min='-', max='+') -> list:
+        entries = self._get(key) or []
+        low, low_exclusive = ((0, 0), False) if min == '-' else _parse_stream_bound(min, 0)
+        high, high_exclusive = ((float('inf'), 0), False) if max == '+' else _parse_stream_bound(max, 2 ** 64)
+        return [
+            (b'%d-%d' % stream_id, dict(fields)) for stream_id, fields in entries
+            if (low < stream_id if low_exclusive else low <= stream_id)
+            and (stream_id < high if high_exclusive else stream_id <= high)
+        ]
+
+    # -------- Pub/sub, pipelines, scripts --------
+    async def publish(self, channel, message) -> int:
+        channel, message = _encode(channel), _encode(message)
+        subscribers = list(self._subscribers.get(channel, ()))
+        for pubsub in subscribers:
+            pubsub.queue.put_nowait({'type': 'message', 'pattern': None, 'channel': channel, 'data': message})
+        return len(subscribers)
+
+    def pubsub(self) -> MemoryPubSub:
+        return MemoryPubSub(self)
+
+    def pipeline(self, transaction: bool = True) -> MemoryPipeline:
+        return MemoryPipeline(self)
+
+    def register_script(self, source: str) -> MemoryScript:
+        return MemoryScript(self, source)
+
+    async def ping(self) -> bool:
+        return True
+
+    async def aclose(self) -> None:
+        pass
+
+
+async def _append(r: MemoryRedis, keys: list, args: list) -> bytes:
+    maxlen, seq, data, channel = args
+    stream_id = await r.xadd(keys[0], {'m': seq, 'd': data}, maxlen=maxlen)
+    await r.publish(channel, b' '.join((stream_id, _encode(seq), _encode(data))))
+    return stream_id
+
+
+async def _swap(r: MemoryRedis, keys: list, args: list) -> int:
+    if (await r.get(keys[0]) or b'0') == _encode(args[0]):
+        await r.rename(keys[1], keys[2])
+        return 1
+    await r.delete(keys[1])
+    return 0
+
+
+async def _take(r: MemoryRedis, keys: list, args: list) -> list:
+    rate, burst, want = float(args[0]), float(args[1]), int(args[2])
+    now = int(time.time() * 1000)
+    state = r._get(keys[0])
+    tokens, ts = state if state is not None else (burst, now)
+    tokens = min(burst, tokens + max(now - ts, 0) * rate / 1000)
+    granted = min(want, math.floor(tokens))
+    tokens -= granted
+    r._data[_encode(keys[0])] = (tokens, now)
+    r._expires[_encode(keys[0])] = time.monotonic() + burst / rate + 1
+    return [granted, math.ceil((1 - tokens) * 1000 / rate) if tokens < 1 else 0]
+
+
+async def _open_stream(r: MemoryRedis, keys: list, args: list) -> int:
+    now, lifetime, slot_id, per_user = int(args[0]), int(args[1]), args[2], int(args[3])
+    await r.zremrangebyscore(keys[0], '-inf', now - lifetime)
+    if await r.zcard(keys[0]) >= per_user:
+        return 0
+    await r.zadd(keys[0], {slot_id: now})
+    await r.pexpire(keys[0], lifetime)
+    return 1
+
+
+def _scripts() -> dict:
+    # Imported lazily: these modules import the Redis connection this stand-in provides.
+    from modules.admission import _OPEN_STREAM, _TAKE
+    from modules.events import _APPEND
+    from modules.membership import _SWAP
+    return {_APPEND: _append, _SWAP: _swap, _TAKE: _take, _OPEN_STREAM: _open_stream}
@@ -0,0 +1,421 @@
+"""
+ChatStorage kept in process memory, for load tests and local runs without
+Postgres. Mirrors the Postgres behaviour the routes rely on (unique names,
+foreign keys, read markers, change_seq, tombstones) but not its performance
+or durability. Selected with CHAT_BACKEND=memory.
+"""
+import bisect
+import datetime
+import itertools
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+from asyncpg.exceptions import ForeignKeyViolationError, UniqueViolationError
+
+from modules.events import DELETED, EDITED
+from modules.media import media_filename, media_url
+from modules.metrics import timed_methods
+from modules.storage import ChatStorage
+
+
+PUBLIC_USER_FIELDS = ('id', 'username', 'name', 'profile', 'bio', 'status')
+
+_WORD = re.compile(r'\w+')
+
+
+def _now() -> datetime.datetime:
+    # Postgres CURRENT_TIMESTAMP into a TIMESTAMP column: local time, no tzinfo.
+    return datetime.datetime.now()
+
+
+def _terms(text: str) -> List[str]:
+    return _WORD.findall(text.lower())
+
+
+@timed_methods
+class MemoryChatStorage(ChatStorage):
+    def __init__(self):
+        super().__init__()
+        self._user_ids = itertools.count(1)
+        self._chat_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._change_seq = itertools.count(1)
+        self.users: Dict[int, dict] = {}
+        self.usernames: Dict[str, int] = {}
+        self.chats: Dict[int, dict] = {}
+        self.chatnames: Dict[str, int] = {}
+        self.rules: Dict[Tuple[int, int], dict] = {}
+        # chat_id -> user_id -> {last_read_id, read_count}
+        self.dialogs: Dict[int, Dict[int, dict]] = {}
+        self.activity: Dict[int, dict] = {}
+        self.messages: Dict[int, dict] = {}
+        # chat_id -> message ids, ascending
+        self.chat_messages: Dict[int, List[int]] = {}
+        self.deletions: Dict[int, dict] = {}
+        # filename -> job row; run_after is time.monotonic().
+        self.media_jobs: Dict[str, dict] = {}
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def pool_stats(self) -> dict:
+        return {'backend': 'memory', 'users': len(self.users), 'chats': len(self.chats),
+                'messages': len(self.messages)}
+
+    # -------- Users --------
+    async def create_user(self, username: str, name: str, password_hash: str,
+                          profile: Optional[str] = None, bio: Optional[str] = None,
+                          status: Optional[str] = None) -> int:
+        if username in self.usernames:
+            raise UniqueViolationError('duplicate key value violates unique constraint "users_username_key"')
+        user_id = next(self._user_ids)
+        self.users[user_id] = dict(id=user_id, username=username, name=name, password=password_hash,
+                                   profile=profile, bio=bio, status=status)
+        self.usernames[username] = user_id
+        return user_id
+
+    async def get_user_by_username(self, username: str) -> Optional[dict]:
+        user_id = self.usernames.get(username)
+        return dict(self.users[user_id]) if user_id is not None else None
+
+    async def get_user_by_id(self, user_id: int) -> Optional[dict]:
+        user = self.users.get(user_id)
+        return dict(user) if user is not None else None
+
+    async def login(self, username: str, password_hash: str) -> Optional[int]:
+        user = self.users.get(self.usernames.get(username))
+        if user is not None and user['password'] == password_hash:
+            return user['id']
+        return None
+
+    async def update_user_profile(self, user_id: int, **kwargs) -> None:
+        allowed = {"name", "profile", "bio", "status", "password"}
+        user = self.users.get(user_id)
+        if user is not None:
+            user.update((k, v) for k, v in kwargs.items() if k in allowed)
+            await self.invalidate_profile(user_id)
+
+    async def load_profiles(self, user_ids: List[int]) -> List[dict]:
+        return [{k: self.users[user_id][k] for k in PUBLIC_USER_FIELDS} for user_id in user_ids
+                if user_id in self.users]
+
+    # -------- Chats --------
+    async def create_chat(self, chatname: str, chat_title: str, chat_about: str, owner_id: int) -> int:
+        if chatname in self.chatnames:
+            raise UniqueViolationError('duplicate key value violates unique constraint "chats_chatname_key"')
+        if owner_id not in self.users:
+            raise ForeignKeyViolationError('insert or update on table "chats" violates foreign key constraint')
+        chat_id = next(self._chat_ids)
+        self.chats[chat_id] = dict(id=chat_id, chatname=chatname, chat_title=chat_title,
+                                   chat_about=chat_about, owner=owner_id)
+        self.chatnames[chatname] = chat_id
+        self.dialogs[chat_id] = {}
+        self.chat_messages[chat_id] = []
+        return chat_id
+
+    async def get_chat_by_name(self, chatname: str) -> Optional[dict]:
+        chat_id = self.chatnames.get(chatname)
+        return dict(self.chats[chat_id]) if chat_id is not None else None
+
+    async def get_chat_by_id(self, chatid: int) -> Optional[dict]:
+        chat = self.chats.get(chatid)
+        return dict(chat) if chat is not None else None
+
+    async def update_chat_info(self, chat_id: int, **kwargs) -> None:
+        allowed = {"chat_title", "chat_about", "owner"}
+        chat = self.chats.get(chat_id)
+        if chat is not None:
+            chat.update((k, v) for k, v in kwargs.items() if k in allowed)
+        await self.invalidate_chat(chat_id)
+
+    async def remove_group(self, chat_id: int) -> None:
+        chat = self.chats.pop(chat_id, None)
+        if chat is not None:
+            del self.chatnames[chat['chatname']]
+            for message_id in self.chat_messages.pop(chat_id):
+                del self.messages[message_id]
+            self.dialogs.pop(chat_id)
+            self.activity.pop(chat_id, None)
+            for key in [key for key in self.rules if key[1] == chat_id]:
+                del self.rules[key]
+            for message_id in [m for m, row in self.deletions.items() if row['chat_id'] == chat_id]:
+                del self.deletions[message_id]
+        await self.invalidate_chat(chat_id)
+        await self._share_recent(['drop', chat_id])
+
+    # -------- Chat Rules --------
+    async def set_chat_rules(self, user_id: int, chat_id: int,
+                             can_ban_user: bool = False, can_remove_message: bool = False,
+                             can_send_message: bool = True, can_send_media: bool = True) -> None:
+        await self.set_chat_rules_bulk(chat_id, [user_id], can_ban_user, can_remove_message,
+                                       can_send_message, can_send_media)
+
+    async def get_chat_rules(self, user_id: int, chat_id: int) -> Optional[dict]:
+        rules = self.rules.get((user_id, chat_id))
+        return dict(rules) if rules is not None else None
+
+    async def set_chat_rules_bulk(self, chat_id: int, user_ids: List[int],
+                                  can_ban_user: bool = False, can_remove_message: bool = False,
+                                  can_send_message: bool = True, can_send_media: bool = True) -> None:
+        if chat_id not in self.chats:
+            raise ForeignKeyViolationError('insert or update on table "chat_rules" violates foreign key constraint')
+        for user_id in user_ids:
+            self.rules[(user_id, chat_id)] = dict(
+                user_id=user_id, chat_id=chat_id, can_ban_user=can_ban_user,
+                can_remove_message=can_remove_message, can_send_message=can_send_message,
+                can_send_media=can_send_media,
+            )
+        await self.invalidate_rules(chat_id, list(user_ids))
+
+    # -------- Dialogs (memberships) --------
+    async def join_chat(self, user_id: int, chat_id: int) -> None:
+        if chat_id not in self.chats or user_id not in self.users:
+            raise ForeignKeyViolationError('insert or update on table "dialogs" violates foreign key constraint')
+        activity = self.activity.get(chat_id, {})
+        self.dialogs[chat_id].setdefault(user_id, dict(last_read_id=activity.get('last_message_id', 0),
+                                                       read_count=activity.get('message_count', 0)))
+
+    async def leave_chat(self, user_id: int, chat_id: int) -> None:
+        self.dialogs.get(chat_id, {}).pop(user_id, None)
+
+    async def get_user_chats(self, user_id: int) -> List[dict]:
+        chats = []
+        for chat_id, members in self.dialogs.items():
+            dialog = members.get(user_id)
+            if dialog is None:
+                continue
+            activity = self.activity.get(chat_id, {})
+            last = self.messages.get(activity.get('last_message_id'))
+            chats.append(dict(
+                self.chats[chat_id],
+                last_activity_at=activity.get('last_activity_at'),
+                unread_count=max(activity.get('message_count', 0) - dialog['read_count'], 0),
+                last_read_id=dialog['last_read_id'],
+                last_message_id=last and last['id'],
+                last_message_sender_id=last and last['sender_id'],
+                last_message_content=last and last['content'],
+                last_message_is_media=last and last['is_media'],
+                last_message_sent_at=last and last['sent_at'],
+            ))
+        # Most recently active first, chats without messages last.
+        chats.sort(key=lambda chat: (chat['last_activity_at'] is not None,
+                                     chat['last_activity_at'] or datetime.datetime.min, chat['id']), reverse=True)
+        return chats
+
+    async def mark_read(self, user_id: int, chat_id: int, message_id: Optional[int] = None) -> bool:
+        dialog = self.dialogs.get(chat_id, {}).get(user_id)
+        activity = self.activity.get(chat_id)
+        if dialog is None or activity is None:
+            return False
+        target = activity['last_message_id'] if message_id is None else message_id
+        if target is None or dialog['last_read_id'] >= target:
+            return False
+        ids = self.chat_messages[chat_id]
+        dialog['last_read_id'] = target
+        dialog['read_count'] = activity['message_count'] - (len(ids) - bisect.bisect_right(ids, target))
+        return True
+
+    async def is_joined(self, chat_id: int, user_id: int) -> bool:
+        return user_id in self.dialogs.get(chat_id, {})
+
+    async def get_chat_users(self, chat_id: int) -> List[dict]:
+        return [{k: self.users[user_id][k] for k in PUBLIC_USER_FIELDS}
+                for user_id in self.dialogs.get(chat_id, {})]
+
+    async def get_chat_members(self, chat_id: int, after_id: int = 0, count: int = 100) -> List[dict]:
+        member_ids = sorted(user_id for user_id in self.dialogs.get(chat_id, {}) if user_id > after_id)
+        return [{k: self.users[user_id][k] for k in PUBLIC_USER_FIELDS} for user_id in member_ids[:count]]
+
+    async def get_chat_member_ids(self, chat_id: int) -> List[int]:
+        return list(self.dialogs.get(chat_id, {}))
+
+    # -------- Messages --------
+    async def send_message(self, chat_id: int, sender_id: int, content: str,
+                           reply_to: Optional[int] = None, is_media: bool = False) -> int:
+        return (await self.send_messages([(chat_id, sender_id, content, reply_to, is_media)]))[0]
+
+    async def send_messages(self, rows: List[tuple]) -> List[int]:
+        for chat_id, sender_id, *_ in rows:
+            if chat_id not in self.chats or sender_id not in self.users:
+                raise ForeignKeyViolationError('insert or update on table "messages" violates foreign key constraint')
+        inserted = []
+        for chat_id, sender_id, content, reply_to, is_media in rows:
+            job = self.media_jobs.get(media_filename(content)) if is_media else None
+            row = dict(id=next(self._message_ids), chat_id=chat_id, sender_id=sender_id, content=content,
+                       reply_to=reply_to, is_media=is_media, sent_at=_now(), edited_at=None,
+                       change_seq=next(self._change_seq),
+                       media=job['meta'] if job and job['state'] == 'done' else None)
+            self.messages[row['id']] = row
+            self.chat_messages[chat_id].append(row['id'])
+            activity = self.activity.setdefault(chat_id, dict(last_message_id=0, last_activity_at=None,
+                                                              message_count=0))
+            activity['last_message_id'] = row['id']
+            activity['last_activity_at'] = row['sent_at']
+            activity['message_count'] += 1
+            dialog = self.dialogs[chat_id].get(sender_id)
+            if dialog is not None:
+                dialog['last_read_id'] = row['id']
+                dialog['read_count'] = activity['message_count']
+            inserted.append(dict(row))
+        await self._emit_created(inserted)
+        return [row['id'] for row in inserted]
+
+    async def get_last_messages(self, chat_id: int, count: int = 20,
+                                before_id: Optional[int] = None,
+                                after_id: Optional[int] = None) -> List[dict]:
+        ids = self.chat_messages.get(chat_id, [])
+        if after_id is not None:
+            start = bisect.bisect_right(ids, after_id)
+            page = ids[start:start + count]
+        else:
+            end = len(ids) if before_id is None else bisect.bisect_left(ids, before_id)
+            page = ids[max(end - count, 0):end]
+        return [dict(self.messages[message_id]) for message_id in reversed(page)]
+
+    def _changes(self, chat_since: Dict[int, int], count: int, cutoff: Optional[datetime.datetime]):
+        messages = [dict(row) for row in self.messages.values()
+                    if row['chat_id'] in chat_since and row['change_seq'] > chat_since[row['chat_id']]
+                    and (cutoff is None or (row['edited_at'] or row['sent_at']) < cutoff)]
+        deletions = [dict(row) for row in self.deletions.values()
+                     if row['chat_id'] in chat_since and row['change_seq'] > chat_since[row['chat_id']]
+                     and (cutoff is None or row['deleted_at'] < cutoff)]
+        messages.sort(key=lambda row: row['change_seq'])
+        deletions.sort(key=lambda row: row['change_seq'])
+        return messages[:count], deletions[:count]
+
+    async def get_changes(self, user_id: int, since: int = 0, last_seen: Optional[dict] = None,
+                          count: int = 500, settle: float = 1.0):
+        if last_seen:
+            chat_since = {}
+            for chat_id, last_id in last_seen.items():
+                if user_id not in self.dialogs.get(chat_id, {}):
+                    continue
+                ids = self.chat_messages[chat_id]
+                seen = (self.messages[message_id] for message_id in reversed(ids[:bisect.bisect_right(ids, last_id)]))
+                chat_since[chat_id] = next((row['change_seq'] for row in seen if row['edited_at'] is None), 0)
+        else:
+            chat_since = {chat_id: since for chat_id, members in self.dialogs.items() if user_id in members}
+        return self._changes(chat_since, count, _now() - datetime.timedelta(seconds=settle))
+
+    async def get_chat_changes(self, chat_id: int, since: int, count: int = 500):
+        return self._changes({chat_id: since}, count, None)
+
+    async def search_messages(self, query: str, chat_id: Optional[int] = None, user_id: Optional[int] = None,
+                              count: int = 20, after: Optional[tuple] = None) -> List[dict]:
+        """
+        Every query word must appear; rank is the share of the message's words
+        that match. Good enough to exercise the route, not websearch_to_tsquery.
+        """
+        wanted = set(_terms(query))
+        if not wanted:
+            return []
+        if chat_id is not None:
+            chat_ids = [chat_id]
+        else:
+            chat_ids = [c for c, members in self.dialogs.items() if user_id in members]
+        hits = []
+        for c in chat_ids:
+            for message_id in self.chat_messages.get(c, []):
+                row = self.messages[message_id]
+                if row['is_media']:
+                    continue
+                terms = _terms(row['content'])
+                if wanted.issubset(terms):
+                    rank = sum(term in wanted for term in terms) / len(terms)
+                    if after is None or (rank, message_id) < tuple(after):
+                        hits.append((rank, message_id))
+        hits.sort(reverse=True)
+        return [dict(self.messages[message_id], rank=rank) for rank, message_id in hits[:count]]
+
+    def _delete(self, message_id: int) -> dict:
+        row = self.messages.pop(message_id)
+        chat_id = row['chat_id']
+        ids = self.chat_messages[chat_id]
+        ids.pop(bisect.bisect_left(ids, message_id))
+        for dialog in self.dialogs[chat_id].values():
+            if dialog['last_read_id'] >= message_id:
+                dialog['read_count'] -= 1
+        activity = self.activity[chat_id]
+        activity['message_count'] -= 1
+        if activity['last_message_id'] == message_id:
+            below = bisect.bisect_left(ids, message_id)
+            activity['last_message_id'] = ids[below - 1] if below else None
+        tombstone = dict(message_id=message_id, chat_id=chat_id, change_seq=next(self._change_seq),
+                         deleted_at=_now())
+        self.deletions[message_id] = tombstone
+        return dict(tombstone)
+
+    async def delete_message(self, message_id: int, user_id: int) -> bool:
+        row = self.messages.get(message_id)
+        if row is None or row['sender_id'] != user_id:
+            return False
+        await self._emit(DELETED, [self._delete(message_id)])
+        return True
+
+    async def remove_message(self, message_id: int, chat_id: int) -> bool:
+        row = self.messages.get(message_id)
+        if row is None or row['chat_id'] != chat_id:
+            return False
+        await self._emit(DELETED, [self._delete(message_id)])
+        return True
+
+    async def edit_message(self, message_id: int, user_id: int, new_content: str) -> bool:
+        row = self.messages.get(message_id)
+        if row is None or row['sender_id'] != user_id:
+            return False
+        row.update(content=new_content, edited_at=_now(), change_seq=next(self._change_seq))
+        await self._emit(EDITED, [dict(row)])
+        return True
+
+    # -------- Media jobs --------
+    async def enqueue_media(self, filename: str, size: int) -> None:
+        job = self.media_jobs.get(filename)
+        if job is None or job['state'] == 'failed':
+            self.media_jobs[filename] = dict(filename=filename, size=size, state='queued', attempts=0,
+                                             run_after=time.monotonic(), error=None, meta=None,
+                                             created_at=_now(), finished_at=None)
+
+    async def claim_media_jobs(self, count: int, lease: float) -> List[dict]:
+        now = time.monotonic()
+        due = sorted((job for job in self.media_jobs.values() if job['state'] == 'queued' and job['run_after'] <= now),
+                     key=lambda job: job['run_after'])[:count]
+        for job in due:
+            job['attempts'] += 1
+            job['run_after'] = now + lease
+        return [{k: job[k] for k in ('filename', 'size', 'attempts')} for job in due]
+
+    async def finish_media_job(self, filename: str, meta: dict) -> int:
+        self.media_jobs[filename].update(state='done', meta=meta, error=None, finished_at=_now())
+        url = media_url(filename)
+        updated = []
+        for row in self.messages.values():
+            if row['is_media'] and row['media'] is None and row['content'] == url:
+                row.update(media=meta, change_seq=next(self._change_seq))
+                updated.append(dict(row))
+        if updated:
+            await self._emit(EDITED, updated)
+        return len(updated)
+
+    async def fail_media_job(self, filename: str, error: str, retry_in: Optional[float]) -> None:
+        job = self.media_jobs[filename]
+        if retry_in is None:
+            job.update(state='failed', error=error, finished_at=_now())
+        else:
+            job.update(error=error, run_after=time.monotonic() + retry_in)
+
+    async def get_media_job(self, filename: str) -> Optional[dict]:
+        job = self.media_jobs.get(filename)
+        if job is None:
+            return None
+        # Same shape as the media_jobs row.
+        return dict(job, run_after=_now() + datetime.timedelta(seconds=job['run_after'] - time.monotonic()))
+
+    async def media_backlog(self) -> dict:
+        now = time.monotonic()
+        queued = [job['run_after'] for job in self.media_jobs.values() if job['state'] == 'queued']
+        due = [run_after for run_after in queued if run_after <= now]
+        return {'queued': len(queued), 'due': len(due), 'oldest_due_s': now - min(due) if due else 0.0}
@@ -0,0 +1,256 @@
+"""
+Minimal Prometheus instrumentation: counters, gauges and histograms with
+labels, rendered in the text exposition format on GET /metrics, plus the
+slow-query log. Recording is a perf_counter pair, a dict lookup and a bisect,
+so it stays on in production.
+
+SLOW_QUERY_MS sets the slow-query threshold for every storage method (0 turns
+the log off); SLOW_QUERY_OVERRIDES sets per-method ones, e.g.
+"get_changes=500,search_messages=250".
+"""
+import abc
+import bisect
+import functools
+import inspect
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 200))
+SLOW_QUERY_OVERRIDES = {
+    name.strip(): float(ms)
+    for name, _, ms in (item.partition('=') for item in os.getenv('SLOW_QUERY_OVERRIDES', '').split(','))
+    if name.strip()
+}
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+slow_log = logging.getLogger('chat.slow_query')
+
+_REGISTRY: List["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(abc.ABC):
+    kind = ''
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        _REGISTRY.append(self)
+
+    @abc.abstractmethod
+    def samples(self) -> List[str]: ...
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in self.values.items()]
+
+
+class Gauge(_Metric):
+    """
+    Either set() directly or built with `collect`, a callable returning
+    {label values tuple: value} read at scrape time.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[tuple, float]]] = None):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[tuple, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, *labels) -> None:
+        self.values[labels] = value
+
+    def samples(self) -> List[str]:
+        values = self.values
+        if self.collect is not None:
+            try:
+                values = self.collect()
+            except Exception as e:
+                slow_log.warning('collecting %s failed: %s', self.name, e)
+                values = {}
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in values.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum]
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in _REGISTRY) + '\n'
+
+
+STORAGE_SECONDS = Histogram('chat_storage_call_seconds', 'Storage method latency.', ['method'])
+STORAGE_ERRORS = Counter('chat_storage_errors_total', 'Storage method calls that raised.', ['method', 'error'])
+SLOW_QUERIES = Counter('chat_storage_slow_calls_total', 'Storage calls over the slow-query threshold.', ['method'])
+POOL_WAIT_SECONDS = Histogram('chat_pool_acquire_wait_seconds', 'Time spent waiting for a pooled connection.')
+POOL_TIMEOUTS = Counter('chat_pool_acquire_timeouts_total', 'Pool acquires that timed out.')
+REDIS_PUBLISH_SECONDS = Histogram('chat_redis_publish_seconds', 'Redis publish round trip.', ['kind'])
+HTTP_SECONDS = Histogram('chat_http_request_seconds', 'Time to response start per route.',
+                         ['method', 'route', 'status'])
+
+
+def _slow_threshold(method: str) -> float:
+    return SLOW_QUERY_OVERRIDES.get(method, SLOW_QUERY_MS) / 1000
+
+
+def timed_methods(cls):
+    """
+    Class decorator timing every public coroutine method into
+    chat_storage_call_seconds{method=...} and the slow-query log.
+    """
+    for name, fn in list(vars(cls).items()):
+        if name.startswith('_') or not inspect.iscoroutinefunction(fn):
+            continue
+        setattr(cls, name, _timed(name, fn))
+    return cls
+
+
+def _redact(value):
+    """
+    What the slow-query log may show of an argument: numbers and flags (ids,
+    counts, cursors) as they are, anything else only by type and size, so
+    password hashes and message content never reach the logs.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    try:
+        return f'<{type(value).__name__} len={len(value)}>'
+    except TypeError:
+        return f'<{type(value).__name__}>'
+
+
+def _timed(method: str, fn):
+    threshold = _slow_threshold(method)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            STORAGE_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            STORAGE_SECONDS.observe(elapsed, method)
+            if threshold and elapsed >= threshold:
+                SLOW_QUERIES.inc(method)
+                slow_log.warning('slow %s: %.1fms args=%.200r kwargs=%.200r', method, elapsed * 1e3,
+                                 [_redact(arg) for arg in args[1:]],
+                                 {key: _redact(value) for key, value in kwargs.items()})
+    return wrapper
+
+
+def _route_template(scope: Scope) -> str:
+    # Newer FastAPI keeps the prefixed template on the effective route context;
+    # older versions put the prefixed route itself in scope['route'].
+    fastapi_scope = scope.get('fastapi')
+    context = fastapi_scope.get('effective_route_context') if isinstance(fastapi_scope, dict) else None
+    for route in (context, scope.get('route')):
+        template = getattr(route, 'path_format', None)
+        if template:
+            return template
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording each request's time to response start,
+    labelled by the matched route template so ids in paths do not explode
+    the label set. Streams are measured to their first byte, not their end.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        started = False
+
+        def observe(status: int) -> None:
+            HTTP_SECONDS.observe(time.perf_counter() - start, scope['method'], _route_template(scope), status)
+
+        async def timed_send(message: Message) -> None:
+            nonlocal started
+            if message['type'] == 'http.response.start':
+                started = True
+                observe(message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        except Exception:
+            # The error middleware outside this one answers 500.
+            if not started:
+                observe(500)
+            raise
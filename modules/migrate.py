@@ -0,0 +1,53 @@
+"""
+Applies migrations/*.sql in filename order and records them in schema_migrations.
+
+    python -m modules.migrate
+"""
+import asyncio
+import os
+from typing import List
+
+from modules.db import AsyncChatDB
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+
+async def migrate(db: AsyncChatDB) -> List[str]:
+    """
+    Returns the names of the migrations applied by this call.
+    Each file runs outside a transaction so it may use CREATE INDEX CONCURRENTLY.
+    """
+    applied = []
+    async with db.acquire() as conn:
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        done = {row['name'] for row in await conn.fetch("SELECT name FROM schema_migrations")}
+        for name in sorted(os.listdir(MIGRATIONS_DIR)):
+            if not name.endswith('.sql') or name in done:
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, name)) as f:
+                await conn.execute(f.read())
+            await conn.execute("INSERT INTO schema_migrations(name) VALUES ($1)", name)
+            applied.append(name)
+    return applied
+
+
+async def main():
+    db = AsyncChatDB(min_size=1, max_size=1)
+    await db.connect()
+    try:
+        for name in await migrate(db):
+            print('applied', name)
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
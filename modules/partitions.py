@@ -0,0 +1,229 @@
+"""
+Upkeep of the time-range partitions of messages (migrations/0006): creates
+partitions MESSAGE_PARTITIONS_AHEAD intervals ahead and archives partitions
+older than MESSAGE_ARCHIVE_AFTER_DAYS to segment files (modules/archive.py).
+
+Archiving takes two passes so every worker has loaded a segment before its
+partition disappears: one pass writes the segment and records it in
+message_partitions, and a pass at least MESSAGE_ARCHIVE_GRACE seconds later
+detaches and drops the partition. If its rows changed in between, the segment
+is written again instead. Archived messages can no longer be edited, deleted
+or searched.
+
+One worker at a time does the upkeep, under an advisory lock; every worker
+reloads the archive index on each pass. MESSAGE_ARCHIVE_DIR must be the same
+directory for all of them.
+
+    python -m modules.partitions    # a single pass, e.g. from cron
+"""
+import asyncio
+import datetime
+import os
+import time
+from typing import List, Optional
+
+import asyncpg
+
+from modules.archive import ARCHIVE_DIR, Archive, SegmentWriter
+from modules.db import AsyncChatDB
+
+
+# 'day', 'week' or 'month'
+PARTITION_INTERVAL = os.getenv('MESSAGE_PARTITION_INTERVAL', 'month')
+PARTITIONS_AHEAD = int(os.getenv('MESSAGE_PARTITIONS_AHEAD', 3))
+# 0 keeps every partition live.
+ARCHIVE_AFTER_DAYS = float(os.getenv('MESSAGE_ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_GRACE = float(os.getenv('MESSAGE_ARCHIVE_GRACE', 900))
+PARTITION_CHECK_INTERVAL = float(os.getenv('MESSAGE_PARTITION_CHECK_INTERVAL', 300))
+# Rows handed to the segment writer thread at a time.
+ARCHIVE_BATCH = 1000
+
+_LOCK_KEY = 0x6d736770
+
+
+def next_bound(ts: datetime.datetime, interval: str = PARTITION_INTERVAL) -> datetime.datetime:
+    """
+    The first interval boundary after ts.
+    """
+    day = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'day':
+        return day + datetime.timedelta(days=1)
+    if interval == 'week':
+        return day + datetime.timedelta(days=7 - day.weekday())
+    if interval == 'month':
+        month = day.replace(day=1)
+        return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+    raise ValueError(f'unknown partition interval {interval!r}')
+
+
+def _add_rows(writer: SegmentWriter, rows: list) -> None:
+    for row in rows:
+        writer.add(row)
+
+
+class PartitionMaintainer:
+    def __init__(self, db: AsyncChatDB, archive: Optional[Archive] = None, archive_dir: str = ARCHIVE_DIR,
+                 interval: str = PARTITION_INTERVAL, ahead: int = PARTITIONS_AHEAD,
+                 archive_after_days: float = ARCHIVE_AFTER_DAYS, grace: float = ARCHIVE_GRACE,
+                 check_interval: float = PARTITION_CHECK_INTERVAL):
+        next_bound(datetime.datetime.now(), interval)
+        self.db = db
+        self.archive = archive or Archive()
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.ahead = ahead
+        self.archive_after_days = archive_after_days
+        # Every worker reloads the index once per check_interval; give them two chances.
+        self.grace = max(grace, 2 * check_interval)
+        self.check_interval = check_interval
+        self.created = 0
+        self.archived = 0
+        self.dropped = 0
+        self.rewritten = 0
+        self._task: Optional[asyncio.Task] = None
+        db.archive = self.archive
+
+    async def start(self) -> None:
+        await self.run_once()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.run_once()
+
+    async def run_once(self) -> None:
+        try:
+            async with self.db.acquire() as conn:
+                if await conn.fetchval("SELECT pg_try_advisory_lock($1)", _LOCK_KEY):
+                    try:
+                        await self.ensure_partitions(conn)
+                        await self.archive_partitions(conn)
+                    finally:
+                        await conn.execute("SELECT pg_advisory_unlock($1)", _LOCK_KEY)
+                rows = await conn.fetch(
+                    "SELECT name, segment FROM message_partitions WHERE segment IS NOT NULL ORDER BY ends"
+                )
+            await self.archive.sync({row['name']: row['segment'] for row in rows})
+        except Exception as e:
+            print("Partition maintenance failed:", e)
+
+    async def ensure_partitions(self, conn: asyncpg.Connection) -> List[str]:
+        """
+        Creates the partitions missing between the newest one and `ahead`
+        intervals from now; returns their names.
+        """
+        ends, now = await conn.fetchrow("SELECT max(ends), LOCALTIMESTAMP FROM message_partitions")
+        if ends is None:
+            return []
+        horizon = now
+        for _ in range(self.ahead):
+            horizon = next_bound(horizon, self.interval)
+        created = []
+        while ends < horizon:
+            starts, ends = ends, next_bound(ends, self.interval)
+            name = f"messages_p{starts:%Y%m%d}"
+            async with conn.transaction():
+                await conn.execute(
+                    f"CREATE TABLE {name} PARTITION OF messages (PRIMARY KEY (id)) "
+                    f"FOR VALUES FROM ('{starts}') TO ('{ends}')"
+                )
+                await conn.execute("INSERT INTO message_partitions(name, starts, ends) VALUES ($1, $2, $3)",
+                                   name, starts, ends)
+            created.append(name)
+        self.created += len(created)
+        return created
+
+    async def archive_partitions(self, conn: asyncpg.Connection) -> None:
+        if not self.archive_after_days:
+            return
+        due = await conn.fetch(
+            """
+            SELECT *, archived_at <= LOCALTIMESTAMP - make_interval(secs => $2) AS settled
+            FROM message_partitions
+            WHERE dropped_at IS NULL AND ends <= LOCALTIMESTAMP - make_interval(days => $1)
+            ORDER BY ends
+            """,
+            int(self.archive_after_days), self.grace
+        )
+        for partition in due:
+            if partition['segment'] is None:
+                await self._write_segment(conn, partition['name'])
+            elif partition['settled']:
+                await self._drop(conn, partition)
+
+    async def _write_segment(self, conn: asyncpg.Connection, name: str) -> None:
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(os.path.abspath(self.archive_dir), f"{name}-{int(time.time())}.seg")
+        writer = await asyncio.to_thread(SegmentWriter, path)
+        try:
+            # One snapshot for the rows and the totals the drop pass compares against.
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                totals = await conn.fetchrow(
+                    f"SELECT count(*) AS rows, COALESCE(max(change_seq), 0) AS change_seq FROM {name}"
+                )
+                batch = []
+                async for row in conn.cursor(f"SELECT * FROM {name} ORDER BY chat_id, id", prefetch=ARCHIVE_BATCH):
+                    batch.append(row)
+                    if len(batch) >= ARCHIVE_BATCH:
+                        await asyncio.to_thread(_add_rows, writer, batch)
+                        batch = []
+                await asyncio.to_thread(_add_rows, writer, batch)
+            await asyncio.to_thread(writer.close)
+        except BaseException:
+            await asyncio.to_thread(writer.abort)
+            raise
+        await conn.execute(
+            """
+            UPDATE message_partitions
+            SET segment = $2, archived_rows = $3, archived_change_seq = $4, archived_at = LOCALTIMESTAMP
+            WHERE name = $1
+            """,
+            name, path, totals['rows'], totals['change_seq']
+        )
+        self.archived += 1
+
+    async def _drop(self, conn: asyncpg.Connection, partition) -> None:
+        name = partition['name']
+        async with conn.transaction():
+            # Fail fast rather than queue every message query behind the detach.
+            await conn.execute("SET LOCAL lock_timeout = '2s'")
+            # Holds off writes, not reads, until the partition is gone.
+            await conn.execute(f"LOCK TABLE {name} IN SHARE MODE")
+            totals = await conn.fetchrow(
+                f"SELECT count(*) AS rows, COALESCE(max(change_seq), 0) AS change_seq FROM {name}"
+            )
+            if (totals['rows'], totals['change_seq']) != (partition['archived_rows'], partition['archived_change_seq']):
+                # Edited or deleted since the segment was written; the next pass writes it again.
+                await conn.execute("UPDATE message_partitions SET segment = NULL WHERE name = $1", name)
+                self.rewritten += 1
+                return
+            await conn.execute(f"DELETE FROM message_search USING {name} WHERE message_search.message_id = {name}.id")
+            await conn.execute(f"ALTER TABLE messages DETACH PARTITION {name}")
+            await conn.execute(f"DROP TABLE {name}")
+            await conn.execute("UPDATE message_partitions SET dropped_at = LOCALTIMESTAMP WHERE name = $1", name)
+        self.dropped += 1
+
+    def stats(self) -> dict:
+        return {'created': self.created, 'archived': self.archived, 'dropped': self.dropped,
+                'rewritten': self.rewritten, 'archive': self.archive.stats()}
+
+
+async def main():
+    db = AsyncChatDB(min_size=1, max_size=1)
+    await db.connect()
+    try:
+        maintainer = PartitionMaintainer(db)
+        await maintainer.run_once()
+        print(maintainer.stats())
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+import os
+from typing import List, Optional
+
+import asyncpg
+from fastapi import HTTPException, Request
+
+from modules.storage import ChatStorage
+from modules.lru import MISSING, TTLCache
+
+
+SEND_MESSAGE = 1
+SEND_MEDIA = 2
+REMOVE_MESSAGE = 4
+BAN_USER = 8
+ALL = SEND_MESSAGE | SEND_MEDIA | REMOVE_MESSAGE | BAN_USER
+
+RULE_BITS = (
+    ('can_send_message', SEND_MESSAGE),
+    ('can_send_media', SEND_MEDIA),
+    ('can_remove_message', REMOVE_MESSAGE),
+    ('can_ban_user', BAN_USER),
+)
+# What a member without a chat_rules row may do; mirrors set_chat_rules' defaults.
+DEFAULT = SEND_MESSAGE | SEND_MEDIA
+
+PERMISSION_CACHE_SIZE = int(os.getenv('PERMISSION_CACHE_SIZE', 100000))
+PERMISSION_CACHE_TTL = float(os.getenv('PERMISSION_CACHE_TTL', 300))
+
+
+def compile_rules(rules: Optional[asyncpg.Record]) -> int:
+    if rules is None:
+        return DEFAULT
+    mask = 0
+    for column, bit in RULE_BITS:
+        if rules[column]:
+            mask |= bit
+    return mask
+
+
+class PermissionCache:
+    """
+    chat_rules compiled to one bitmask per (chat_id, user_id) and cached, so
+    permission checks on hot routes are a dict lookup. The chat owner holds ALL.
+    """
+
+    def __init__(self, db: ChatStorage, cache_size: int = PERMISSION_CACHE_SIZE,
+                 cache_ttl: float = PERMISSION_CACHE_TTL):
+        self.db = db
+        self.cache = TTLCache(cache_size, cache_ttl)
+
+    async def mask(self, chat_id: int, user_id: int) -> int:
+        mask = self.cache.get((chat_id, user_id))
+        if mask is not MISSING:
+            return mask
+        chat = await self.db.get_chat_by_id(chat_id)
+        if chat is not None and chat['owner'] == user_id:
+            mask = ALL
+        else:
+            mask = compile_rules(await self.db.get_chat_rules(user_id, chat_id))
+        self.cache.set((chat_id, user_id), mask)
+        return mask
+
+    async def require(self, chat_id: int, user_id: int, bits: int) -> None:
+        if await self.mask(chat_id, user_id) & bits != bits:
+            raise HTTPException(403, 'Not allowed in this chat.')
+
+    async def set_rules(self, chat_id: int, user_ids: List[int], **rules) -> None:
+        # The storage invalidates the masks, see ChatStorage.invalidate_rules.
+        await self.db.set_chat_rules_bulk(chat_id, user_ids, **rules)
+
+    def drop(self, key: Optional[list]) -> None:
+        """
+        Drops cached masks for [chat_id, [user_id, ...]], [chat_id, None] for a whole chat,
+        or None for everything.
+        """
+        if key is None:
+            self.cache.clear()
+            return
+        chat_id, user_ids = key
+        if user_ids is None:
+            user_ids = [k[1] for k in self.cache.keys() if k[0] == chat_id]
+        for user_id in user_ids:
+            self.cache.pop((chat_id, user_id))
+
+    def drop_chat(self, chat_id: Optional[int]) -> None:
+        # Owner changes arrive as chat invalidations.
+        self.drop(None if chat_id is None else [chat_id, None])
+
+
+def get_permissions(request: Request) -> PermissionCache:
+    return request.app.state.permissions
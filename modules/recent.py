@@ -0,0 +1,227 @@
+import bisect
+import datetime
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+
+RECENT_PER_CHAT = int(os.getenv('RECENT_PER_CHAT', 100))
+RECENT_MAX_MESSAGES = int(os.getenv('RECENT_MAX_MESSAGES', 200000))
+
+_TIMESTAMPS = ('sent_at', 'edited_at')
+
+
+def decode_row(row: dict) -> dict:
+    row = dict(row)
+    for key in _TIMESTAMPS:
+        if isinstance(row.get(key), str):
+            row[key] = datetime.datetime.fromisoformat(row[key])
+    return row
+
+
+class Ring:
+    """
+    Up to `capacity` newest messages of one chat, kept sorted by id.
+    `complete` means nothing newer than the oldest held message is missing;
+    `exhausted` means the chat has no messages older than the ones held.
+    `stale` maps ids changed elsewhere to the change_seq the ring must catch
+    up to; the ring serves no page until they are refilled.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.ids: List[int] = []
+        self.rows: Dict[int, dict] = {}
+        self.complete = False
+        self.exhausted = False
+        self.deleted: set = set()
+        self.stale: Dict[int, int] = {}
+
+    def add(self, row: dict) -> int:
+        """
+        Returns the change in the number of held messages.
+        """
+        message_id = row['id']
+        if message_id in self.deleted:
+            return 0
+        if self.stale.get(message_id, float('inf')) <= row.get('change_seq', 0):
+            del self.stale[message_id]
+        if message_id in self.rows:
+            self.rows[message_id] = row
+            return 0
+        if self.complete and len(self.ids) >= self.capacity and message_id < self.ids[0]:
+            return 0
+        bisect.insort(self.ids, message_id)
+        self.rows[message_id] = row
+        if len(self.ids) > self.capacity:
+            del self.rows[self.ids.pop(0)]
+            self.exhausted = False
+            return 0
+        return 1
+
+    def mark(self, message_id: int, change_seq: int) -> None:
+        """
+        Notes that message_id reached change_seq on another worker.
+        """
+        if message_id in self.deleted:
+            return
+        row = self.rows.get(message_id)
+        if row is not None and row.get('change_seq', 0) >= change_seq:
+            return
+        if (row is None and self.complete and len(self.ids) >= self.capacity
+                and message_id < self.ids[0]):
+            return
+        self.stale[message_id] = max(change_seq, self.stale.get(message_id, 0))
+
+    def remove(self, message_id: int) -> int:
+        self.stale.pop(message_id, None)
+        if not self.complete:
+            # Keeps a row deleted during warm-up from being re-added by the warm-up query.
+            self.deleted.add(message_id)
+        if self.rows.pop(message_id, None) is None:
+            return 0
+        self.ids.remove(message_id)
+        return -1
+
+    def page(self, count: int) -> Optional[List[dict]]:
+        if not self.complete or self.stale or (len(self.ids) < count and not self.exhausted):
+            return None
+        return [self.rows[i] for i in reversed(self.ids[-count:])]
+
+
+class RecentMessages:
+    """
+    Per-chat rings of the newest messages so the first page of history is
+    served from memory. Chats are evicted least recently used first once
+    the total number of held messages exceeds `max_messages`.
+    """
+
+    def __init__(self, per_chat: int = RECENT_PER_CHAT, max_messages: int = RECENT_MAX_MESSAGES):
+        self.per_chat = per_chat
+        self.max_messages = max_messages
+        self.rings: "OrderedDict[int, Ring]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_time = 0.0
+        self.miss_time = 0.0
+
+    def page(self, chat_id: int, count: int) -> Optional[List[dict]]:
+        ring = self.rings.get(chat_id)
+        if ring is None or count > self.per_chat:
+            return None
+        self.rings.move_to_end(chat_id)
+        return ring.page(count)
+
+    def begin_warm(self, chat_id: int) -> Ring:
+        """
+        Creates an incomplete ring that collects concurrent changes while its
+        initial rows are loaded; finish_warm() merges the loaded rows.
+        """
+        ring = self.rings.get(chat_id)
+        if ring is None:
+            ring = self.rings[chat_id] = Ring(self.per_chat)
+        ring.complete = False
+        return ring
+
+    def finish_warm(self, chat_id: int, ring: Ring, rows: List[dict]) -> None:
+        if self.rings.get(chat_id) is not ring:
+            return
+        for row in rows:
+            self.size += ring.add(row)
+        ring.complete = True
+        ring.exhausted = len(rows) < self.per_chat
+        ring.deleted.clear()
+        self._evict()
+
+    def add(self, row: dict) -> None:
+        ring = self.rings.get(row['chat_id'])
+        if ring is not None:
+            self.size += ring.add(row)
+            self._evict()
+
+    def stale(self, chat_id: int) -> Optional[Tuple[Ring, Dict[int, int]]]:
+        """
+        The complete ring of chat_id and a snapshot of its stale ids, if it
+        has any; pass both to finish_refill() with the rows fetched for them.
+        """
+        ring = self.rings.get(chat_id)
+        if ring is None or not ring.complete or not ring.stale:
+            return None
+        return ring, dict(ring.stale)
+
+    def finish_refill(self, chat_id: int, ring: Ring, wanted: Dict[int, int], rows: List[dict]) -> None:
+        if self.rings.get(chat_id) is not ring:
+            return
+        for row in rows:
+            # Removed meanwhile if no longer stale; ring.add() clears what the row satisfies.
+            if row['id'] in ring.stale:
+                self.size += ring.add(row)
+        found = {row['id'] for row in rows}
+        for message_id, change_seq in wanted.items():
+            # Gone from the table; its removal was broadcast or is on its way.
+            if message_id not in found and ring.stale.get(message_id) == change_seq:
+                del ring.stale[message_id]
+        self._evict()
+
+    def remove(self, chat_id: int, message_id: int) -> None:
+        ring = self.rings.get(chat_id)
+        if ring is not None:
+            self.size += ring.remove(message_id)
+
+    def drop(self, chat_id: Optional[int] = None) -> None:
+        if chat_id is None:
+            self.rings.clear()
+            self.size = 0
+            return
+        ring = self.rings.pop(chat_id, None)
+        if ring is not None:
+            self.size -= len(ring.ids)
+
+    def apply(self, change: Optional[list]) -> None:
+        """
+        Applies a change broadcast by another worker:
+        ['changed', [[chat_id, message_id, change_seq], ...]] for sent or edited
+        messages, ['remove', chat_id, message_id], ['drop', chat_id] or None
+        for everything.
+        """
+        if change is None:
+            self.drop()
+        elif change[0] == 'changed':
+            for chat_id, message_id, change_seq in change[1]:
+                ring = self.rings.get(chat_id)
+                if ring is not None:
+                    ring.mark(message_id, change_seq)
+        elif change[0] == 'remove':
+            self.remove(change[1], change[2])
+        elif change[0] == 'drop':
+            self.drop(change[1])
+
+    def _evict(self) -> None:
+        while self.size > self.max_messages and len(self.rings) > 1:
+            _, ring = self.rings.popitem(last=False)
+            self.size -= len(ring.ids)
+
+    def record(self, hit: bool, started: float) -> None:
+        elapsed = time.perf_counter() - started
+        if hit:
+            self.hits += 1
+            self.hit_time += elapsed
+        else:
+            self.misses += 1
+            self.miss_time += elapsed
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'chats': len(self.rings),
+            'messages': self.size,
+            'max_messages': self.max_messages,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'hit_avg_us': self.hit_time / self.hits * 1e6 if self.hits else 0.0,
+            'miss_avg_ms': self.miss_time / self.misses * 1e3 if self.misses else 0.0,
+        }
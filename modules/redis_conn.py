@@ -0,0 +1,11 @@
+import os
+
+import redis.asyncio as redis
+
+
+# Shared by every module that talks to Redis, so a worker keeps a single connection pool.
+if os.getenv('CHAT_BACKEND', 'postgres') == 'memory':
+    from modules.memory_redis import MemoryRedis
+    r = MemoryRedis()
+else:
+    r = redis.Redis(port=int(os.getenv('REDIS_PORT', 6379)))
@@ -0,0 +1,240 @@
+"""
+Read replicas for AsyncChatDB. Read-only methods run on a replica that has
+replayed everything the caller must see; everything else, and every read no
+replica can serve yet, runs on the primary.
+
+Lag is tracked by position rather than by replay timestamps: every
+PQ_REPLICA_CHECK_INTERVAL seconds the checker reads the primary's WAL position
+and asks each replica whether it has replayed past it. A replica that has is
+known to hold every commit acknowledged before that check started, and that
+moment becomes its `caught_up_to` (time.time()). Reads then ask for a
+replica caught up to some moment: the caller's own last write for
+read-your-writes, and never older than PQ_REPLICA_MAX_LAG ago.
+
+The last write of each user is kept in Redis (lastwrite:<user_id>, expiring
+after PQ_REPLICA_MAX_LAG), so read-your-writes holds whichever worker serves
+the next request. Moments are wall-clock times for the same reason; worker
+clocks are assumed to agree to well within PQ_REPLICA_MAX_LAG.
+
+Reading that marker costs a Redis GET (chat_replica_marker_seconds), paid at
+most once per request: the answer is kept for the rest of the request, and no
+lookup happens when this worker's own record of the user's last write already
+rules every replica out, or when no replica could serve the read anyway.
+
+    PQ_REPLICA_DSNS=postgres://replica-1/chat,postgres://replica-2/chat
+"""
+import asyncio
+import itertools
+import math
+import os
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+import asyncpg
+import redis.asyncio as redis
+
+from modules.lru import MISSING, TTLCache
+from modules.metrics import Histogram
+
+
+REPLICA_DSNS = [dsn.strip() for dsn in os.getenv('PQ_REPLICA_DSNS', '').split(',') if dsn.strip()]
+REPLICA_POOL_MAX_SIZE = int(os.getenv('PQ_REPLICA_POOL_MAX_SIZE', 20))
+# Replicas further behind than this serve nothing.
+REPLICA_MAX_LAG = float(os.getenv('PQ_REPLICA_MAX_LAG', 2.0))
+REPLICA_CHECK_INTERVAL = float(os.getenv('PQ_REPLICA_CHECK_INTERVAL', 0.5))
+REPLICA_CHECK_TIMEOUT = float(os.getenv('PQ_REPLICA_CHECK_TIMEOUT', 1.0))
+WRITERS_CACHE_SIZE = int(os.getenv('PQ_REPLICA_WRITERS_CACHE_SIZE', 100000))
+
+LAST_WRITE_KEY = 'lastwrite:{}'
+
+# The user the current request acts for; set by modules.session.require_user.
+current_user: ContextVar[Optional[int]] = ContextVar('current_user', default=None)
+# (user_id, their last write per Redis or None, when that was read), for the current request.
+_shared_write: ContextVar[Optional[tuple]] = ContextVar('shared_write', default=None)
+
+REPLICA_MARKER_SECONDS = Histogram('chat_replica_marker_seconds',
+                                   "Redis lookups of a user's last write before a replica read.")
+
+# A standby that has replayed past the primary's position, or a server that is
+# not a standby at all (a replica DSN pointing at the primary while testing).
+_CAUGHT_UP = "SELECT NOT pg_is_in_recovery() OR pg_last_wal_replay_lsn() >= $1::text::pg_lsn"
+
+
+class Replica:
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool: asyncpg.pool.Pool = None
+        self.healthy = False
+        self.caught_up_to = float('-inf')
+        self.reads = 0
+        self.failures = 0
+
+    def in_use(self) -> int:
+        return self.pool.get_size() - self.pool.get_idle_size() if self.pool else 0
+
+    def stats(self) -> dict:
+        lag = time.time() - self.caught_up_to
+        return {'healthy': self.healthy, 'lag_s': lag if lag != float('inf') else None,
+                'in_use': self.in_use(), 'reads': self.reads, 'failures': self.failures}
+
+
+class ReplicaSet:
+    """
+    Pools for the replicas plus their health checker. Knows nothing about the
+    queries; AsyncChatDB asks pick() for a replica and falls back to the
+    primary on None.
+    """
+
+    def __init__(self, dsns: List[str], pool_options: dict, max_lag: float = REPLICA_MAX_LAG,
+                 interval: float = REPLICA_CHECK_INTERVAL):
+        self.replicas = [Replica(dsn) for dsn in dsns]
+        self.pool_options = pool_options
+        self.max_lag = max_lag
+        self.interval = interval
+        # Shares last writes with the other workers; set by the app. Without it
+        # read-your-writes only covers writes made through this worker.
+        self.redis: Optional[redis.Redis] = None
+        # user_id -> time their last write through this worker finished. Entries can expire
+        # after max_lag: by then every replica pick() accepts has that write anyway.
+        self.writers = TTLCache(WRITERS_CACHE_SIZE, max_lag)
+        self._order = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self.fallbacks = 0
+        self.redis_errors = 0
+        self.marker_lookups = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.replicas)
+
+    async def start(self, primary: asyncpg.pool.Pool) -> None:
+        await asyncio.gather(*(self._connect(replica) for replica in self.replicas))
+        await self.check(primary)
+        self._task = asyncio.create_task(self._run(primary))
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.gather(*(replica.pool.close() for replica in self.replicas if replica.pool))
+
+    async def _connect(self, replica: Replica) -> None:
+        try:
+            replica.pool = await asyncpg.create_pool(dsn=replica.dsn, **self.pool_options)
+        except Exception as e:
+            print("Replica connect failed:", e)
+
+    async def _run(self, primary: asyncpg.pool.Pool) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check(primary)
+            except Exception as e:
+                print("Replica check failed:", e)
+
+    async def check(self, primary: asyncpg.pool.Pool) -> None:
+        # Taken before reading the position: every commit acknowledged by now is at or before it.
+        started = time.time()
+        try:
+            position = await primary.fetchval("SELECT pg_current_wal_lsn()::text", timeout=REPLICA_CHECK_TIMEOUT)
+        except Exception as e:
+            # Without the primary's position no replica can prove it is current; let them age out.
+            print("Replica check could not read the primary position:", e)
+            return
+        await asyncio.gather(*(self._check(replica, position, started) for replica in self.replicas))
+
+    async def _check(self, replica: Replica, position: str, started: float) -> None:
+        if replica.pool is None:
+            await self._connect(replica)
+            if replica.pool is None:
+                replica.healthy = False
+                return
+        try:
+            caught_up = await replica.pool.fetchval(_CAUGHT_UP, position, timeout=REPLICA_CHECK_TIMEOUT)
+        except Exception as e:
+            if replica.healthy:
+                print("Replica unhealthy:", e)
+            replica.healthy = False
+            replica.failures += 1
+            return
+        replica.healthy = True
+        if caught_up:
+            replica.caught_up_to = max(replica.caught_up_to, started)
+
+    async def wrote(self, *user_ids: Optional[int]) -> None:
+        """
+        Records that these users, and the user of the current request, just
+        wrote; their reads stay off replicas that have not replayed it yet.
+        """
+        if not self.replicas:
+            # Every read goes to the primary anyway.
+            return
+        now = time.time()
+        writers = {user_id for user_id in (*user_ids, current_user.get()) if user_id is not None}
+        for user_id in writers:
+            self.writers.set(user_id, now)
+        if self.redis is None or not writers:
+            return
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id in writers:
+                    pipe.set(LAST_WRITE_KEY.format(user_id), repr(now), px=math.ceil(self.max_lag * 1000))
+                await pipe.execute()
+        except Exception as e:
+            # The write itself is committed; other workers may serve these users a stale read.
+            self.redis_errors += 1
+            print("Replica write marker lost Redis:", e)
+
+    async def _last_shared_write(self, user_id: int) -> Optional[float]:
+        """
+        When `user_id` last wrote through any worker, None if not within
+        max_lag; raises if Redis cannot tell. Asked once per request: later
+        reads of the same request reuse the answer for up to one check
+        interval, the longest a replica's standing stays the same anyway.
+        """
+        now = time.time()
+        seen = _shared_write.get()
+        if seen is not None and seen[0] == user_id and now - seen[2] < self.interval:
+            return seen[1]
+        start = time.perf_counter()
+        value = await self.redis.get(LAST_WRITE_KEY.format(user_id))
+        REPLICA_MARKER_SECONDS.observe(time.perf_counter() - start)
+        self.marker_lookups += 1
+        written = None if value is None else float(value)
+        _shared_write.set((user_id, written, now))
+        return written
+
+    async def pick(self, after: float = float('-inf')) -> Optional[Replica]:
+        """
+        The least busy healthy replica holding every commit acknowledged
+        before `after` and before the current user's last write, or None.
+        """
+        floor = max(after, time.time() - self.max_lag)
+        candidates = [replica for replica in self.replicas
+                      if replica.healthy and replica.pool is not None and replica.caught_up_to >= floor]
+        user_id = current_user.get()
+        if candidates and user_id is not None:
+            # This worker's own record first: it may rule every replica out without asking Redis.
+            written = self.writers.get(user_id)
+            if written is not MISSING:
+                candidates = [replica for replica in candidates if replica.caught_up_to >= written]
+        if candidates and user_id is not None and self.redis is not None:
+            try:
+                written = await self._last_shared_write(user_id)
+            except Exception as e:
+                # Without the marker a replica could miss the user's own write; use the primary.
+                self.redis_errors += 1
+                print("Replica write marker lost Redis:", e)
+                candidates = []
+            else:
+                if written is not None:
+                    candidates = [replica for replica in candidates if replica.caught_up_to >= written]
+        if not candidates:
+            self.fallbacks += 1
+            return None
+        # Rotate the starting point so equally idle replicas share the load.
+        start = next(self._order) % len(candidates)
+        return min(candidates[start:] + candidates[:start], key=Replica.in_use)
+
+    def stats(self) -> List[dict]:
+        return [replica.stats() for replica in self.replicas]
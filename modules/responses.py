@@ -0,0 +1,30 @@
+"""
+orjson response class for record-heavy routes. History, search and dialog
+pages come from storage as plain dicts (the recent-message rings, or one
+conversion per fetched row in AsyncChatDB) and go straight to bytes, skipping
+FastAPI's jsonable_encoder walk. Any other asyncpg Record is copied to a dict
+on the way, since orjson cannot serialize one itself.
+
+Routes using it declare response_model for the schema but return an
+ORJSONResponse themselves, so FastAPI does not validate the payload either.
+"""
+from typing import Any
+
+import asyncpg
+import orjson
+from starlette.responses import JSONResponse
+
+
+def _default(value):
+    if isinstance(value, asyncpg.Record):
+        return dict(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=_default)
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
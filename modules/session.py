@@ -0,0 +1,99 @@
+import hashlib
+import os
+import secrets
+from typing import Optional
+
+import redis.asyncio as redis
+from fastapi import Header, HTTPException
+
+from modules.lru import MISSING, TTLCache
+from modules.redis_conn import r
+from modules.replicas import current_user
+
+
+SESSION_TTL = int(os.getenv('SESSION_TTL', 7 * 24 * 3600))
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 10000))
+# Safety net for revocations missed while a worker was disconnected from Redis.
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', 30))
+
+
+class SessionStore:
+    """
+    Opaque bearer tokens stored in Redis (hashed) with an in-process LRU/TTL
+    front cache, so resolving a token to a user id never touches Postgres.
+    """
+
+    def __init__(self, r: redis.Redis, ttl: int = SESSION_TTL,
+                 cache_size: int = SESSION_CACHE_SIZE, cache_ttl: float = SESSION_CACHE_TTL):
+        self.r = r
+        self.ttl = ttl
+        self.cache = TTLCache(cache_size, cache_ttl)
+        # Set by the app to broadcast revocations to other workers.
+        self.invalidator = None
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return 'session:' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    async def create(self, user_id: int) -> str:
+        token = secrets.token_urlsafe(32)
+        key = self._key(token)
+        await self.r.set(key, user_id, ex=self.ttl)
+        self.cache.set(key, user_id)
+        return token
+
+    async def resolve(self, token: str) -> Optional[int]:
+        """
+        Returns user id for a live token, else None.
+        """
+        if not token:
+            return None
+        key = self._key(token)
+        user_id = self.cache.get(key)
+        if user_id is not MISSING:
+            return user_id
+        value = await self.r.get(key)
+        if value is None:
+            return None
+        user_id = int(value)
+        self.cache.set(key, user_id)
+        return user_id
+
+    def drop(self, key: Optional[str]) -> None:
+        """
+        Drops a session from the local cache by its Redis key; None drops every session.
+        """
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key)
+
+    async def revoke(self, token: str) -> None:
+        key = self._key(token)
+        await self.r.delete(key)
+        if self.invalidator is not None:
+            await self.invalidator.publish('session', key)
+        else:
+            self.drop(key)
+
+
+sessions = SessionStore(r)
+
+
+def bearer_token(authorization: str = Header('')) -> str:
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        raise HTTPException(401, 'Missing session token.')
+    return token.strip()
+
+
+async def require_user(authorization: str = Header('')) -> int:
+    """
+    FastAPI dependency resolving `Authorization: Bearer <token>` to a user id.
+    Also makes it the current user for read-your-writes replica routing.
+    """
+    user_id = await sessions.resolve(bearer_token(authorization))
+    if user_id is None:
+        raise HTTPException(403, 'Unverified session.')
+    current_user.set(user_id)
+    return user_id
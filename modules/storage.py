@@ -0,0 +1,343 @@
+"""
+The storage interface every router and cache talks to. AsyncChatDB is the
+Postgres implementation; MemoryChatStorage (modules/memory_storage.py) keeps
+everything in process for load tests and local runs without Postgres.
+
+    CHAT_BACKEND=memory uvicorn app:app
+"""
+import abc
+import asyncio
+import os
+from typing import Dict, Iterable, List, Optional
+
+from modules.events import CREATED, DELETED, message_envelope
+from modules.lru import MISSING, TTLCache
+from modules.recent import RecentMessages
+
+
+# 'postgres' or 'memory'; 'memory' also swaps Redis for modules.memory_redis.
+CHAT_BACKEND = os.getenv('CHAT_BACKEND', 'postgres')
+
+
+class PublishError(Exception):
+    """
+    New messages were stored but could not be published to the recent rings
+    or the event log. `ids` are the stored message ids, in row order; sending
+    them again would store duplicates.
+    """
+
+    def __init__(self, ids: List[int]):
+        super().__init__(f'{len(ids)} stored message(s) not published')
+        self.ids = ids
+
+
+class ChatStorage(abc.ABC):
+    """
+    Rows come back as asyncpg Records or plain dicts with the same keys; callers
+    only index them by column name. Implementations call _emit() after every
+    message mutation and invalidate_chat() after every chat change.
+    """
+
+    def __init__(self):
+        self.chat_cache = TTLCache(int(os.getenv('CHAT_CACHE_SIZE', 10000)),
+                                   float(os.getenv('CHAT_CACHE_TTL', 300)))
+        self.profile_cache = TTLCache(int(os.getenv('PROFILE_CACHE_SIZE', 50000)),
+                                      float(os.getenv('PROFILE_CACHE_TTL', 300)))
+        # user_id -> the task loading it, shared by concurrent lookups.
+        self._profile_loads: Dict[int, asyncio.Task] = {}
+        self.recent = RecentMessages()
+        # Set by the app to broadcast cache invalidations to other workers.
+        self.invalidator = None
+        # Set by the app to the PermissionCache compiled from chat_rules.
+        self.permissions = None
+        # Set by the app to an EventLog; every message mutation is published there.
+        self.events = None
+
+    @abc.abstractmethod
+    async def connect(self): ...
+
+    @abc.abstractmethod
+    async def close(self): ...
+
+    def pool_stats(self) -> dict:
+        return {}
+
+    def pool_wait(self) -> float:
+        """
+        Seconds the longest current caller has been waiting for a connection.
+        """
+        return 0.0
+
+    # -------- Users --------
+    @abc.abstractmethod
+    async def create_user(self, username: str, name: str, password_hash: str,
+                          profile: Optional[str] = None, bio: Optional[str] = None,
+                          status: Optional[str] = None) -> int: ...
+
+    @abc.abstractmethod
+    async def get_user_by_username(self, username: str): ...
+
+    @abc.abstractmethod
+    async def get_user_by_id(self, user_id: int): ...
+
+    @abc.abstractmethod
+    async def login(self, username: str, password_hash: str) -> Optional[int]: ...
+
+    @abc.abstractmethod
+    async def update_user_profile(self, user_id: int, **kwargs) -> None: ...
+
+    @abc.abstractmethod
+    async def load_profiles(self, user_ids: List[int]) -> list:
+        """
+        Public profile rows (no password) of the existing users among
+        user_ids, uncached; callers want get_users_by_ids().
+        """
+
+    async def get_users_by_ids(self, user_ids: Iterable[int]) -> Dict[int, dict]:
+        """
+        Public profiles by id, unknown ids left out. Served from
+        profile_cache; misses are loaded in one query, and a lookup for an
+        id already being loaded waits for that load instead of issuing another.
+        """
+        requested = dict.fromkeys(user_ids)
+        profiles = {}
+        waits = set()
+        missing = []
+        for user_id in requested:
+            profile = self.profile_cache.get(user_id)
+            if profile is not MISSING:
+                profiles[user_id] = profile
+            elif user_id in self._profile_loads:
+                waits.add(self._profile_loads[user_id])
+            else:
+                missing.append(user_id)
+        if missing:
+            # A task rather than a coroutine, so a cancelled caller does not fail the others waiting on it.
+            task = asyncio.ensure_future(self._load_profiles(missing))
+            for user_id in missing:
+                self._profile_loads[user_id] = task
+            waits.add(task)
+        for loaded in await asyncio.gather(*map(asyncio.shield, waits)):
+            profiles.update((user_id, profile) for user_id, profile in loaded.items() if user_id in requested)
+        return profiles
+
+    async def _load_profiles(self, user_ids: List[int]) -> Dict[int, dict]:
+        task = asyncio.current_task()
+        try:
+            loaded = {row['id']: dict(row) for row in await self.load_profiles(user_ids)}
+            for user_id, profile in loaded.items():
+                # Not if drop_profile() ran meanwhile: the row may predate the change.
+                if self._profile_loads.get(user_id) is task:
+                    self.profile_cache.set(user_id, profile)
+            return loaded
+        finally:
+            for user_id in user_ids:
+                if self._profile_loads.get(user_id) is task:
+                    del self._profile_loads[user_id]
+
+    def drop_profile(self, user_id: Optional[int]) -> None:
+        """
+        Drops a profile from the local cache, and from any load in flight;
+        None drops every profile.
+        """
+        if user_id is None:
+            self.profile_cache.clear()
+            self._profile_loads.clear()
+        else:
+            self.profile_cache.pop(user_id)
+            self._profile_loads.pop(user_id, None)
+
+    async def invalidate_profile(self, user_id: int) -> None:
+        if self.invalidator is not None:
+            await self.invalidator.publish('profile', user_id)
+        else:
+            self.drop_profile(user_id)
+
+    # -------- Chats --------
+    @abc.abstractmethod
+    async def create_chat(self, chatname: str, chat_title: str, chat_about: str, owner_id: int) -> int: ...
+
+    @abc.abstractmethod
+    async def get_chat_by_name(self, chatname: str): ...
+
+    @abc.abstractmethod
+    async def get_chat_by_id(self, chatid: int): ...
+
+    def _cache_chat(self, chat) -> None:
+        # Misses are not cached so a chat created by another worker shows up immediately.
+        if chat is not None:
+            self.chat_cache.set(('id', chat['id']), chat)
+            self.chat_cache.set(('name', chat['chatname']), chat)
+
+    def drop_chat(self, chat_id: Optional[int]) -> None:
+        """
+        Drops a chat from the local cache; None drops every chat.
+        """
+        if chat_id is None:
+            self.chat_cache.clear()
+            return
+        chat = self.chat_cache.pop(('id', chat_id))
+        if chat is not None:
+            self.chat_cache.pop(('name', chat['chatname']))
+
+    async def invalidate_chat(self, chat_id: int) -> None:
+        if self.invalidator is not None:
+            await self.invalidator.publish('chat', chat_id)
+        else:
+            self.drop_chat(chat_id)
+
+    @abc.abstractmethod
+    async def update_chat_info(self, chat_id: int, **kwargs) -> None: ...
+
+    @abc.abstractmethod
+    async def remove_group(self, chat_id: int) -> None: ...
+
+    # -------- Chat Rules --------
+    @abc.abstractmethod
+    async def set_chat_rules(self, user_id: int, chat_id: int,
+                             can_ban_user: bool = False, can_remove_message: bool = False,
+                             can_send_message: bool = True, can_send_media: bool = True) -> None: ...
+
+    @abc.abstractmethod
+    async def get_chat_rules(self, user_id: int, chat_id: int): ...
+
+    @abc.abstractmethod
+    async def set_chat_rules_bulk(self, chat_id: int, user_ids: List[int],
+                                  can_ban_user: bool = False, can_remove_message: bool = False,
+                                  can_send_message: bool = True, can_send_media: bool = True) -> None: ...
+
+    async def invalidate_rules(self, chat_id: int, user_ids: List[int]) -> None:
+        if self.invalidator is not None:
+            await self.invalidator.publish('rules', [chat_id, user_ids])
+        elif self.permissions is not None:
+            self.permissions.drop([chat_id, user_ids])
+
+    # -------- Dialogs (memberships) --------
+    @abc.abstractmethod
+    async def join_chat(self, user_id: int, chat_id: int) -> None: ...
+
+    @abc.abstractmethod
+    async def leave_chat(self, user_id: int, chat_id: int) -> None: ...
+
+    @abc.abstractmethod
+    async def get_user_chats(self, user_id: int) -> list: ...
+
+    @abc.abstractmethod
+    async def mark_read(self, user_id: int, chat_id: int, message_id: Optional[int] = None) -> bool: ...
+
+    @abc.abstractmethod
+    async def is_joined(self, chat_id: int, user_id: int) -> bool: ...
+
+    @abc.abstractmethod
+    async def get_chat_users(self, chat_id: int) -> list: ...
+
+    @abc.abstractmethod
+    async def get_chat_members(self, chat_id: int, after_id: int = 0, count: int = 100) -> list: ...
+
+    @abc.abstractmethod
+    async def get_chat_member_ids(self, chat_id: int) -> List[int]: ...
+
+    # -------- Messages --------
+    @abc.abstractmethod
+    async def send_message(self, chat_id: int, sender_id: int, content: str,
+                           reply_to: Optional[int] = None, is_media: bool = False) -> int: ...
+
+    @abc.abstractmethod
+    async def send_messages(self, rows: List[tuple]) -> List[int]: ...
+
+    @abc.abstractmethod
+    async def get_last_messages(self, chat_id: int, count: int = 20,
+                                before_id: Optional[int] = None, after_id: Optional[int] = None) -> list: ...
+
+    @abc.abstractmethod
+    async def get_changes(self, user_id: int, since: int = 0, last_seen: Optional[dict] = None,
+                          count: int = 500, settle: float = 1.0): ...
+
+    @abc.abstractmethod
+    async def get_chat_changes(self, chat_id: int, since: int, count: int = 500): ...
+
+    @abc.abstractmethod
+    async def search_messages(self, query: str, chat_id: Optional[int] = None, user_id: Optional[int] = None,
+                              count: int = 20, after: Optional[tuple] = None) -> list: ...
+
+    @abc.abstractmethod
+    async def delete_message(self, message_id: int, user_id: int) -> bool: ...
+
+    @abc.abstractmethod
+    async def remove_message(self, message_id: int, chat_id: int) -> bool: ...
+
+    @abc.abstractmethod
+    async def edit_message(self, message_id: int, user_id: int, new_content: str) -> bool: ...
+
+    # -------- Media jobs (modules/media_pipeline.py) --------
+    @abc.abstractmethod
+    async def enqueue_media(self, filename: str, size: int) -> None:
+        """
+        Queues processing of a stored file, unless it already has a job.
+        """
+
+    @abc.abstractmethod
+    async def claim_media_jobs(self, count: int, lease: float) -> list:
+        """
+        Up to `count` due jobs, each leased for `lease` seconds and with its
+        attempts already counted; rows have filename, size and attempts.
+        """
+
+    @abc.abstractmethod
+    async def finish_media_job(self, filename: str, meta: dict) -> int:
+        """
+        Stores a job's result and attaches it to the is_media messages sent
+        with the file so far; returns how many were updated.
+        """
+
+    @abc.abstractmethod
+    async def fail_media_job(self, filename: str, error: str, retry_in: Optional[float]) -> None:
+        """
+        Records a failed attempt: due again in `retry_in` seconds, or given
+        up on when it is None.
+        """
+
+    @abc.abstractmethod
+    async def get_media_job(self, filename: str): ...
+
+    @abc.abstractmethod
+    async def media_backlog(self) -> dict:
+        """
+        Queued jobs, how many of them are due, and how long the oldest due
+        one has waited (oldest_due_s).
+        """
+
+    async def _share_recent(self, change: list) -> None:
+        if self.invalidator is not None:
+            await self.invalidator.publish('recent', change)
+        else:
+            self.recent.apply(change)
+
+    async def _emit_created(self, rows) -> None:
+        """
+        _emit(CREATED) for rows already committed; failures raise PublishError.
+        """
+        try:
+            await self._emit(CREATED, rows)
+        except Exception as e:
+            raise PublishError([row['id'] for row in rows]) from e
+
+    async def _emit(self, kind: str, rows) -> None:
+        """
+        Applies a message mutation to the recent-message rings and publishes
+        it on the realtime channel. rows are messages rows, or
+        message_deletions rows for DELETED.
+        """
+        if kind == DELETED:
+            for row in rows:
+                await self._share_recent(['remove', row['chat_id'], row['message_id']])
+        else:
+            # This worker's rings take the rows; the others only learn which ids
+            # changed and fetch them when their ring is next read.
+            for row in rows:
+                self.recent.add(dict(row))
+            await self._share_recent(['changed', [[row['chat_id'], row['id'], row['change_seq']] for row in rows]])
+        if self.events is not None:
+            await self.events.append_many(
+                (row['chat_id'], row['change_seq'], message_envelope(kind, row)) for row in rows
+            )
@@ -0,0 +1,169 @@
+"""
+Content negotiation for history pages and the message stream.
+
+History routes (/messages/get, /dialog/get) answer in JSON or, when Accept
+asks for application/msgpack, MessagePack with the same shape. Bodies of at
+least WIRE_COMPRESS_MIN_BYTES are compressed with zstd or gzip, whichever
+Accept-Encoding prefers (zstd wins ties).
+
+The stream speaks server-sent events by default. Accept:
+application/vnd.chat.frames+json or +msgpack switches it to length-prefixed
+frames: a u32 big-endian length, then {"id", "event", "data"} in that
+encoding. A zero-length frame is a keepalive.
+"""
+import datetime
+import gzip
+import os
+import struct
+from typing import Any, Dict, List, Optional, Sequence
+
+import asyncpg
+import msgpack
+import orjson
+import zstandard
+from starlette.requests import Request
+from starlette.responses import Response
+
+from modules.events import sse_frame
+from modules.metrics import Counter
+from modules.responses import dumps
+
+
+WIRE_COMPRESS_MIN_BYTES = int(os.getenv('WIRE_COMPRESS_MIN_BYTES', 1024))
+WIRE_GZIP_LEVEL = int(os.getenv('WIRE_GZIP_LEVEL', 5))
+WIRE_ZSTD_LEVEL = int(os.getenv('WIRE_ZSTD_LEVEL', 3))
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+SSE = 'text/event-stream'
+FRAMES_JSON = 'application/vnd.chat.frames+json'
+FRAMES_MSGPACK = 'application/vnd.chat.frames+msgpack'
+
+# Other names clients send for the same thing.
+_ALIASES = {'application/x-msgpack': MSGPACK, 'application/vnd.msgpack': MSGPACK}
+
+HISTORY_TYPES = [JSON, MSGPACK]
+STREAM_TYPES = [SSE, FRAMES_JSON, FRAMES_MSGPACK]
+ENCODINGS = ['zstd', 'gzip']
+
+KEEPALIVE = {SSE: b': keepalive\n\n', FRAMES_JSON: b'\0\0\0\0', FRAMES_MSGPACK: b'\0\0\0\0'}
+
+_LENGTH = struct.Struct('>I')
+_zstd = zstandard.ZstdCompressor(level=WIRE_ZSTD_LEVEL)
+
+WIRE_RESPONSES = Counter('chat_wire_responses_total', 'History responses by media type and content encoding.',
+                         ('media_type', 'encoding'))
+
+
+def _weights(header: str) -> Dict[str, float]:
+    """
+    Accept / Accept-Encoding header -> {lowercased token: q}.
+    """
+    weights = {}
+    for item in header.split(','):
+        token, *params = item.split(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        token = _ALIASES.get(token, token)
+        weights[token] = max(q, weights.get(token, 0.0))
+    return weights
+
+
+def negotiate(accept: str, offered: Sequence[str]) -> str:
+    """
+    The offered media type Accept weighs highest, earlier ones winning ties.
+    Falls back to the first offered type rather than answering 406.
+    """
+    weights = _weights(accept)
+    best, best_q = offered[0], 0.0
+    for media_type in offered:
+        q = weights.get(media_type)
+        if q is None:
+            q = weights.get(media_type.split('/')[0] + '/*', weights.get('*/*', 0.0))
+        if q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    weights = _weights(accept_encoding)
+    best, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'zstd':
+        return _zstd.compress(body)
+    return gzip.compress(body, WIRE_GZIP_LEVEL, mtime=0)
+
+
+def _msgpack_default(value):
+    # Same values the JSON encoding produces.
+    if isinstance(value, asyncpg.Record):
+        return dict(value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not MessagePack serializable')
+
+
+def packb(content: Any) -> bytes:
+    return msgpack.packb(content, default=_msgpack_default, use_bin_type=True, datetime=False)
+
+
+def negotiated(request: Request, content: Any) -> Response:
+    """
+    `content` rendered in the format and encoding the request asked for.
+    """
+    media_type = negotiate(request.headers.get('accept', ''), HISTORY_TYPES)
+    body = packb(content) if media_type == MSGPACK else dumps(content)
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    encoding = None
+    if len(body) >= WIRE_COMPRESS_MIN_BYTES:
+        encoding = choose_encoding(request.headers.get('accept-encoding', ''))
+        if encoding:
+            body = compress(body, encoding)
+            headers['Content-Encoding'] = encoding
+    WIRE_RESPONSES.inc(media_type, encoding or 'identity')
+    return Response(body, media_type=media_type, headers=headers)
+
+
+def stream_frame(media_type: str, event_id: str, data: bytes, event: str = 'message') -> bytes:
+    """
+    One stream event in `media_type`; `data` is the JSON envelope.
+    """
+    if media_type == SSE:
+        return sse_frame(event_id, data, event)
+    if media_type == FRAMES_JSON:
+        # The envelope is already JSON; splice it in rather than parse it again.
+        body = b'{"id":%s,"event":%s,"data":%s}' % (orjson.dumps(event_id), orjson.dumps(event), data)
+    else:
+        body = packb({'id': event_id, 'event': event, 'data': orjson.loads(data)})
+    return _LENGTH.pack(len(body)) + body
+
+
+def read_frames(buffer: bytearray) -> List[bytes]:
+    """
+    Pops every complete length-prefixed frame body off `buffer`, keepalives
+    included as b''.
+    """
+    frames = []
+    while len(buffer) >= _LENGTH.size:
+        (length,) = _LENGTH.unpack_from(buffer)
+        if len(buffer) < _LENGTH.size + length:
+            break
+        frames.append(bytes(buffer[_LENGTH.size:_LENGTH.size + length]))
+        del buffer[:_LENGTH.size + length]
+    return frames
@@ -1,21 +1,22 @@
-from fastapi import APIRouter
-from models.chats import CreateChat, DeleteChat, JoinChat
-from modules.db import AsyncChatDB
+from fastapi import APIRouter, Depends
+from models.chats import CreateChat, DeleteChat, JoinChat, SetRules
+from modules.db import get_db
+from modules.storage import ChatStorage
+from modules.session import require_user
+from modules.membership import MembershipCache, get_membership
+from modules.permissions import PermissionCache, get_permissions
 from asyncpg.exceptions import UniqueViolationError
-import hashlib
-import hashlib
 from fastapi import HTTPException
+import os
 
 
 router = APIRouter()
-db = AsyncChatDB()
 
-@router.on_event("startup")
-async def startup():
-    await db.connect()
+MEMBERS_PAGE_SIZE = int(os.getenv('MEMBERS_PAGE_SIZE', 100))
+MEMBERS_MAX_PAGE_SIZE = int(os.getenv('MEMBERS_MAX_PAGE_SIZE', 1000))
 
 @router.get('/get')
-async def get(chat_id: int=0, chat_name: str=''):
+async def get(chat_id: int=0, chat_name: str='', db: ChatStorage = Depends(get_db)):
     try:
         if chat_id:
             result = await db.get_chat_by_id(chat_id)
@@ -31,15 +32,13 @@ async def get(chat_id: int=0, chat_name: str=''):
         return HTTPException(500, 'Server side error.')
 
 @router.post('/create')
-async def create_chat(request: CreateChat):
+async def create_chat(request: CreateChat, user: int = Depends(require_user), db: ChatStorage = Depends(get_db),
+                      membership: MembershipCache = Depends(get_membership)):
     try:
-        user = await db.login(request.username, hashlib.sha256(request.password.encode('utf-8')).hexdigest())
-        if not user:
-            return HTTPException(403, 'Unverified session.')
         result = await db.create_chat(request.groupname, request.grouptitle, '', user)
         if not result:
             return HTTPException(409, 'Chat name already exists.')
-        await db.join_chat(user, result)
+        await membership.join(user, result)
         return {'status_code':200, 'chat_id': result}
     except UniqueViolationError:
         return HTTPException(401, 'Already exists.')
@@ -48,17 +47,16 @@ async def create_chat(request: CreateChat):
         return HTTPException(500, 'Server side error.')
 
 @router.post('/delete')
-async def delete_chat(request: DeleteChat):
+async def delete_chat(request: DeleteChat, user: int = Depends(require_user), db: ChatStorage = Depends(get_db),
+                      membership: MembershipCache = Depends(get_membership)):
     try:
-        user = await db.login(request.username, hashlib.sha256(request.password.encode('utf-8')).hexdigest())
-        if not user:
-            return HTTPException(403, 'Unverified session.')
         result = await db.get_chat_by_name(request.groupname)
         if not result:
             return HTTPException(404, 'Group doesnt exists.')
         result = dict(result)
         if result['owner'] == user:
             await db.remove_group(result['id'])
+            await membership.remove_chat(result['id'])
         return {'status':True}
     except Exception as e:
         print(e)
@@ -66,15 +64,47 @@ async def delete_chat(request: DeleteChat):
 
 
 @router.post('/join')
-async def join_chat(request: JoinChat):
+async def join_chat(request: JoinChat, user: int = Depends(require_user), db: ChatStorage = Depends(get_db),
+                    membership: MembershipCache = Depends(get_membership)):
     try:
-        user = await db.login(request.username, hashlib.sha256(request.password.encode('utf-8')).hexdigest())
-        if not user:
-            return HTTPException(403, 'Unverified session.')
         chat = await db.get_chat_by_name(request.groupname)
         if not chat:
             return HTTPException(404, 'Chat does not exists.')
-        await db.join_chat(user, chat['id'])
+        await membership.join(user, chat['id'])
     except Exception as e:
         print(e)
-        return HTTPException(500, 'Server side error.')
\ No newline at end of file
+        return HTTPException(500, 'Server side error.')
+
+
+@router.get('/members')
+async def members(chat_id: int, after_id: int=0, limit: int=MEMBERS_PAGE_SIZE, user: int = Depends(require_user),
+                  db: ChatStorage = Depends(get_db), membership: MembershipCache = Depends(get_membership)):
+    limit = max(1, min(limit, MEMBERS_MAX_PAGE_SIZE))
+    if not await membership.is_member(chat_id, user):
+        raise HTTPException(403, 'You are not joined in this chat.')
+    try:
+        rows = await db.get_chat_members(chat_id, after_id, limit)
+        return {'status_code': 200, 'members': [dict(row) for row in rows],
+                'next_after_id': rows[-1]['id'] if len(rows) == limit else None}
+    except Exception as e:
+        print(e)
+        raise HTTPException(500, 'Server side error.')
+
+
+@router.post('/rules')
+async def set_rules(request: SetRules, user: int = Depends(require_user), db: ChatStorage = Depends(get_db),
+                    permissions: PermissionCache = Depends(get_permissions)):
+    try:
+        chat = await db.get_chat_by_id(request.chat_id)
+        if not chat:
+            raise HTTPException(404, 'Chat does not exists.')
+        if chat['owner'] != user:
+            raise HTTPException(403, 'Only the owner can change rules.')
+        await permissions.set_rules(request.chat_id, request.user_ids,
+                                    **request.model_dump(exclude={'chat_id', 'user_ids'}))
+        return {'status_code': 200, 'updated': len(request.user_ids)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        raise HTTPException(500, 'Server side error.')
\ No newline at end of file
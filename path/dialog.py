@@ -1,46 +1,60 @@
 from asyncpg.connection import asyncpg
-from fastapi import APIRouter
-from models.users import UserLogin
-from modules.db import AsyncChatDB
-from asyncpg.exceptions import UniqueViolationError
-import hashlib
-import hashlib
+from fastapi import APIRouter, Depends, Request
+from modules.db import get_db
+from modules.storage import ChatStorage
+from modules.session import require_user
+from modules.admission import rate_limited
+from modules.membership import MembershipCache, get_membership
+from modules.responses import ORJSONResponse
+from modules.wire import negotiated
+from models.chats import DialogList
 from fastapi import HTTPException
+from typing import Optional
 
 router = APIRouter()
-db = AsyncChatDB()
 
-@router.on_event("startup")
-async def startup():
-    await db.connect()
-
-@router.post('/get')
-async def dialogs(request: UserLogin):
+@router.post('/get', response_model=DialogList, response_class=ORJSONResponse)
+async def dialogs(request: Request, user: int = Depends(rate_limited('/dialog/get')), db: ChatStorage = Depends(get_db)):
     try:
-        user = await db.login(request.username, request.password_hash)
-        if not user:
-            return HTTPException(403, 'Unverified session.')
         chats = await db.get_user_chats(user)
-        return {'status_code':200, 'chats':chats}
+        return negotiated(request, {'status_code':200, 'chats':chats})
     except Exception as e:
         print(e)
-        return HTTPException(500, 'Server side error.')
+        raise HTTPException(500, 'Server side error.')
+
+@router.post('/read')
+async def mark_read(chat_id: int, message_id: Optional[int]=None, user: int = Depends(require_user),
+                    db: ChatStorage = Depends(get_db)):
+    try:
+        moved = await db.mark_read(user, chat_id, message_id)
+        return {'status_code': 200, 'updated': moved}
+    except Exception as e:
+        print(e)
+        raise HTTPException(500, 'Server side error.')
 
 @router.post('/join')
-async def join_chat(request: UserLogin, chat_name: str='', chat_id: int=0):
+async def join_chat(chat_name: str='', chat_id: int=0, user: int = Depends(require_user), db: ChatStorage = Depends(get_db),
+                    membership: MembershipCache = Depends(get_membership)):
     try:
         if chat_name:
             chat_id_ = await db.get_chat_by_name(chat_name)
             if not chat_id_:
                 return HTTPException(404, 'Chat doesnt exists.')
-            chat_id = chat_id
+            chat_id = chat_id_['id']
 
-        user = await db.login(request.username, request.password_hash)
-        if not user:
-            return HTTPException(403, 'Unverified session.')
-        await db.join_chat(user, chat_id)
+        await membership.join(user, chat_id)
         return {'status_code': 200}
     except asyncpg.exceptions.ForeignKeyViolationError:
         return HTTPException(404, 'There is not such a group.')
     except Exception as e:
         return HTTPException(500, 'Server side error.')
+
+@router.post('/leave')
+async def leave_chat(chat_id: int, user: int = Depends(require_user),
+                     membership: MembershipCache = Depends(get_membership)):
+    try:
+        await membership.leave(user, chat_id)
+        return {'status_code': 200}
+    except Exception as e:
+        print(e)
+        raise HTTPException(500, 'Server side error.')
@@ -0,0 +1,39 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse
+from modules.db import get_db
+from modules.media import media_path
+from modules.storage import ChatStorage
+import asyncio
+import os
+
+router = APIRouter()
+
+
+@router.get('/{filename}/info')
+async def get_media_info(filename: str, db: ChatStorage = Depends(get_db)):
+    """
+    Processing state of an upload: queued, done (with its metadata) or failed.
+    """
+    if not media_path(filename):
+        raise HTTPException(404, 'No such media.')
+    job = await db.get_media_job(filename)
+    if job is None:
+        raise HTTPException(404, 'No such media.')
+    return {'status_code': 200, 'state': job['state'], 'attempts': job['attempts'], 'error': job['error'],
+            'media': job['meta']}
+
+
+@router.get('/{filename}')
+async def get_media(filename: str):
+    path = media_path(filename)
+    if not path:
+        raise HTTPException(404, 'No such media.')
+    try:
+        stat = await asyncio.to_thread(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(404, 'No such media.')
+    # FileResponse answers Range requests itself and hands the file to the
+    # server's zero-copy path (http.response.pathsend) when it offers one.
+    media_type = 'image/jpeg' if filename.endswith('.jpg') else 'application/octet-stream'
+    return FileResponse(path, media_type=media_type, stat_result=stat,
+                        headers={'Cache-Control': 'public, max-age=31536000, immutable'})
@@ -1,126 +1,337 @@
-from fastapi import APIRouter
-from models.users import UserLogin
-from modules.db import AsyncChatDB
-from models.messages import MessageInput, StreamRequest
+from fastapi import APIRouter, Depends, Header, Request, HTTPException
+from modules.db import get_db
+from modules.storage import ChatStorage, PublishError
+from modules.admission import StreamSlot, StreamSlots, get_stream_slots, rate_limited
+from modules.hub import FanoutHub
+from modules.ingest import get_ingest
+from modules.membership import MembershipCache, get_membership
+from modules.permissions import REMOVE_MESSAGE, SEND_MEDIA, SEND_MESSAGE, PermissionCache, get_permissions
+from modules.redis_conn import r
+from modules.media import MEDIA_MAX_BYTES, EmptyMedia, MediaTooLarge, media_url, store_stream
+from modules.media_pipeline import MediaPipeline, get_media_pipeline
+from modules.events import (CREATED, DELETED, EDITED, EventLog, make_event_id, message_envelope, parse_event_id,
+                            parse_published, parse_stream_id)
+from modules.wire import KEEPALIVE, SSE, STREAM_TYPES, negotiate, negotiated, stream_frame
+from models.messages import DeleteMessage, EditMessage, MessageInput, MessagesPage, SearchPage, StreamRequest
+from modules.responses import ORJSONResponse
 from fastapi.responses import StreamingResponse
-import hashlib
-from fastapi import HTTPException
-from fastapi import APIRouter, Request, HTTPException
-import uuid
+from typing import Optional
+import asyncio
+import base64
+import binascii
+import heapq
 import os
-import redis.asyncio as redis
-import json
 
 router = APIRouter()
-db = AsyncChatDB()
 
-r = redis.Redis()
+hub = FanoutHub(r)
+log = EventLog(r)
 
-@router.on_event("startup")
-async def startup():
-    await db.connect()
+PAGE_SIZE = int(os.getenv('MESSAGES_PAGE_SIZE', 40))
+MAX_PAGE_SIZE = int(os.getenv('MESSAGES_MAX_PAGE_SIZE', 200))
+STREAM_HEARTBEAT = float(os.getenv('STREAM_HEARTBEAT', 15))
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv('SEARCH_MAX_PAGE_SIZE', 100))
+SEARCH_MAX_QUERY = int(os.getenv('SEARCH_MAX_QUERY', 256))
 
-@router.post('/get')
-async def get_messages(request: UserLogin, chat_id: int=0, chat_name: str=''):
+def encode_cursor(direction: str, message_id: int) -> str:
+    """
+    direction is 'b' (older than message_id) or 'a' (newer than message_id).
+    """
+    return base64.urlsafe_b64encode(f'{direction}{message_id}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        if raw[0] not in 'ab':
+            raise ValueError(raw)
+        return raw[0], int(raw[1:])
+    except (ValueError, IndexError, binascii.Error, UnicodeDecodeError):
+        raise HTTPException(400, 'Invalid cursor.')
+
+
+def encode_search_cursor(rank: float, message_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{rank!r}:{message_id}'.encode()).decode().rstrip('=')
+
+
+def decode_search_cursor(cursor: str):
+    try:
+        rank, _, message_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().partition(':')
+        return float(rank), int(message_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise HTTPException(400, 'Invalid cursor.')
+
+
+@router.post('/get', response_model=MessagesPage, response_class=ORJSONResponse)
+async def get_messages(request: Request, chat_id: int=0, chat_name: str='', limit: int=PAGE_SIZE,
+                       before_id: Optional[int]=None, after_id: Optional[int]=None, cursor: str='', include: str='',
+                       user_id: int = Depends(rate_limited('/messages/get')), db: ChatStorage = Depends(get_db),
+                       membership: MembershipCache = Depends(get_membership)):
+    """
+    A page of history, newest first. include=senders adds the profile of
+    every distinct sender on the page, so clients need no /user/get per sender.
+    Answers in MessagePack and compressed too, see modules/wire.py.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    if cursor:
+        direction, message_id = decode_cursor(cursor)
+        before_id, after_id = (message_id, None) if direction == 'b' else (None, message_id)
     try:
         if chat_name:
             chat_id_ = await db.get_chat_by_name(chat_name)
             if not chat_id_:
-                return HTTPException(404, 'Doesnt exists.')
+                raise HTTPException(404, 'Doesnt exists.')
             chat_id = chat_id_['id']
-        messages = await db.get_last_messages(chat_id, 0, 40)
-        return {'status_code':200, 'messages':messages}
+        if not await membership.is_member(chat_id, user_id):
+            raise HTTPException(403, 'You are not joined in this chat.')
+        messages = await db.get_last_messages(chat_id, limit, before_id=before_id, after_id=after_id)
+        if after_id is not None:
+            # Forward paging always hands back a cursor so clients can keep polling for newer messages.
+            next_cursor = encode_cursor('a', messages[0]['id'] if messages else after_id)
+        elif len(messages) == limit:
+            next_cursor = encode_cursor('b', messages[-1]['id'])
+        else:
+            next_cursor = None
+        page = {'status_code':200, 'messages':messages, 'next_cursor': next_cursor}
+        if 'senders' in include.split(','):
+            page['senders'] = list((await db.get_users_by_ids(m['sender_id'] for m in messages)).values())
+        return negotiated(request, page)
+    except HTTPException:
+        raise
     except Exception as e:
         print(e)
-        return HTTPException(500, 'Server side error.')
+        raise HTTPException(500, 'Server side error.')
             
 
-@router.post('/send')
-async def send_message(data: MessageInput):
+@router.post('/search', response_model=SearchPage, response_class=ORJSONResponse)
+async def search_messages(q: str, chat_id: int=0, chat_name: str='', limit: int=SEARCH_PAGE_SIZE, cursor: str='',
+                          user_id: int = Depends(rate_limited('/messages/search')), db: ChatStorage = Depends(get_db),
+                          membership: MembershipCache = Depends(get_membership)):
+    """
+    Ranked full-text search in one chat, or in every joined chat when neither
+    chat_id nor chat_name is given. Pass next_cursor back for the next page.
+    """
+    q = q.strip()
+    if not q or len(q) > SEARCH_MAX_QUERY:
+        raise HTTPException(400, 'Invalid search query.')
+    limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+    after = decode_search_cursor(cursor) if cursor else None
     try:
-        # Authenticate user
-        password_hash = hashlib.sha256(data.password.encode()).hexdigest()
-        user_id = await db.login(data.username, password_hash)
-        if not user_id:
-            raise HTTPException(status_code=403, detail="Invalid username or password.")
+        if chat_name:
+            chat = await db.get_chat_by_name(chat_name)
+            if not chat:
+                raise HTTPException(404, 'Chat not found.')
+            chat_id = chat['id']
+        if chat_id and not await membership.is_member(chat_id, user_id):
+            raise HTTPException(403, 'You are not joined in this chat.')
+        messages = await db.search_messages(q, chat_id or None, user_id, limit, after)
+        next_cursor = encode_search_cursor(messages[-1]['rank'], messages[-1]['id']) if len(messages) == limit else None
+        return ORJSONResponse({'status_code': 200, 'messages': messages, 'next_cursor': next_cursor})
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        raise HTTPException(500, 'Server side error.')
 
-        
+
+@router.post('/send')
+async def send_message(data: MessageInput, user_id: int = Depends(rate_limited('/messages/send')), db: ChatStorage = Depends(get_db),
+                       ingest = Depends(get_ingest), membership: MembershipCache = Depends(get_membership),
+                       permissions: PermissionCache = Depends(get_permissions)):
+    try:
         chat_id = data.chat_id
         if data.chat_name:
             chat = await db.get_chat_by_name(data.chat_name)
             if not chat:
                 raise HTTPException(status_code=404, detail="Chat not found.")
             chat_id = chat['id']
+        if not await membership.is_member(chat_id, user_id):
+            raise HTTPException(status_code=403, detail="You are not joined in this chat.")
+        await permissions.require(chat_id, user_id, SEND_MESSAGE | (SEND_MEDIA if data.is_media else 0))
 
-        
-        msg_id = await db.send_message(
+        msg_id = await ingest.send_message(
             chat_id=chat_id,
             sender_id=user_id,
             content=data.content,
             reply_to=data.reply_to if data.reply_to else None,
             is_media=data.is_media
         )
-        await r.publish(f'{chat_id}', json.dumps(dict(chat_id=chat_id,
-            sender_id=user_id,
-            content=data.content,
-            reply_to=data.reply_to if data.reply_to else None,
-            is_media=data.is_media)))
         return {'status_code': 200, 'message_id': msg_id}
+    except PublishError as e:
+        # Stored, so the send succeeded; open streams miss it, but history and /sync have it.
+        print("Message stored but not published:", e.__cause__)
+        return {'status_code': 200, 'message_id': e.ids[0]}
+    except HTTPException:
+        raise
     except Exception as e:
         print("Error in /send:", e)
         raise HTTPException(status_code=500, detail="Server error.")
 
 
 @router.post("/upload-media")
-async def upload_media(request: Request):
+async def upload_media(request: Request, chat_id: int, user_id: int = Depends(rate_limited('/messages/upload-media')),
+                       db: ChatStorage = Depends(get_db), membership: MembershipCache = Depends(get_membership),
+                       permissions: PermissionCache = Depends(get_permissions),
+                       pipeline: MediaPipeline = Depends(get_media_pipeline)):
+    """
+    Stores the body and queues it for processing (modules/media_pipeline.py).
+    Send the returned url as an is_media message; its media field fills in
+    once processing is done, and /media/{filename}/info reports progress.
+    """
+    if not await membership.is_member(chat_id, user_id):
+        raise HTTPException(403, "You are not joined in this chat.")
+    await permissions.require(chat_id, user_id, SEND_MEDIA)
+    length = request.headers.get('content-length', '')
+    if length.isdigit() and int(length) > MEDIA_MAX_BYTES:
+        raise HTTPException(413, "File too large.")
+    try:
+        filename, size = await store_stream(request.stream())
+        await db.enqueue_media(filename, size)
+        pipeline.notify()
+        return {"status_code": 200, "url": media_url(filename), "size": size}
+    except EmptyMedia:
+        raise HTTPException(400, "Empty file body.")
+    except MediaTooLarge:
+        raise HTTPException(413, "File too large.")
+    except Exception as e:
+        print("Error uploading media:", e)
+        raise HTTPException(500, 'Server side error.')
+
+@router.post('/edit')
+async def edit_message(data: EditMessage, user_id: int = Depends(rate_limited('/messages/edit')), db: ChatStorage = Depends(get_db)):
+    try:
+        # Only the sender may edit.
+        if not await db.edit_message(data.message_id, user_id, data.content):
+            raise HTTPException(404, 'Message not found.')
+        return {'status_code': 200}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        raise HTTPException(500, 'Server side error.')
+
+@router.post('/delete')
+async def delete_message(data: DeleteMessage, user_id: int = Depends(rate_limited('/messages/delete')), db: ChatStorage = Depends(get_db),
+                         permissions: PermissionCache = Depends(get_permissions)):
     try:
-        body = await request.body()
-        if not body:
-            raise HTTPException(400, "Empty file body.")
+        if await db.delete_message(data.message_id, user_id):
+            return {'status_code': 200}
+        # Not the sender: only moderators of the chat may remove it.
+        await permissions.require(data.chat_id, user_id, REMOVE_MESSAGE)
+        if not await db.remove_message(data.message_id, data.chat_id):
+            raise HTTPException(404, 'Message not found.')
+        return {'status_code': 200}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        raise HTTPException(500, 'Server side error.')
 
-        filename = f"{uuid.uuid4()}.bin"
-        filepath = f"static/media/{filename}"
 
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+async def replay_from_db(db: ChatStorage, chat_id: int, since: int):
+    """
+    (seq, envelope) for every change after change_seq `since`, oldest first,
+    for clients whose position was trimmed from the log.
+    """
+    while True:
+        messages, deletions = await db.get_chat_changes(chat_id, since, MAX_PAGE_SIZE)
+        changes = heapq.merge(
+            ((row['change_seq'], EDITED if row['edited_at'] else CREATED, row) for row in messages),
+            ((row['change_seq'], DELETED, row) for row in deletions),
+            key=lambda change: change[0],
+        )
+        # A full page of either kind may hide later changes of the other, so
+        # stop at the end of the shorter full page and fetch again from there.
+        full = [rows[-1]['change_seq'] for rows in (messages, deletions) if len(rows) == MAX_PAGE_SIZE]
+        limit = min(full) if full else None
+        for seq, kind, row in changes:
+            if limit is not None and seq > limit:
+                break
+            yield seq, message_envelope(kind, row)
+        if limit is None:
+            return
+        since = limit
 
-        with open(filepath, "wb") as f:
-            f.write(body)
 
-        url = f"/media/{filename}"
-        return {"status_code": 200, "url": url}
-    except Exception as e:
-        print("Error uploading media:", e)
-        return HTTPException(500, 'Server side error.')
+async def wait_for_message(chat_id, db: ChatStorage, last_event_id: str = '', slot: Optional[StreamSlot] = None,
+                           media_type: str = SSE):
+    # Subscribe before replaying so nothing published during the replay is lost;
+    # live events already covered by the replay are skipped below.
+    def live_frame(data: bytes) -> bytes:
+        stream_id, seq, envelope = parse_published(data)
+        return stream_frame(media_type, make_event_id(stream_id, seq), envelope)
 
-async def wait_for_message(chat_id):
-    pubsub = r.pubsub()
-    await pubsub.subscribe(f"{chat_id}")
-    async for message in pubsub.listen():
-        if message['type'] == 'message':
-            print(message)
-            yield message['data']
+    sub = await hub.subscribe(f"{chat_id}")
+    try:
+        position = (0, 0)
+        replayed = set()
+        if last_event_id:
+            stream_id, seq = parse_event_id(last_event_id)
+            events = await log.replay(chat_id, stream_id)
+            if events is None:
+                async for seq, data in replay_from_db(db, chat_id, seq):
+                    replayed.add(seq)
+                    yield stream_frame(media_type, make_event_id('0-0', seq), data)
+            else:
+                position = parse_stream_id(stream_id)
+                for stream_id, seq, data in events:
+                    position = parse_stream_id(stream_id)
+                    yield stream_frame(media_type, make_event_id(stream_id, seq), data)
+        while True:
+            # Busy streams must refresh too, not only idle ones between heartbeats.
+            if slot is not None:
+                await slot.refresh_if_due()
+            try:
+                published = await sub.get(STREAM_HEARTBEAT if slot is None else min(STREAM_HEARTBEAT, slot.slots.refresh))
+            except asyncio.TimeoutError:
+                yield KEEPALIVE[media_type]
+                continue
+            except StopAsyncIteration:
+                return
+            # Parsed and framed once per format for all of the chat's streams on this worker.
+            stream_id, seq, _ = published.encode('parsed', parse_published)
+            if parse_stream_id(stream_id) <= position or seq in replayed:
+                continue
+            yield published.encode(media_type, live_frame)
+    finally:
+        await hub.unsubscribe(sub)
+        if slot is not None:
+            await slot.release()
 
 @router.post('/stream')
-async def streamer(request: StreamRequest):
+async def streamer(request: StreamRequest, http_request: Request, user: int = Depends(rate_limited('/messages/stream')),
+                   db: ChatStorage = Depends(get_db), membership: MembershipCache = Depends(get_membership),
+                   slots: StreamSlots = Depends(get_stream_slots),
+                   last_event_id_header: str = Header('', alias='Last-Event-ID')):
+    last_event_id = request.last_event_id or last_event_id_header
+    if last_event_id:
+        try:
+            parse_event_id(last_event_id)
+        except ValueError:
+            raise HTTPException(400, 'Invalid last_event_id.')
     try:
-        user = await db.login(request.username, hashlib.sha256(request.password.encode('utf-8')).hexdigest())
-        if not user:
-            return HTTPException(403, 'Unverified session.')
-        
         if request.chat_name:
             chat_id = await db.get_chat_by_name(request.chat_name)
             if not chat_id:
-                return HTTPException(404, 'Chat does not exists.')
+                raise HTTPException(404, 'Chat does not exists.')
             chat_id = chat_id['id']
         else:
             chat_id = await db.get_chat_by_id(request.chat_id)
             if not chat_id:
-                return HTTPException(404, 'Chat does not exists.')
+                raise HTTPException(404, 'Chat does not exists.')
             chat_id = chat_id['id']
-        if not await db.is_joined(chat_id, user):
-            return HTTPException(403, 'You are not joined in this chat.')
+        if not await membership.is_member(chat_id, user):
+            raise HTTPException(403, 'You are not joined in this chat.')
+        slot = await slots.acquire(user)
+        if slot is None:
+            raise HTTPException(429, 'Too many open streams.')
 
-        return StreamingResponse(wait_for_message(chat_id))
+        media_type = negotiate(http_request.headers.get('accept', ''), STREAM_TYPES)
+        return StreamingResponse(wait_for_message(chat_id, db, last_event_id, slot, media_type), media_type=media_type,
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'Vary': 'Accept'})
+    except HTTPException:
+        raise
     except Exception as e:
         print(e)
-        return HTTPException(500, 'Server side error.')
\ No newline at end of file
+        raise HTTPException(500, 'Server side error.')
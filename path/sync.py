@@ -0,0 +1,61 @@
+from fastapi import APIRouter, Depends, HTTPException
+from models.messages import SyncPage, SyncRequest
+from modules.db import get_db
+from modules.storage import ChatStorage
+from modules.responses import ORJSONResponse
+from modules.admission import rate_limited
+import os
+
+router = APIRouter()
+
+SYNC_MAX_LIMIT = int(os.getenv('SYNC_MAX_LIMIT', 2000))
+SYNC_MAX_CHATS = int(os.getenv('SYNC_MAX_CHATS', 5000))
+# Hold back changes younger than this so a lower, still-committing change_seq is never skipped.
+SYNC_SETTLE = float(os.getenv('SYNC_SETTLE', 1.0))
+
+
+@router.post('', response_model=SyncPage, response_class=ORJSONResponse)
+async def sync(request: SyncRequest, user: int = Depends(rate_limited('/sync')), db: ChatStorage = Depends(get_db)):
+    """
+    Brings a device up to date across all joined chats. Pass the previous
+    response's next_seq as `since`; repeat while has_more is true.
+
+    A device that only knows the last message it has of each chat sends a
+    chat_id -> last seen message id map in `chats` instead, and merges the
+    response's next_chats into it for the next call. A map request never gets
+    a next_seq: the map may not cover every joined chat, so no single
+    position is safe for all of them.
+    """
+    limit = max(1, min(request.limit, SYNC_MAX_LIMIT))
+    if len(request.chats) > SYNC_MAX_CHATS:
+        raise HTTPException(400, 'Too many chats.')
+    try:
+        messages, deletions = await db.get_changes(user, request.since, request.chats or None,
+                                                   limit, SYNC_SETTLE)
+        changes = sorted([('message', row) for row in messages] + [('deleted', row) for row in deletions],
+                         key=lambda change: change[1]['change_seq'])
+        has_more = len(messages) == limit or len(deletions) == limit or len(changes) > limit
+        changes = changes[:limit]
+        messages = [row for kind, row in changes if kind == 'message']
+        next_seq = next_chats = None
+        if request.chats:
+            # Every change of a chat up to the last one returned is in this page, so the
+            # newest message returned from a chat is safe as its last seen id.
+            next_chats = {}
+            for row in messages:
+                chat_id = row['chat_id']
+                next_chats[chat_id] = max(next_chats.get(chat_id, request.chats[chat_id]), row['id'])
+        else:
+            next_seq = changes[-1][1]['change_seq'] if changes else request.since
+        return ORJSONResponse({
+            'status_code': 200,
+            'messages': messages,
+            'deleted': [row for kind, row in changes if kind == 'deleted'],
+            'next_seq': next_seq,
+            # JSON object keys are strings, as in the request's map.
+            'next_chats': None if next_chats is None else {str(k): v for k, v in next_chats.items()},
+            'has_more': has_more,
+        })
+    except Exception as e:
+        print(e)
+        raise HTTPException(500, 'Server side error.')
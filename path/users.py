@@ -1,20 +1,21 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, Query
 from models.users import UserLogin, UserRegister
-from modules.db import AsyncChatDB
+from typing import List
+from modules.db import get_db
+from modules.storage import ChatStorage
+from modules.session import sessions, bearer_token
 from asyncpg.exceptions import UniqueViolationError
 import hashlib
 import hashlib
+import os
 from fastapi import HTTPException
 
 router = APIRouter()
-db = AsyncChatDB()
 
-@router.on_event("startup")
-async def startup():
-    await db.connect()
-    
+USERS_PER_REQUEST = int(os.getenv('USERS_PER_REQUEST', 200))
+
 @router.post('/register')
-async def register(user: UserRegister):
+async def register(user: UserRegister, db: ChatStorage = Depends(get_db)):
     print('here')
     try:
         user_id = await db.create_user(
@@ -31,13 +32,24 @@ async def register(user: UserRegister):
 
 
 @router.post('/login')
-async def post(user: UserLogin):
+async def post(user: UserLogin, db: ChatStorage = Depends(get_db)):
     try:
         hashed_pw = hashlib.sha256(user.password.encode('utf-8')).hexdigest()
         result = await db.login(user.username, hashed_pw)
         if isinstance(result, int):
-            return {'status': True, 'user_id': result}
-        raise HTTPException(status_code=403, detail="Wrong username and password combination.")
+            token = await sessions.create(result)
+            return {'status': True, 'user_id': result, 'token': token}
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail="Server side error.")
+    raise HTTPException(status_code=403, detail="Wrong username and password combination.")
+
+
+@router.post('/logout')
+async def logout(token: str = Depends(bearer_token)):
+    try:
+        await sessions.revoke(token)
+        return {'status': True}
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail="Server side error.")
@@ -46,11 +58,11 @@ async def post(user: UserLogin):
 from fastapi import HTTPException
 
 @router.get('/get')
-async def getuser(user_id: int):
+async def getuser(user_id: int, db: ChatStorage = Depends(get_db)):
     if not user_id:
         raise HTTPException(status_code=400, detail='No user_id.')
     try:
-        result = await db.get_user_by_id(user_id)
+        result = (await db.get_users_by_ids([user_id])).get(user_id)
         if not result:
             raise HTTPException(status_code=404, detail='No user exists with this user_id')
 
@@ -58,6 +70,23 @@ async def getuser(user_id: int):
         user_dict['password'] = 'HIDDEN'
 
         return {'status': True, 'user': user_dict}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail='Server side error.')
+
+
+@router.get('/get-many')
+async def getusers(user_id: List[int] = Query(...), db: ChatStorage = Depends(get_db)):
+    """
+    Public profiles for up to USERS_PER_REQUEST ids (?user_id=1&user_id=2);
+    unknown ids are left out.
+    """
+    if len(user_id) > USERS_PER_REQUEST:
+        raise HTTPException(status_code=400, detail=f'At most {USERS_PER_REQUEST} user ids.')
+    try:
+        return {'status': True, 'users': list((await db.get_users_by_ids(user_id)).values())}
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail='Server side error.')